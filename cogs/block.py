@@ -3,6 +3,7 @@ import re
 import discord
 from discord.ext import commands
 
+from core.queries import BLOCKED_USERS, catalog
 from core.statbot import StatBot
 from core.utility import get_conn
 
@@ -13,11 +14,7 @@ class Block(commands.Cog):
 
     async def _is_blocked(self, user_id: int) -> bool:
         async with get_conn(self.bot) as conn:
-            list_ = await conn.fetch(
-                'SELECT UserID FROM statbot_db.USERS '
-                'WHERE Restricted = $1',
-                True
-            )
+            list_ = await catalog.fetch(conn, BLOCKED_USERS, True)
             results = [item for sublist in list_ for item in sublist]
 
             if user_id not in results:
@@ -129,11 +126,7 @@ class Block(commands.Cog):
     @commands.is_owner()
     async def blocklist(self, ctx: commands.Context) -> None:
         async with get_conn(self.bot) as conn:
-            rows = await conn.fetch(
-                'SELECT UserID FROM statbot_db.USERS '
-                'WHERE Restricted = $1',
-                True
-            )
+            rows = await catalog.fetch(conn, BLOCKED_USERS, True)
             if not rows:
                 await ctx.send('There are currently no blocked users.')
                 return
@@ -5,7 +5,6 @@ WC_MARGIN = 2
 WC_HEIGHT = 360
 WC_WIDTH = 640
 WC_SCALE = 2
-WC_COLLOCATIONS = True
 WC_MAX_WORDS = 800
 WC_MAX_FONT_SIZE = None
 WC_COLOR_MODE = 'RGB'
@@ -1,8 +1,39 @@
+import datetime
+import json
+import time
+from functools import partial
+
 import discord
+import pandas as pd
+from core import bot_config, counters, fulltext, partitions, queries, utility, words
+from core.loader import LOADERS, create_loader
 from core.statbot import StatBot
+from core.timerange import TimeRange
+from core.utility import get_conn
 from discord.ext import commands
 
 
+# Shaped like the grade messages, with the row count as $1
+BENCH_FETCH_QUERY = (
+    'SELECT G.N % 1000 AS authorid, repeat(\'benchmark message \', 1 + G.N % 8) || G.N AS msgs, '
+    'NOW() - G.N * INTERVAL \'1 second\' AS sent '
+    'FROM generate_series(1, $1) AS G(N)'
+)
+
+
+def _plan_indexes(plan: dict) -> list[str]:
+    indexes = [plan['Index Name']] if 'Index Name' in plan else list()
+    for child in plan.get('Plans', list()):
+        indexes.extend(_plan_indexes(child))
+    return indexes
+
+
+def _pandas_word_freq(msgs: pd.Series, limit: int) -> pd.DataFrame:
+    # How vocab counted words before they were counted at ingestion time
+    word_freq = msgs.str.lower().str.split().explode().value_counts().rename_axis(['word']).reset_index(name='counts')
+    return word_freq.head(limit)
+
+
 class DevCommands(commands.Cog):
     def __init__(self, bot: StatBot) -> None:
         self.bot = bot
@@ -31,9 +62,210 @@ class DevCommands(commands.Cog):
     @commands.command(hidden=True)
     @commands.is_owner()
     async def dbstats(self, ctx: commands.Context) -> None:
-        p = self.bot.pool
-        await ctx.send('Database Pool Connection Status Report:\nMin Size: {}, Max Size: {}, Size: {}, Free Size: {}'
-                       ''.format(p.minsize, p.maxsize, p.size, p.freesize))
+        await ctx.send(self.bot.pools.report())
+        await ctx.send(self.bot.message_buffer.report())
+        await ctx.send(self.bot.registry.report())
+        await ctx.send(utility.fetch_stats.report())
+        await ctx.send(queries.catalog.report())
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def cachestats(self, ctx: commands.Context, clear: bool = False) -> None:
+        await ctx.send(self.bot.report_cache.report())
+        if clear:
+            self.bot.report_cache.clear()
+            await ctx.send('Report cache cleared.')
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def benchloader(self, ctx: commands.Context, rows: int = 100000) -> None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        records = [
+            [x, None, 'benchmark message number {}'.format(x), [], now, None, 1, 1, 1]
+            for x in range(rows)
+        ]
+
+        # The scratch table has none of the MESSAGES counter triggers: they'd need real SERVERS/CHANNELS rows and would
+        # lock live counters for as long as the benchmark runs. So these numbers leave out the counting cost
+        report = 'Loader Throughput Report ({} rows, without the MESSAGE_COUNTS/WORD_COUNTS triggers):\n'.format(rows)
+        async with get_conn(self.bot) as conn:
+            for method in LOADERS:
+                for batch_size in (1000, 5000, 20000):
+                    tr = conn.transaction()
+                    await tr.start()
+                    try:
+                        await conn.execute(
+                            'CREATE TEMP TABLE bench_messages (LIKE statbot_db.MESSAGES INCLUDING ALL)'
+                        )
+                        loader = create_loader(conn, method, batch_size, schema=None, table='bench_messages')
+                        for record in records:
+                            await loader.add(record)
+                        await loader.flush()
+                    finally:
+                        await tr.rollback()
+
+                    report += '{} (batch {}): {:.2f}s, {:.0f} rows/s\n'.format(
+                        method, batch_size, loader.elapsed, loader.rows_per_second
+                    )
+
+        await ctx.send(report)
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def benchfetch(self, ctx: commands.Context, *sizes: int) -> None:
+        report = 'DataFrame Fetch Benchmark:\n'
+        async with get_conn(self.bot, 'analytics') as conn:
+            for rows in sizes or (10000, 1000000, 10000000):
+                for method, fetch in (('cursor', utility.fetch_as_dataframe), ('copy', utility.copy_as_dataframe)):
+                    start = time.perf_counter()
+                    try:
+                        df = await fetch(conn, BENCH_FETCH_QUERY, rows)
+                    except utility.ResultTooLarge:
+                        report += '{} rows via {}: over FETCH_MAX_MB\n'.format(rows, method)
+                        continue
+
+                    elapsed = time.perf_counter() - start
+                    report += '{} rows via {}: {:.0f} ms, {:.0f} rows/s, {:.1f} MB DataFrame\n'.format(
+                        rows, method, elapsed * 1000, rows / elapsed if elapsed else 0.0,
+                        df.memory_usage(deep=True).sum() / 1024 / 1024
+                    )
+                    del df
+
+        await ctx.send(report)
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def explainhot(self, ctx: commands.Context) -> None:
+        if ctx.guild is None:
+            await ctx.send('Run this from a server, its reports are the ones that get explained.')
+            return
+
+        # The statements the report commands run, time ranged ones over the grade window
+        since, until = TimeRange.last_days(bot_config.GRADE_WINDOW_DAYS).bounds
+        values = {'server': ctx.guild.id, 'channel': ctx.channel.id, 'author': ctx.author.id, 'since': since,
+                  'until': until}
+
+        report = 'Hot Query Plans (EXPLAIN ANALYZE):\n'
+        async with get_conn(self.bot, 'analytics') as conn:
+            for name, parameters in queries.REPORT_PARAMETERS.items():
+                # ANALYZE really runs the query, so keep it from changing anything
+                tr = conn.transaction(readonly=True)
+                await tr.start()
+                try:
+                    explained = await conn.fetchval(
+                        'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + queries.QUERIES[name],
+                        *(values[p] for p in parameters)
+                    )
+                finally:
+                    await tr.rollback()
+
+                result = json.loads(explained)[0]
+                plan = result['Plan']
+                report += '{}: {:.1f} ms (planning {:.1f} ms), {} via {}\n'.format(
+                    name, result['Execution Time'], result['Planning Time'], plan['Node Type'],
+                    ', '.join(_plan_indexes(plan)) or 'no index'
+                )
+
+        await ctx.send(report)
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def enablefulltext(self, ctx: commands.Context) -> None:
+        await ctx.send('Adding the full-text column, this rewrites the messages table and blocks writes to it...')
+        async with get_conn(self.bot) as conn:
+            await fulltext.add_column(conn)
+            await partitions.create_index_concurrently(
+                conn, fulltext.INDEX_NAME, fulltext.INDEX_SUFFIX, 'USING GIN ({})'.format(fulltext.COLUMN)
+            )
+        await ctx.send('Full-text column and index are ready, set WORD_STATS_BACKEND = \'tsvector\' to use them.')
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def disablefulltext(self, ctx: commands.Context) -> None:
+        async with get_conn(self.bot) as conn:
+            await fulltext.drop_column(conn)
+        await ctx.send('Full-text column dropped.')
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def benchwords(self, ctx: commands.Context, member: discord.Member = None, limit: int = 100) -> None:
+        if ctx.guild is None:
+            await ctx.send('Run this from the server to benchmark.')
+            return
+
+        author_id = member.id if member else None
+        scope = member.name if member else ctx.guild.name
+        report = 'Word Frequency Benchmark ({}, top {}):\n'.format(scope, limit)
+
+        async with get_conn(self.bot, 'analytics') as conn:
+            start = time.perf_counter()
+            df = await utility.fetch_as_dataframe(
+                conn,
+                'SELECT M.Content AS msgs FROM statbot_db.MESSAGES AS M '
+                'WHERE M.ServerID = $1 AND ($2::BIGINT IS NULL OR M.AuthorID = $2)',
+                ctx.guild.id,
+                author_id
+            )
+            fetched = time.perf_counter() - start
+            transferred = int(df.msgs.str.len().sum()) if len(df.index) else 0
+            await self.bot.loop.run_in_executor(None, partial(_pandas_word_freq, df.msgs, limit))
+            report += 'pandas over raw messages: {:.0f} ms ({:.0f} ms fetching {} rows, {} characters)\n'.format(
+                (time.perf_counter() - start) * 1000, fetched * 1000, len(df.index), transferred
+            )
+
+            start = time.perf_counter()
+            rows = await words.word_frequencies(conn, ctx.guild.id, author_id=author_id, limit=limit)
+            report += 'WORD_COUNTS table: {:.0f} ms, {} rows\n'.format((time.perf_counter() - start) * 1000, len(rows))
+
+            if await fulltext.is_enabled(conn):
+                start = time.perf_counter()
+                rows = await fulltext.word_frequencies(conn, ctx.guild.id, author_id=author_id, limit=limit)
+                report += 'ts_stat over {}: {:.0f} ms, {} rows\n'.format(
+                    fulltext.COLUMN, (time.perf_counter() - start) * 1000, len(rows)
+                )
+            else:
+                report += 'ts_stat: full-text column not enabled\n'
+
+        await ctx.send(report)
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def checkcounts(self, ctx: commands.Context, fix: bool = False) -> None:
+        if ctx.guild is None:
+            await ctx.send('Run this from the server whose counters should be checked.')
+            return
+
+        async with get_conn(self.bot) as conn:
+            mismatches = await counters.check_server(conn, ctx.guild.id)
+            if mismatches and fix:
+                await counters.recount_server(conn, ctx.guild.id)
+
+        if not mismatches:
+            await ctx.send('Message counters for this server match the messages table.')
+            return
+
+        report = 'Message counters are off for {} channel/author pairs{}:\n'.format(
+            len(mismatches), ', recounted' if fix else ''
+        )
+        for row in mismatches[:10]:
+            report += 'Channel {}, Author {}: counted {}, actual {}\n'.format(
+                row['channelid'], row['authorid'], row['counted'], row['actual']
+            )
+        await ctx.send(report)
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def recountwords(self, ctx: commands.Context) -> None:
+        # Applies tokenizer changes, e.g. new command prefixes in wordcloud/prefixes.txt. The prefixes are read at
+        # startup, so restart the bot before running this
+        await ctx.send('Recounting words for all servers, writes to the messages table wait until it is done...')
+        async with get_conn(self.bot) as conn:
+            # Replacing the triggers locks MESSAGES until commit, so no write is counted by neither or both
+            async with conn.transaction():
+                await words.install_triggers(conn)
+                await words.recount_all(conn)
+
+        await ctx.send('Word counts have been rebuilt.')
 
     @commands.command(hidden=True)
     @commands.is_owner()
@@ -1,14 +1,21 @@
+import asyncio
 import datetime
 import logging
 import time
+from typing import Optional
 
 import asyncpg
-import dateutil.parser
 import discord
 from discord.ext import commands
 
+from core import bot_config, partitions, rebuild
+from core.importer import ImportPlanner
+from core.ingest import is_loggable, message_row
+from core.loader import primary_key
+from core.purge import Purger
+from core.scheduler import ImportScheduler
 from core.statbot import StatBot
-from core.utility import get_conn
+from core.utility import get_conn, Status
 
 
 class Synchronization(commands.Cog):
@@ -16,13 +23,59 @@ class Synchronization(commands.Cog):
         self.bot = bot
         self.log = logging.getLogger('statbot')
         self.log.setLevel(level=logging.INFO)
+        self.planner = ImportPlanner(bot, bot_config.IMPORT_MAX_WORKERS, bot_config.IMPORT_GUILD_WORKERS)
+        self.scheduler = ImportScheduler(
+            bot, self.planner, bot_config.IMPORT_MAX_WORKERS, bot_config.IMPORT_GUILD_WORKERS
+        )
+        self.purger = Purger(bot, bot_config.PURGE_BATCH_SIZE, bot_config.PURGE_DELAY)
+        self._startup_task = None
+
+    async def cog_load(self) -> None:
+        async with get_conn(self.bot) as conn:
+            dropped = await rebuild.drop_stale(conn)
+        if dropped:
+            self.log.info('Dropped {} tables left behind by an interrupted regeneratedb'.format(dropped))
+
+        # Purges and imports interrupted by a restart pick up where they left off
+        self.purger.start()
+        await self.purger.resume()
+        await self.scheduler.recover()
+        self.scheduler.start()
+
+        # Read the cursors before the gateway connects, as live ingestion advances them past the offline gap
+        cursors = await self.planner.load_cursors()
+        self._startup_task = self.bot.loop.create_task(self._startup_sync(cursors))
+
+    async def cog_unload(self) -> None:
+        if self._startup_task is not None:
+            self._startup_task.cancel()
+        self.purger.stop()
+        self.scheduler.stop()
+
+    async def _startup_sync(self, cursors: dict[int, dict[int, Optional[int]]]) -> None:
+        await self.bot.wait_until_ready()
+
+        async with get_conn(self.bot) as conn:
+            for guild in self.bot.guilds:
+                if guild.id in cursors:
+                    await self._server_add_users(guild, conn)
+
+        for guild in self.bot.guilds:
+            if guild.id not in cursors:
+                continue
+
+            text_channels = [
+                c for c in guild.text_channels
+                if c.id in cursors[guild.id] and c.permissions_for(guild.me).read_message_history
+            ]
+            await self.scheduler.enqueue_guild(guild, text_channels, cursors[guild.id])
 
     async def _remove_text_channel(self, channel: discord.TextChannel) -> None:
         async with get_conn(self.bot) as conn:
             async with conn.transaction():
                 rows = await conn.fetch(
                     'SELECT ChannelID FROM statbot_db.CHANNELS '
-                    'WHERE ChannelID = $1 FOR UPDATE',
+                    'WHERE ChannelID = $1 AND NOT Removing FOR UPDATE',
                     channel.id
                 )
 
@@ -31,78 +84,62 @@ class Synchronization(commands.Cog):
                     self.log.debug(channel)
                     return
 
+                # The channel's messages are deleted in the background, see Purger
                 await conn.execute(
-                    'DELETE FROM statbot_db.CHANNELS '
+                    'UPDATE statbot_db.CHANNELS SET Removing = TRUE '
                     'WHERE ChannelID = $1',
                     channel.id
                 )
 
-    async def _add_text_channel(self, channel: discord.TextChannel) -> None:
-        async with get_conn(self.bot) as conn:
-            async with conn.transaction():
-                rows = await conn.fetch(
-                    'SELECT ServerID FROM statbot_db.SERVERS '
-                    'WHERE ServerID = $1 FOR KEY SHARE',
-                    channel.guild.id
-                )
+        self.bot.registry.remove_channel(channel.id)
+        self.bot.report_cache.bump(channel.guild.id)
+        self.purger.enqueue('channel', channel.id, channel.guild.id, channel.name)
 
-                if not rows:
-                    self.log.info('FAILED TO ADD CHANNEL: Server not in DB')
-                    self.log.debug(channel.guild)
-                    self.log.debug(channel)
-                    return
+    async def _add_text_channel(self, channel: discord.TextChannel) -> None:
+        if self.bot.registry.server_status(channel.guild.id) == Status.NOT_ADDED:
+            self.log.info('FAILED TO ADD CHANNEL: Server not in DB')
+            self.log.debug(channel.guild)
+            self.log.debug(channel)
+            return
 
-                await conn.execute(
-                    'INSERT INTO statbot_db.CHANNELS (ChannelID, ServerID, Importing) '
-                    'VALUES ($1, $2, $3)',
-                    channel.id,
-                    channel.guild.id,
-                    True
-                )
+        # A channel that was removed and re-added has to finish purging before its row can be recreated
+        await self.purger.wait_for('channel', channel.id)
 
-                await self._add_messages(channel, conn)
+        async with get_conn(self.bot) as conn:
+            await conn.execute(
+                'INSERT INTO statbot_db.CHANNELS (ChannelID, ServerID, Importing) '
+                'VALUES ($1, $2, $3)',
+                channel.id,
+                channel.guild.id,
+                True
+            )
+            self.bot.registry.set_channel(channel.id, channel.guild.id, importing=True)
 
-                await conn.execute(
-                    'UPDATE statbot_db.CHANNELS SET Importing = $1 '
-                    'WHERE ChannelID = $2',
-                    False,
-                    channel.id
-                )
+            # The history import itself can take hours, so it's left to the scheduler
+            await self.scheduler.enqueue(conn, channel)
 
     async def _add_user(self, member: discord.Member) -> None:
+        if self.bot.registry.server_status(member.guild.id) == Status.NOT_ADDED:
+            self.log.info('FAILED TO ADD USER: Server not in DB')
+            self.log.debug(member.guild)
+            self.log.debug(member)
+            return
+
         async with get_conn(self.bot) as conn:
             async with conn.transaction():
-                rows = await conn.fetch(
-                    'SELECT ServerID FROM statbot_db.SERVERS '
-                    'WHERE ServerID = $1 FOR KEY SHARE',
-                    member.guild.id
+                await conn.execute(
+                    'INSERT INTO statbot_db.USERS VALUES ($1, $2) '
+                    'ON CONFLICT DO NOTHING',
+                    member.id,
+                    False
                 )
 
-                if not rows:
-                    self.log.info('FAILED TO ADD USER: Server not in DB')
-                    self.log.debug(member.guild)
-                    self.log.debug(member)
-                    return
-
-                try:
-                    await conn.execute(
-                        'INSERT INTO statbot_db.USERS VALUES ($1, $2)',
-                        member.id,
-                        False
-                    )
-                except asyncpg.UniqueViolationError as e:
-                    self.log.info('User already exists in DB (EXPECTED)')
-                    self.log.debug(e)
-
-                try:
-                    await conn.execute(
-                        'INSERT INTO statbot_db.HAS_USERS VALUES ($1, $2)',
-                        member.guild.id,
-                        member.id
-                    )
-                except asyncpg.UniqueViolationError as e:
-                    self.log.debug(e)
-                    return
+                await conn.execute(
+                    'INSERT INTO statbot_db.HAS_USERS VALUES ($1, $2) '
+                    'ON CONFLICT DO NOTHING',
+                    member.guild.id,
+                    member.id
+                )
 
     async def _remove_user(self, member: discord.Member) -> None:
         async with get_conn(self.bot) as conn:
@@ -129,114 +166,26 @@ class Synchronization(commands.Cog):
                     self.log.error('{!r}: errno is {}'.format(e, e.args[0]))
                     return
 
-    async def _delete_message(self, message_id: int) -> None:
-        async with get_conn(self.bot) as conn:
-            try:
-                await conn.execute(
-                    'DELETE FROM statbot_db.MESSAGES '
-                    'WHERE MessageID = $1',
-                    message_id
-                )
-            except Exception as e:
-                self.log.info('FAILED TO DELETE MESSAGE: Message is not in DB.')
-                self.log.debug(message_id)
-                self.log.debug('{!r}: errno is {}'.format(e, e.args[0]))
-                return
-
-    async def _bulk_delete_message(self, message_ids: set[int]) -> None:
-        async with get_conn(self.bot) as conn:
-            for message_id in message_ids:
-                try:
-                    await conn.execute(
-                        'DELETE FROM statbot_db.MESSAGES '
-                        'WHERE MessageID = $1',
-                        message_id
-                    )
-                except Exception as e:
-                    self.log.info('FAILED TO BULK DELETE MESSAGE: Message is not in DB')
-                    self.log.debug(message_id)
-                    self.log.debug('{!r}: errno is {}'.format(e, e.args[0]))
-                    continue
-                self.log.info('Bulk message deleted: ' + str(message_id))
-
-    async def _update_message(self, message_id: int, content: str, edited_timestamp: datetime.datetime) -> None:
-        async with get_conn(self.bot) as conn:
-            async with conn.transaction():
-                rows = await conn.fetch(
-                    'SELECT MessageID FROM statbot_db.MESSAGES '
-                    'WHERE MessageID = $1 FOR KEY SHARE',
-                    message_id
-                )
-                if not rows:
-                    self.log.info('FAILED TO UPDATE MESSAGE: Message is not in DB')
-                    self.log.debug(message_id)
-                    return
-
-                try:
-                    await conn.execute(
-                        'UPDATE statbot_db.MESSAGES '
-                        'SET Content = $1, EditTime = $2 '
-                        'WHERE MessageID = $3',
-                        content,
-                        edited_timestamp,
-                        message_id
-                    )
-                except Exception as e:
-                    self.log.info('FAILED TO UPDATE MESSAGE: Message is not in DB')
-                    self.log.debug(message_id)
-                    return
-
-    async def _log_message(self, message: discord.Message) -> None:
-        async with get_conn(self.bot) as conn:
-            if message.type != discord.MessageType.default and message.type != discord.MessageType.reply:
-                self.log.info('FAILED TO LOG MESSAGE: Type not default or reply')
-                self.log.debug(message)
-                self.log.debug('Message content: {}'.format(message.content))
-                return
-
-            async with conn.transaction():
-                rows = await conn.fetch(
-                    'SELECT ServerID FROM statbot_db.SERVERS '
-                    'WHERE ServerID = $1 FOR KEY SHARE',
-                    message.guild.id
-                )
-                if not rows:
-                    self.log.info('FAILED TO LOG MESSAGE: Server not in DB')
-                    self.log.debug(message)
-                    self.log.debug(message.guild)
-                    return
-
-                rows = await conn.fetch(
-                    'SELECT ChannelID FROM statbot_db.CHANNELS '
-                    'WHERE ChannelID = $1 FOR KEY SHARE',
-                    message.channel.id
-                )
-                if not rows:
-                    self.log.info('FAILED TO LOG MESSAGE: Channel not yet added')
-                    self.log.debug(message)
-                    self.log.debug(message.channel)
-                    return
+    def _log_message(self, message: discord.Message) -> None:
+        if not is_loggable(message):
+            self.log.info('FAILED TO LOG MESSAGE: Type not default or reply')
+            self.log.debug(message)
+            self.log.debug('Message content: {}'.format(message.content))
+            return
 
-                attachment_url_list = [attachment.url for attachment in message.attachments]
+        if self.bot.registry.channel_status(message.channel.id) == Status.NOT_ADDED:
+            self.log.info('FAILED TO LOG MESSAGE: Channel not yet added')
+            self.log.debug(message)
+            self.log.debug(message.channel)
+            return
 
-                await conn.execute(
-                    'INSERT INTO statbot_db.MESSAGES VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)',
-                    message.id,
-                    None if not message.reference else message.reference.message_id,
-                    message.content,
-                    attachment_url_list,
-                    message.created_at,
-                    message.edited_at,
-                    message.guild.id,
-                    message.channel.id,
-                    message.author.id
-                )
+        self.bot.message_buffer.put(message_row(message))
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message) -> None:
         if message.guild is None:
             return
-        await self._log_message(message)
+        self._log_message(message)
 
     @commands.Cog.listener()
     async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent) -> None:
@@ -246,11 +195,11 @@ class Synchronization(commands.Cog):
             self.log.info('FAILED TO DELETE MESSAGE: Ignoring DMChannel/GroupChannel')
             return
 
-        await self._delete_message(payload.message_id)
+        self.bot.message_buffer.delete([payload.message_id], payload.guild_id)
 
     @commands.Cog.listener()
     async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent) -> None:
-        await self._bulk_delete_message(payload.message_ids)
+        self.bot.message_buffer.delete(payload.message_ids, payload.guild_id)
 
     @commands.Cog.listener()
     async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent) -> None:
@@ -268,10 +217,12 @@ class Synchronization(commands.Cog):
         content = payload.data['content']
         edited_timestamp = payload.data['edited_timestamp']
 
+        # Discord sends ISO 8601, which fromisoformat handles without dateutil's format guessing
         if edited_timestamp is not None:
-            edited_timestamp = dateutil.parser.parse(edited_timestamp, ignoretz=True)
+            edited_timestamp = datetime.datetime.fromisoformat(edited_timestamp)
 
-        await self._update_message(message_id, content, edited_timestamp)
+        # Bursts of edits to the same message collapse into one row of a set-based UPDATE
+        self.bot.message_buffer.edit(message_id, content, edited_timestamp, payload.guild_id)
 
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member) -> None:
@@ -326,76 +277,28 @@ class Synchronization(commands.Cog):
                 await self._add_text_channel(text_channel)
                 self.log.info('Adding text channel')
 
-    async def _add_messages(self, text_channel: discord.TextChannel, conn: asyncpg.Connection) -> None:
-        msg_queue = list()
-        counter = 0
-
-        async with conn.transaction():
-            async for message in text_channel.history(limit=None):
-                if message.type != discord.MessageType.default and message.type != discord.MessageType.reply:
-                    self.log.info('FAILED TO LOG MESSAGE: Type not default or reply')
-                    self.log.debug(message)
-                    self.log.debug('Message content: {}'.format(message.content))
-                    continue
-
-                attachment_url_list = [attachment.url for attachment in message.attachments]
-
-                msg_queue.append([
-                    message.id,
-                    None if not message.reference else message.reference.message_id,
-                    message.content,
-                    attachment_url_list,
-                    message.created_at,
-                    message.edited_at,
-                    message.guild.id,
-                    message.channel.id,
-                    message.author.id
-                ])
-
-                counter += 1
-                if counter % 1000 == 0:
-                    await conn.executemany(
-                        'INSERT INTO statbot_db.MESSAGES '
-                        'VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)',
-                        msg_queue
-                    )
-                    msg_queue.clear()
-
-                if counter % 10000 == 0:
-                    self.log.info('Fetched 10000 messages from {} channel in {} '
-                                  'server'.format(text_channel.name, text_channel.guild.name))
-
-            if counter % 10000 != 0:
-                self.log.info('Fetched {} messages from {} channel, '
-                              '{} server'.format((counter % 10000),
-                                                 text_channel.name, text_channel.guild.name))
-                await conn.executemany(
-                    'INSERT INTO statbot_db.MESSAGES '
-                    'VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)',
-                    msg_queue
-                )
-                msg_queue.clear()
-
     async def _server_add_users(self, guild: discord.Guild, conn: asyncpg.Connection) -> None:
-        counter = 0
-        for member in guild.members:
-            try:
-                await conn.execute(
-                    'INSERT INTO statbot_db.USERS VALUES ($1, $2)',
-                    member.id,
-                    False
-                )
-            except asyncpg.UniqueViolationError as e:
-                self.log.info('FAILED TO ADD USER: Already exists in DB (expected)')
-                self.log.debug('{!r}: errno is {}'.format(e, e.args[0]))
-
-            await conn.execute(
-                'INSERT INTO statbot_db.HAS_USERS VALUES ($1, $2)',
-                guild.id,
-                member.id
-            )
-            counter += 1
-        self.log.info('Added {} users from {}'.format(counter, guild.name))
+        # Diffs the member list against HAS_USERS in one statement, so this also repairs churn missed while offline
+        row = await conn.fetchrow(
+            'WITH MEMBERS AS (SELECT unnest($2::BIGINT[]) AS UserID), '
+            'NEW_USERS AS ('
+            '    INSERT INTO statbot_db.USERS (UserID, Restricted) '
+            '    SELECT UserID, FALSE FROM MEMBERS '
+            '    ON CONFLICT DO NOTHING), '
+            'ADDED AS ('
+            '    INSERT INTO statbot_db.HAS_USERS (ServerID, UserID) '
+            '    SELECT $1, UserID FROM MEMBERS '
+            '    ON CONFLICT DO NOTHING '
+            '    RETURNING UserID), '
+            'REMOVED AS ('
+            '    DELETE FROM statbot_db.HAS_USERS AS H '
+            '    WHERE H.ServerID = $1 AND NOT EXISTS (SELECT 1 FROM MEMBERS AS M WHERE M.UserID = H.UserID) '
+            '    RETURNING UserID) '
+            'SELECT (SELECT COUNT(*) FROM ADDED) AS added, (SELECT COUNT(*) FROM REMOVED) AS removed',
+            guild.id,
+            [member.id for member in guild.members]
+        )
+        self.log.info('Added {} users to and removed {} users from {}'.format(row['added'], row['removed'], guild.name))
 
     @commands.command(hidden=True, name='addguild')
     @commands.is_owner()
@@ -408,6 +311,10 @@ class Synchronization(commands.Cog):
                 await ctx.send('You\'re going to have to send this message from the server you want added.')
                 return
 
+            if self.purger.is_pending('server', ctx.guild.id):
+                await ctx.send('This server is still being purged, try again once `purgestatus` shows it done.')
+                return
+
             try:
                 await conn.execute(
                     'INSERT INTO statbot_db.SERVERS '
@@ -420,10 +327,15 @@ class Synchronization(commands.Cog):
                 self.log.warning(ctx.guild)
                 self.log.warning('{!r}: errno is {}'.format(e, e.args[0]))
                 return
+            self.bot.registry.set_server(ctx.guild.id, importing=True)
+
+            if self.bot.messages_partitioned:
+                await partitions.create_server_partition(conn, ctx.guild.id, bot_config.MESSAGES_PARTITION_BY_SENT)
 
             # Now add all users in server
             await self._server_add_users(ctx.guild, conn)
 
+            import_channels = list()
             for text_channel in ctx.guild.text_channels:
                 await conn.execute(
                     'INSERT INTO statbot_db.CHANNELS (ChannelID, ServerID, Importing) VALUES ($1, $2, $3)',
@@ -431,6 +343,7 @@ class Synchronization(commands.Cog):
                     ctx.guild.id,
                     True
                 )
+                self.bot.registry.set_channel(text_channel.id, ctx.guild.id, importing=True)
 
                 if text_channel.permissions_for(ctx.guild.me).read_message_history is False:
                     self.log.info('Skipping restricted channel')
@@ -438,25 +351,13 @@ class Synchronization(commands.Cog):
                     self.log.debug(text_channel)
                     continue
 
-                await self._add_messages(text_channel, conn)
-
-                await conn.execute(
-                    'UPDATE statbot_db.CHANNELS SET Importing = $1 '
-                    'WHERE ChannelID = $2',
-                    False,
-                    text_channel.id
-                )
+                import_channels.append(text_channel)
 
-            await conn.execute(
-                'UPDATE statbot_db.SERVERS SET Importing = $1 '
-                'WHERE ServerID = $2',
-                False,
-                ctx.guild.id
-            )
-            self.log.info('Server message transfer complete')
+        await self.scheduler.enqueue_guild(ctx.guild, import_channels)
+        await ctx.send('Server added. Its history is being imported in the background, see `importstatus`.')
 
-            end = time.time()
-            self.log.info(str(round((end - start) / 60, 2)) + ' minutes elapsed')
+        end = time.time()
+        self.log.info(str(round((end - start) / 60, 2)) + ' minutes elapsed')
 
     @commands.command(hidden=True, name='removeguild')
     @commands.is_owner()
@@ -472,7 +373,7 @@ class Synchronization(commands.Cog):
             async with conn.transaction():
                 row = await conn.fetchrow(
                     'SELECT ServerID FROM statbot_db.SERVERS '
-                    'WHERE ServerID = $1 FOR UPDATE',
+                    'WHERE ServerID = $1 AND NOT Removing FOR UPDATE',
                     ctx.guild.id
                 )
                 if row is None:
@@ -481,77 +382,168 @@ class Synchronization(commands.Cog):
                     return
 
                 await conn.execute(
-                    'DELETE FROM statbot_db.SERVERS '
+                    'UPDATE statbot_db.SERVERS SET Removing = TRUE '
                     'WHERE ServerID = $1',
                     ctx.guild.id
                 )
+                await self.scheduler.forget_guild(conn, ctx.guild.id)
 
-            self.log.info('Server removal complete')
+                # Dropping the guild's partition is instant, the purge then only has leftovers to clear
+                if self.bot.messages_partitioned:
+                    await partitions.drop_server_partition(conn, ctx.guild.id)
+
+            self.bot.registry.remove_server(ctx.guild.id)
+            self.bot.report_cache.bump(ctx.guild.id)
+            await self.scheduler.cancel_guild(ctx.guild.id)
+            self.purger.enqueue('server', ctx.guild.id, ctx.guild.id, ctx.guild.name)
+
+            self.log.info('Server marked as removed, its messages are being purged in the background')
+            await ctx.send('Server removed. Its messages are being purged in the background, see `purgestatus`.')
 
             end = time.time()
             self.log.info(str(round((end - start) / 60, 2)) + ' minutes elapsed')
 
+    @commands.command(hidden=True, name='purgestatus')
+    @commands.is_owner()
+    async def purgestatus(self, ctx: discord.ext.commands.Context) -> None:
+        await ctx.send(self.purger.report())
+
+    @commands.command(hidden=True, name='importstatus')
+    @commands.is_owner()
+    async def importstatus(self, ctx: discord.ext.commands.Context) -> None:
+        await ctx.send(self.planner.progress.report())
+
+        metrics = self.planner.progress.metrics()
+        await ctx.send('```\n{}\n```'.format('\n'.join('{} {:g}'.format(k, v) for k, v in metrics.items())))
+
+    @commands.command(hidden=True, name='importqueue')
+    @commands.is_owner()
+    async def importqueue(self, ctx: discord.ext.commands.Context) -> None:
+        await ctx.send(await self.scheduler.report())
+
+    @commands.command(hidden=True, name='refreshregistry')
+    @commands.is_owner()
+    async def refreshregistry(self, ctx: discord.ext.commands.Context) -> None:
+        async with get_conn(self.bot) as conn:
+            await self.bot.registry.refresh(conn)
+
+        await ctx.send(self.bot.registry.report())
+
+    @commands.command(hidden=True, name='partitionmessages')
+    @commands.is_owner()
+    async def partitionmessages(self, ctx: discord.ext.commands.Context) -> None:
+        start = time.time()
+
+        async with get_conn(self.bot, 'import') as conn:
+            if await partitions.is_partitioned(conn):
+                await ctx.send('MESSAGES is already partitioned.')
+                return
+
+            await ctx.send('Partitioning MESSAGES by server. Messages keep being logged while this runs.')
+
+            server_ids = await partitions.prepare_migration(conn, bot_config.MESSAGES_PARTITION_BY_SENT)
+            for server_id in server_ids:
+                await partitions.copy_server(conn, server_id, bot_config.IMPORT_BATCH_SIZE)
+
+            # Upserts written against the old table's key would fail on the new one, so nothing is written until the
+            # swap is done and the buffer knows the new key
+            async with self.bot.message_buffer.paused(), self.scheduler.paused():
+                await partitions.finish_migration(conn)
+                self.bot.message_buffer.key = await primary_key(conn, 'statbot_db.messages')
+
+        self.bot.messages_partitioned = True
+        # Pooled connections may still hold statements prepared against the old table
+        await self.bot.pools.expire_connections()
+
+        end = time.time()
+        self.log.info('MESSAGES partitioning complete, ' + str(round((end - start) / 60, 2)) + ' minutes elapsed')
+        await ctx.send('MESSAGES is now partitioned by server. The old table was kept as '
+                       '`statbot_db.MESSAGES_UNPARTITIONED`; drop it once you\'ve checked the new one.')
+
+    async def _rebuild_guild(self, guild: discord.Guild) -> None:
+        partitioned = self.bot.messages_partitioned
+
+        async with get_conn(self.bot, 'import') as conn:
+            table = await rebuild.create_shadow(conn, guild.id, partitioned, bot_config.MESSAGES_PARTITION_BY_SENT)
+
+            # Now add all users in server
+            await self._server_add_users(guild, conn)
+
+            import_channels = list()
+            for text_channel in guild.text_channels:
+                # Channels the server gained since it was added still need a row for their messages to reference
+                status = await conn.execute(
+                    'INSERT INTO statbot_db.CHANNELS (ChannelID, ServerID, Importing) VALUES ($1, $2, $3) '
+                    'ON CONFLICT DO NOTHING',
+                    text_channel.id,
+                    guild.id,
+                    True
+                )
+                if status != 'INSERT 0 0':
+                    self.bot.registry.set_channel(text_channel.id, guild.id, importing=True)
+                elif self.bot.registry.channel_status(text_channel.id) == Status.NOT_ADDED:
+                    # Being purged
+                    continue
+
+                if text_channel.permissions_for(guild.me).read_message_history is False:
+                    print('Skipping restricted channel')
+                    continue
+
+                import_channels.append(text_channel)
+
+        try:
+            await self.planner.rebuild_guild(guild, import_channels, table)
+        except Exception:
+            async with get_conn(self.bot, 'import') as conn:
+                await rebuild.drop_shadow(conn, guild.id)
+            raise
+
+        async with get_conn(self.bot, 'import') as conn:
+            await rebuild.swap_shadow(conn, guild.id, partitioned, bot_config.REBUILD_SWAP_BATCH_SIZE)
+            self.bot.report_cache.bump(guild.id)
+            await conn.execute(
+                'UPDATE statbot_db.CHANNELS SET Importing = $1 '
+                'WHERE ChannelID = ANY($2::BIGINT[])',
+                False,
+                [c.id for c in import_channels]
+            )
+            for text_channel in import_channels:
+                self.bot.registry.set_channel(text_channel.id, guild.id, importing=False)
+
+        # The swap has committed, the purger drops the old rows without holding up this rebuild slot
+        self.purger.enqueue('retired', guild.id, guild.id, guild.name)
+
     @commands.command(hidden=True, name='regeneratedb')
     @commands.is_owner()
     async def regeneratedb(self, ctx: discord.ext.commands.Context, *args: str) -> None:
+        # Each guild is re-imported into a shadow table and swapped in at the end, its old data serving until then
+        guilds = [g for g in self.bot.guilds if self.bot.registry.server_status(g.id) != Status.NOT_ADDED]
+        skipped = len(self.bot.guilds) - len(guilds)
+        if skipped:
+            print('Skipping {} servers that aren\'t in the database'.format(skipped))
+
         async with get_conn(self.bot) as conn:
-            for guild in self.bot.guilds:
-                async with conn.transaction():
-                    print('Regenerating {}'.format(guild.name))
-                    rows = await conn.fetch(
-                        'SELECT ServerID FROM statbot_db.SERVERS '
-                        'WHERE ServerID = $1 FOR UPDATE',
-                        guild.id
-                    )
-                    if len(rows) != 1:
-                        print('Can\'t remove a server that\'s not in the database')
-                        continue
+            await rebuild.install_mirror(conn)
 
-                    await conn.execute(
-                        'DELETE FROM statbot_db.SERVERS '
-                        'WHERE ServerID = $1',
-                        guild.id
-                    )
-                    print('Removed {}, now re-adding'.format(guild.name))
-
-                    try:
-                        await conn.execute(
-                            'INSERT INTO statbot_db.SERVERS '
-                            'VALUES ($1, $2)',
-                            guild.id,
-                            True
-                        )
-                    except asyncpg.UniqueViolationError as e:
-                        print('This server already exists in the database')
-                        print(e)
-                        return
-
-                    # Now add all users in server
-                    await self._server_add_users(guild, conn)
+        slots = asyncio.Semaphore(bot_config.REBUILD_MAX_GUILDS)
 
-                    for text_channel in guild.text_channels:
-                        await conn.execute(
-                            'INSERT INTO statbot_db.CHANNELS VALUES ($1, $2)',
-                            text_channel.id,
-                            guild.id
-                        )
+        async def unit(guild: discord.Guild) -> None:
+            async with slots:
+                print('Regenerating {}'.format(guild.name))
+                await self._rebuild_guild(guild)
+                print('Regenerated {}'.format(guild.name))
 
-                        if text_channel.permissions_for(guild.me).read_message_history is False:
-                            print('Skipping restricted channel')
-                            continue
+        results = await asyncio.gather(*[unit(g) for g in guilds], return_exceptions=True)
 
-                        await self._add_messages(text_channel, conn)
+        async with get_conn(self.bot) as conn:
+            await rebuild.remove_mirror(conn)
 
-                    await conn.execute(
-                        'UPDATE statbot_db.SERVERS SET Importing = $1 '
-                        'WHERE ServerID = $2',
-                        False,
-                        guild.id
-                    )
-                    print('Server message transfer complete')
-                    print('{} server regeneration complete'.format(guild.name))
+        for guild, result in zip(guilds, results):
+            if isinstance(result, Exception):
+                self.log.error('FAILED TO REGENERATE SERVER: {}, its old data was kept'.format(guild.name))
+                self.log.error('{!r}: errno is {}'.format(result, result.args[0] if result.args else None))
 
-            print('Regeneration complete')
+        print('Regeneration complete')
 
 
 async def setup(bot: StatBot) -> None:
@@ -1,12 +1,15 @@
 import io
 import os
 import re
+import sys
 import time
+import traceback
 from functools import partial
 from typing import Optional, TypedDict, Union
 
 import PIL
 import aiofiles
+import asyncpg
 import discord
 import numpy as np
 import requests
@@ -18,8 +21,9 @@ from scipy.ndimage import gaussian_gradient_magnitude
 from wordcloud import STOPWORDS, ImageColorGenerator
 
 from cogs import constant
-from core import utility
+from core import queries, utility
 from core.statbot import StatBot
+from core.timerange import TimeRange, TimeRangeConverter
 from core.utility import get_conn, Status
 
 
@@ -29,6 +33,7 @@ class WcParams(TypedDict):
     target: Optional[discord.Member]
     mask: Optional[str]
     url: Optional[str]
+    window: TimeRange
 
 
 def _edge_find(mask_array: np.ndarray) -> np.ndarray:
@@ -42,7 +47,7 @@ def _edge_find(mask_array: np.ndarray) -> np.ndarray:
 
 # noinspection PyTypeChecker
 def _generate_cloud(
-        stopwords: set[str], word_string: str, collocations: bool, image_name: str = None, image_url: str = None
+        frequencies: dict[str, int], image_name: str = None, image_url: str = None
 ) -> Optional[io.BytesIO]:
     start_time = time.time()
 
@@ -118,30 +123,24 @@ def _generate_cloud(
 
         wordcloud = wc.WordCloud(
             color_func=colors,
-            stopwords=stopwords,
             margin=constant.WC_MARGIN,
             max_words=constant.WC_MAX_WORDS,
             max_font_size=constant.WC_MAX_FONT_SIZE,
             background_color=bg_color,
             mask=mask_array_copy,
-            collocations=collocations,
-            normalize_plurals=False,
             mode=constant.WC_COLOR_MODE,
             relative_scaling=0,
-        ).generate(word_string)
+        ).generate_from_frequencies(frequencies)
     else:
         wordcloud = wc.WordCloud(
             height=constant.WC_HEIGHT, width=constant.WC_WIDTH,
             color_func=wc.random_color_func,
-            stopwords=stopwords,
             margin=constant.WC_MARGIN,
             max_words=constant.WC_MAX_WORDS,
             max_font_size=constant.WC_MAX_FONT_SIZE,
             scale=scale,
             background_color=bg_color,
-            collocations=collocations,
-            normalize_plurals=False,
-        ).generate(word_string)
+        ).generate_from_frequencies(frequencies)
 
     output_buffer = io.BytesIO()
     wordcloud.to_image().save(output_buffer, constant.WC_FILE_FORMAT)
@@ -158,6 +157,16 @@ class UserCommands(commands.Cog):
     def __init__(self, bot: StatBot):
         self.bot = bot
 
+    async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError) -> None:
+        # A time range msgcount couldn't read
+        if isinstance(error, commands.BadArgument):
+            await ctx.send(str(error))
+            return
+
+        # With a cog error handler the bot's default one stays quiet, so print everything else like it would
+        print('Ignoring exception in command {}:'.format(ctx.command), file=sys.stderr)
+        traceback.print_exception(type(error), error, error.__traceback__)
+
     async def _handle_server_status_response(self, ctx: discord.ext.commands.Context, server_status: Status) -> None:
         if server_status != Status.AVAILABLE:
             if server_status == Status.IMPORTING:
@@ -198,10 +207,18 @@ class UserCommands(commands.Cog):
             'emojis_only': False,
             'target': None,
             'mask': None,
-            'url': None
+            'url': None,
+            'window': TimeRange()
         }
 
         for arg in args:
+            try:
+                if params['window'].update(arg):
+                    continue
+            except commands.BadArgument as e:
+                await ctx.send(str(e))
+                return None
+
             match = re.search(constant.REGEX['user_mention'], arg)
             url_match = re.search(constant.REGEX['urls'], arg)
             if arg.lower() == 'noemojis':
@@ -235,36 +252,33 @@ class UserCommands(commands.Cog):
 
         return stopwords
 
-    async def _pre_filter_wc_string(
-            self, ctx: commands.Context, msg_list: list[str], params: WcParams) -> Optional[str]:
-        # command filtering
-        async with aiofiles.open('wordcloud/prefixes.txt', 'r') as prefixes:
-            pref_str = '|'.join((await prefixes.read()).split('\n'))
+    async def _pre_filter_wc_frequencies(
+            self, ctx: commands.Context, word_counts: list[asyncpg.Record], params: WcParams
+    ) -> Optional[dict[str, int]]:
+        # Command invocations and links were already left out when the words were counted
+        stopwords = await self._get_stopwords()
 
-        reg_ex = '^(' + pref_str + ').*?( |$)'
-        string_list = list()
-        for row in msg_list:
-            if not re.search(reg_ex, row[0]):
-                string_list.append(row[0])
+        frequencies = dict()
+        for row in word_counts:
+            word = row['word']
+            is_emoji = word.startswith(':')
 
-        joined_msgs = ' '.join(string_list)
+            # emoji filtering
+            if (is_emoji and not params['emojis']) or (not is_emoji and params['emojis_only']):
+                continue
 
-        # emoji filtering
-        if not params['emojis']:
-            joined_msgs = re.sub(constant.REGEX['emojis'], '', joined_msgs)
+            word = word.strip(':')
+            # Same as what WordCloud.generate() used to drop from the raw text
+            if len(word) < 2 or word.isdigit() or word.lower() in stopwords:
+                continue
 
-        if params['emojis_only']:
-            match = re.findall(constant.REGEX['emoji_names'], joined_msgs)
-            if match:
-                joined_msgs = ' '.join(match)
-            else:
-                await ctx.send('No emojis found in your message history.')
-                return None
-        else:
-            # link filtering
-            joined_msgs = re.sub(constant.REGEX['urls'], '', joined_msgs)
+            frequencies[word] = frequencies.get(word, 0) + row['uses']
+
+        if params['emojis_only'] and not frequencies:
+            await ctx.send('No emojis found in your message history.')
+            return None
 
-        return joined_msgs
+        return frequencies
 
     async def _assign_args(
             self,
@@ -290,157 +304,157 @@ class UserCommands(commands.Cog):
 
     @commands.command(name='wordcloud')
     async def wordcloud(self, ctx: commands.Context, *args: str) -> None:
-        async with get_conn(self.bot) as conn:
-            async with conn.transaction():
-                server_status = await utility.server_status(conn, ctx.guild)
-                await self._handle_server_status_response(ctx, server_status)
-                if server_status != Status.AVAILABLE:
-                    return
+        server_status = utility.server_status(self.bot, ctx.guild)
+        await self._handle_server_status_response(ctx, server_status)
+        if server_status != Status.AVAILABLE:
+            return
 
-                params = await self._process_wordcloud_args(ctx, args)
-                if params is None:
-                    return
+        params = await self._process_wordcloud_args(ctx, args)
+        if params is None:
+            return
 
-                uploaded = None
-                if len(ctx.message.attachments) > 0:
-                    uploaded = ctx.message.attachments[0].url
-                elif params['url']:
-                    uploaded = params['url']
+        uploaded = None
+        if len(ctx.message.attachments) > 0:
+            uploaded = ctx.message.attachments[0].url
+        elif params['url']:
+            uploaded = params['url']
 
-                try:
-                    if ctx.author.nick:
-                        bot_response = await ctx.send('I\'ll ping you when it\'s ready {}!'.format(ctx.author.nick))
+        try:
+            if ctx.author.nick:
+                bot_response = await ctx.send('I\'ll ping you when it\'s ready {}!'.format(ctx.author.nick))
+            else:
+                bot_response = await ctx.send('I\'ll ping you when it\'s ready {}!'.format(ctx.author.name))
+
+            if not params['target']:
+                params['target'] = ctx.author
+
+            # Rendering is the slow part, the same cloud is reused until the guild's messages change
+            key = (
+                'wordcloud',
+                ctx.guild.id,
+                None,
+                params['target'].id,
+                (params['emojis'], params['emojis_only'], params['mask'], uploaded, params['window'].key)
+            )
+            found, image = self.bot.report_cache.get(key)
+            if found:
+                final_image = io.BytesIO(image)
+            else:
+                version = self.bot.report_cache.version(ctx.guild.id)
+
+                # The connection goes back before rendering, which can take a while in the process pool
+                async with get_conn(self.bot, 'analytics', ctx.command.qualified_name) as conn:
+                    if params['window']:
+                        word_counts = await queries.catalog.fetch(
+                            conn, queries.WINDOW_WORDCLOUD_COUNTS, ctx.guild.id, params['target'].id,
+                            *params['window'].bounds
+                        )
                     else:
-                        bot_response = await ctx.send('I\'ll ping you when it\'s ready {}!'.format(ctx.author.name))
-
-                    if not params['target']:
-                        params['target'] = ctx.author
+                        word_counts = await queries.catalog.fetch(
+                            conn, queries.WORDCLOUD_COUNTS, ctx.guild.id, params['target'].id
+                        )
 
-                    msg_list = await conn.fetch(
-                        'SELECT M.Content '
-                        'FROM statbot_db.SERVERS AS S, statbot_db.MESSAGES AS M '
-                        'WHERE S.ServerID = $1 AND M.AuthorID = $2 AND S.ServerID = M.ServerID',
-                        ctx.guild.id,
-                        params['target'].id
-                    )
+                frequencies = await self._pre_filter_wc_frequencies(ctx, word_counts, params)
+                if frequencies is None:
+                    return
 
-                    filtered_msgs = await self._pre_filter_wc_string(ctx, msg_list, params)
-                    if filtered_msgs is None:
-                        return
+                func = partial(
+                    _generate_cloud,
+                    frequencies,
+                    image_name=params['mask'] if not uploaded else None,
+                    image_url=uploaded
+                )
 
-                    collocations = False if params['emojis_only'] else constant.WC_COLLOCATIONS
+                try:
+                    final_image = await self.bot.loop.run_in_executor(self.bot.process_executor, func)
+                except ValueError as e:
+                    print('ValueError: {}'.format(e))
+                    await ctx.send(
+                        'This user does not have enough interesting words to generate a wordcloud. Sorry!',
+                        delete_after=5
+                    )
+                    return
+                except PIL.UnidentifiedImageError as e:
+                    print('PIL.UnidentifiedImageError: {}'.format(e))
+                    await ctx.send('Invalid image file type.', delete_after=5)
+                    return
 
-                    stopwords = await self._get_stopwords()
+                self.bot.report_cache.put(key, final_image.getvalue(), version)
 
-                    func = partial(
-                        _generate_cloud,
-                        stopwords,
-                        filtered_msgs,
-                        image_name=params['mask'] if not uploaded else None,
-                        collocations=collocations,
-                        image_url=uploaded
-                    )
+            file = discord.File(filename='wordcloud.png', fp=final_image)
 
-                    try:
-                        final_image = await self.bot.loop.run_in_executor(self.bot.process_executor, func)
-                    except ValueError as e:
-                        print('ValueError: {}'.format(e))
-                        await ctx.send(
-                            'This user does not have enough interesting words to generate a wordcloud. Sorry!',
-                            delete_after=5
-                        )
-                        return
-                    except PIL.UnidentifiedImageError as e:
-                        print('PIL.UnidentifiedImageError: {}'.format(e))
-                        await ctx.send('Invalid image file type.', delete_after=5)
-                        return
-
-                    file = discord.File(filename='wordcloud.png', fp=final_image)
-
-                    if params['target'] == ctx.author:
-                        await ctx.send('Here you go {} ^_^'.format(ctx.author.mention), file=file)
-                    elif params['target'].nick:
-                        await ctx.send(
-                            'Here is {}\'s word cloud, {} ^_^'.format(params['target'].nick, ctx.author.mention),
-                            file=file
-                        )
-                    else:
-                        await ctx.send(
-                            'Here is {}\'s word cloud, {} ^_^'.format(params['target'].name, ctx.author.mention),
-                            file=file
-                        )
-                finally:
-                    await bot_response.delete()
+            if params['target'] == ctx.author:
+                await ctx.send('Here you go {} ^_^'.format(ctx.author.mention), file=file)
+            elif params['target'].nick:
+                await ctx.send(
+                    'Here is {}\'s word cloud, {} ^_^'.format(params['target'].nick, ctx.author.mention),
+                    file=file
+                )
+            else:
+                await ctx.send(
+                    'Here is {}\'s word cloud, {} ^_^'.format(params['target'].name, ctx.author.mention),
+                    file=file
+                )
+        finally:
+            await bot_response.delete()
 
     @commands.command(name='msgcount')
     async def msgcount(
             self,
             ctx: commands.Context,
             arg1: Optional[Union[discord.Member, discord.TextChannel]],
-            arg2: Optional[Union[discord.Member, discord.TextChannel]]
+            arg2: Optional[Union[discord.Member, discord.TextChannel]],
+            *,
+            window: TimeRangeConverter = TimeRange()
     ) -> None:
-        async with get_conn(self.bot) as conn:
-            async with conn.transaction():
-                server_status = await utility.server_status(conn, ctx.guild)
-                await self._handle_server_status_response(ctx, server_status)
-                if server_status != Status.AVAILABLE:
-                    return
+        server_status = utility.server_status(self.bot, ctx.guild)
+        await self._handle_server_status_response(ctx, server_status)
+        if server_status != Status.AVAILABLE:
+            return
 
-                (target, channel) = await self._assign_args(ctx, arg1, arg2)
-                if target is None:
-                    return
+        (target, channel) = await self._assign_args(ctx, arg1, arg2)
+        if target is None:
+            return
 
-                # No channel was specified by the user
-                if not channel:
-                    msg_count = await conn.fetchrow(
-                        'SELECT COUNT(*) '
-                        'FROM statbot_db.SERVERS AS S, statbot_db.MESSAGES AS M '
-                        'WHERE S.ServerID = $1 AND M.AuthorID = $2 AND S.ServerID = M.ServerID',
-                        ctx.guild.id,
-                        target.id
-                    )
+        if channel:
+            channel_status = utility.channel_status(self.bot, channel)
+            await self._handle_channel_status_response(ctx, channel_status)
+            if channel_status != Status.AVAILABLE:
+                return
 
-                    total = await conn.fetchrow(
-                        'SELECT COUNT(*) '
-                        'FROM statbot_db.SERVERS AS S, statbot_db.MESSAGES AS M '
-                        'WHERE S.ServerID = M.ServerID AND S.ServerID = $1',
-                        ctx.guild.id
+        async with get_conn(self.bot, 'analytics', ctx.command.qualified_name) as conn:
+            # MESSAGE_COUNTS only has running totals, a time range counts the messages themselves over the Sent index
+            if window:
+                if not channel:
+                    counts = await queries.catalog.fetchrow(
+                        conn, queries.WINDOW_MSGCOUNT_SERVER, ctx.guild.id, target.id, *window.bounds
                     )
                 else:
-                    channel_status = await utility.channel_status(conn, ctx.channel)
-                    await self._handle_channel_status_response(ctx, channel_status)
-                    if channel_status != Status.AVAILABLE:
-                        return
-
-                    msg_count = await conn.fetchrow(
-                        'SELECT COUNT(*) '
-                        'FROM statbot_db.CHANNELS C, statbot_db.MESSAGES AS M '
-                        'WHERE C.ChannelID = $1 AND C.ChannelID = M.ChannelID '
-                        'AND M.AuthorID = $2',
-                        channel.id,
-                        target.id
-                    )
-
-                    total = await conn.fetchrow(
-                        'SELECT COUNT(*) '
-                        'FROM statbot_db.MESSAGES '
-                        'WHERE ChannelID = $1',
-                        channel.id
+                    counts = await queries.catalog.fetchrow(
+                        conn, queries.WINDOW_MSGCOUNT_CHANNEL, ctx.guild.id, channel.id, target.id, *window.bounds
                     )
+            # No channel was specified by the user
+            elif not channel:
+                counts = await queries.catalog.fetchrow(conn, queries.MSGCOUNT_SERVER, ctx.guild.id, target.id)
+            else:
+                counts = await queries.catalog.fetchrow(
+                    conn, queries.MSGCOUNT_CHANNEL, ctx.guild.id, channel.id, target.id
+                )
 
-        percent = round((msg_count['count'] / total['count']) * 100, 2)
+        percent = round((counts['count'] / counts['total']) * 100, 2) if counts['total'] else 0.0
+        when = ' ' + window.describe() if window else ''
 
         if not channel:
             await ctx.send(
-                '**{}** has contributed **{}** messages out of the total **{}** messages sent in the **{}** server. '
+                '**{}** has contributed **{}** messages out of the total **{}** messages sent in the **{}** server{}. '
                 'That\'s **{}%**! Woah!'
-                ''.format(target.name, msg_count['count'], total['count'], ctx.guild.name, percent)
+                ''.format(target.name, counts['count'], counts['total'], ctx.guild.name, when, percent)
             )
         else:
             await ctx.send(
-                '**{}** has contributed **{}** messages out of the total **{}** messages sent in the **{}** channel. '
+                '**{}** has contributed **{}** messages out of the total **{}** messages sent in the **{}** channel{}. '
                 'That\'s **{}%**! Woah!'
-                ''.format(target.name, msg_count['count'], total['count'], channel.name, percent)
+                ''.format(target.name, counts['count'], counts['total'], channel.name, when, percent)
             )
 
 
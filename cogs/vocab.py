@@ -1,9 +1,11 @@
+import asyncio
 import inspect
 import re
-import string
+import sys
 import textwrap
+import traceback
 from functools import partial
-from typing import Optional, Union
+from typing import Any, Callable, Optional, Union
 
 import asyncpg
 import discord
@@ -17,9 +19,11 @@ from nltk import WordNetLemmatizer
 from num2words import num2words
 
 from cogs import constant
-from core import utility
+from core import bot_config, fulltext, queries, utility
+from core.pools import RequestScope
 from core.statbot import StatBot
-from core.utility import get_conn, Status
+from core.timerange import TimeRange, TimeRangeConverter
+from core.utility import Status
 
 
 # noinspection PyMethodMayBeStatic
@@ -85,16 +89,20 @@ class Vocab(commands.Cog):
     async def cog_load(self) -> None:
         await self.bot.loop.run_in_executor(None, self.vocab_data_init)
 
-    def _clean_content(self, msg_str: str) -> str:
-        lower_case = msg_str.lower()
-        remove_urls = constant.REGEX['urls'].sub('', lower_case)
-        remove_user = constant.REGEX['user_mention'].sub('', remove_urls)
-        remove_channel = constant.REGEX['channel_mention'].sub('', remove_user)
-        remove_emojis = constant.REGEX['emoji_names'].sub('', remove_channel)
-
-        remove_punctuation = remove_emojis.translate(str.maketrans('', '', string.punctuation))
+    async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError) -> None:
+        if isinstance(error, commands.CommandInvokeError) and isinstance(error.original, utility.ResultTooLarge):
+            await ctx.send('There are too many messages to put this report together, try it for a single channel.')
+            return
+        if isinstance(error, commands.CommandInvokeError) and isinstance(error.original, asyncio.TimeoutError):
+            await ctx.send('I\'m busy with other reports right now, try again in a bit.')
+            return
+        if isinstance(error, commands.BadArgument):
+            await ctx.send(str(error))
+            return
 
-        return remove_punctuation
+        # With a cog error handler the bot's default one stays quiet, so print everything else like it would
+        print('Ignoring exception in command {}:'.format(ctx.command), file=sys.stderr)
+        traceback.print_exception(type(error), error, error.__traceback__)
 
     def _unique_words(self, msg_list: list) -> str:
         msg_set = set(msg_list)
@@ -134,113 +142,117 @@ class Vocab(commands.Cog):
 
             return remove_emojis
 
-    async def _get_agg_msgs(
+    async def _fetch_word_counts(
             self,
-            conn: asyncpg.Connection,
+            scope: RequestScope,
             guild_id: int,
             user_id: Optional[int] = None,
-            channel_id: Optional[int] = None
+            channel_id: Optional[int] = None,
+            window: TimeRange = TimeRange()
     ) -> pd.DataFrame:
+        conn = await scope.connection()
+
+        if window:
+            return await self._fetch_window_word_counts(conn, guild_id, user_id, channel_id, window)
+
+        # ts_stat sums over everything its query returns, so it can only stand in for a single author
+        if user_id and bot_config.WORD_STATS_BACKEND == 'tsvector' and await fulltext.is_enabled(conn):
+            rows = await fulltext.word_frequencies(conn, guild_id, author_id=user_id, channel_id=channel_id)
+            df = pd.DataFrame(columns=['word', 'counts'], data=rows)
+            df.insert(0, 'authorid', user_id)
+            return df
+
+        # Counted at ingestion time, so only a word list per author comes over instead of their whole history.
+        # :name: tokens are custom emojis, which only wordclouds use. Results for everyone are big enough to be worth
+        # the COPY path
         if channel_id:
             if user_id:
                 df = await utility.fetch_as_dataframe(
                     conn,
-                    "SELECT M.authorid, STRING_AGG(M.content, ' ') as msgs "
-                    "FROM statbot_db.MESSAGES as M "
-                    "WHERE M.serverid = $1 AND M.channelid = $2 AND M.authorid = $3 "
-                    "GROUP BY M.authorid",
+                    queries.WORD_COUNTS_CHANNEL_MEMBER,
                     guild_id,
                     channel_id,
                     user_id
                 )
             else:
-                df = await utility.fetch_as_dataframe(
-                    conn,
-                    "SELECT M.authorid, STRING_AGG(M.content, ' ') as msgs "
-                    "FROM statbot_db.MESSAGES as M "
-                    "WHERE M.serverid = $1 AND M.channelid = $2 "
-                    "GROUP BY M.authorid",
-                    guild_id,
-                    channel_id
-                )
+                df = await utility.copy_as_dataframe(conn, queries.WORD_COUNTS_CHANNEL, guild_id, channel_id)
         else:
+            if user_id:
+                df = await utility.fetch_as_dataframe(conn, queries.WORD_COUNTS_MEMBER, guild_id, user_id)
+            else:
+                df = await utility.copy_as_dataframe(conn, queries.WORD_COUNTS_SERVER, guild_id)
+
+        return df
+
+    async def _fetch_window_word_counts(
+            self,
+            conn: asyncpg.Connection,
+            guild_id: int,
+            user_id: Optional[int],
+            channel_id: Optional[int],
+            window: TimeRange
+    ) -> pd.DataFrame:
+        # The counting tables have no time dimension, so the words are split out of the messages sent in the window.
+        # The range on Sent keeps it to the matching stretch of idx_MESSAGES_ServerID_Sent
+        since, until = window.bounds
+        if channel_id:
             if user_id:
                 df = await utility.fetch_as_dataframe(
                     conn,
-                    "SELECT M.authorid, STRING_AGG(M.content, ' ') as msgs "
-                    "FROM statbot_db.MESSAGES as M "
-                    "WHERE M.serverid = $1 AND M.authorid = $2 "
-                    "GROUP BY M.authorid",
+                    queries.WINDOW_WORD_COUNTS_CHANNEL_MEMBER,
                     guild_id,
-                    user_id
+                    channel_id,
+                    user_id,
+                    since,
+                    until
                 )
             else:
+                df = await utility.copy_as_dataframe(
+                    conn, queries.WINDOW_WORD_COUNTS_CHANNEL, guild_id, channel_id, since, until
+                )
+        else:
+            if user_id:
                 df = await utility.fetch_as_dataframe(
-                    conn,
-                    "SELECT M.authorid, STRING_AGG(M.content, ' ') as msgs "
-                    "FROM statbot_db.MESSAGES as M "
-                    "WHERE M.serverid = $1 "
-                    "GROUP BY M.authorid",
-                    guild_id
+                    conn, queries.WINDOW_WORD_COUNTS_MEMBER, guild_id, user_id, since, until
                 )
-
-        df.msgs.replace(to_replace=[r'^\s+$', ''], value=np.nan, regex=True, inplace=True)
-        df.dropna(inplace=True)
-        df.reset_index(drop=True, inplace=True)
+            else:
+                df = await utility.copy_as_dataframe(conn, queries.WINDOW_WORD_COUNTS_SERVER, guild_id, since, until)
 
         return df
 
-    async def _get_agg_msgs_grade(
+    async def _fetch_agg_msgs_grade(
             self,
-            conn: asyncpg.Connection,
+            scope: RequestScope,
             guild_id: int,
+            grade_window: TimeRange,
             user_id: Optional[int] = None,
             channel_id: Optional[int] = None
     ) -> pd.DataFrame:
+        conn = await scope.connection()
+
+        since, until = grade_window.bounds
         if channel_id:
             if user_id:
                 df_grade = await utility.fetch_as_dataframe(
                     conn,
-                    "SELECT M.authorid, M.content as msgs, M.sent "
-                    "FROM statbot_db.MESSAGES as M "
-                    "WHERE M.serverid = $1 AND M.authorid = $2 AND M.channelid = $3 "
-                    "AND M.sent BETWEEN NOW() - INTERVAL '1 MONTH' AND NOW() "
-                    "ORDER BY M.sent",
+                    queries.GRADE_MSGS_CHANNEL_MEMBER,
                     guild_id,
                     user_id,
-                    channel_id
+                    channel_id,
+                    since,
+                    until
                 )
             else:
-                df_grade = await utility.fetch_as_dataframe(
-                    conn,
-                    "SELECT M.authorid, M.content as msgs, M.sent "
-                    "FROM statbot_db.MESSAGES as M "
-                    "WHERE M.serverid = $1 AND M.channelid = $2 "
-                    "AND M.sent BETWEEN NOW() - INTERVAL '1 MONTH' AND NOW() "
-                    "ORDER BY M.sent",
-                    guild_id,
-                    channel_id
+                df_grade = await utility.copy_as_dataframe(
+                    conn, queries.GRADE_MSGS_CHANNEL, guild_id, channel_id, since, until
                 )
         else:
             if user_id:
                 df_grade = await utility.fetch_as_dataframe(
-                    conn,
-                    "SELECT M.authorid, M.content as msgs, M.sent "
-                    "FROM statbot_db.MESSAGES as M "
-                    "WHERE M.serverid = $1 AND M.authorid = $2 AND M.sent BETWEEN NOW() - INTERVAL '1 MONTH' AND NOW() "
-                    "ORDER BY M.sent",
-                    guild_id,
-                    user_id,
+                    conn, queries.GRADE_MSGS_MEMBER, guild_id, user_id, since, until
                 )
             else:
-                df_grade = await utility.fetch_as_dataframe(
-                    conn,
-                    "SELECT M.authorid, M.content as msgs, M.sent "
-                    "FROM statbot_db.MESSAGES as M "
-                    "WHERE M.serverid = $1 AND M.sent BETWEEN NOW() - INTERVAL '1 MONTH' AND NOW() "
-                    "ORDER BY M.sent",
-                    guild_id
-                )
+                df_grade = await utility.copy_as_dataframe(conn, queries.GRADE_MSGS_SERVER, guild_id, since, until)
 
         df_grade.msgs.replace(to_replace=[r'^\s+$', ''], value=np.nan, regex=True, inplace=True)
         df_grade.dropna(inplace=True)
@@ -248,6 +260,69 @@ class Vocab(commands.Cog):
 
         return df_grade
 
+    async def _get_word_counts(
+            self,
+            scope: RequestScope,
+            guild_id: int,
+            user_id: Optional[int] = None,
+            channel_id: Optional[int] = None,
+            window: TimeRange = TimeRange()
+    ) -> pd.DataFrame:
+        return await self.bot.report_cache.get_or_compute(
+            ('word_counts', guild_id, channel_id, user_id, (bot_config.WORD_STATS_BACKEND, window.key)),
+            partial(self._fetch_word_counts, scope, guild_id, user_id=user_id, channel_id=channel_id, window=window)
+        )
+
+    async def _get_agg_msgs_grade(
+            self,
+            scope: RequestScope,
+            guild_id: int,
+            grade_window: TimeRange,
+            user_id: Optional[int] = None,
+            channel_id: Optional[int] = None
+    ) -> pd.DataFrame:
+        return await self.bot.report_cache.get_or_compute(
+            ('grade_msgs', guild_id, channel_id, user_id, grade_window.key),
+            partial(self._fetch_agg_msgs_grade, scope, guild_id, grade_window, user_id=user_id, channel_id=channel_id)
+        )
+
+    def _grade_window(self, window: TimeRange) -> TimeRange:
+        # Grading reads whole messages, so without a time range it sticks to the last GRADE_WINDOW_DAYS
+        return window if window else TimeRange.last_days(bot_config.GRADE_WINDOW_DAYS)
+
+    def _report_key(
+            self,
+            command: str,
+            ctx: commands.Context,
+            channel_target: Optional[discord.TextChannel],
+            user_target: Optional[discord.Member] = None,
+            params: Any = None,
+            window: TimeRange = TimeRange()
+    ) -> tuple:
+        return (
+            command,
+            ctx.guild.id,
+            channel_target.id if channel_target else None,
+            user_target.id if user_target else None,
+            params,
+            window.key
+        )
+
+    def _target_name(
+            self, ctx: commands.Context, channel_target: Optional[discord.TextChannel], window: TimeRange
+    ) -> str:
+        target_name = '#' + channel_target.name if channel_target else '**' + ctx.guild.name + '**'
+        if window:
+            target_name += ' ' + window.describe()
+        return target_name
+
+    async def _compute(self, key: tuple, func: Callable, *args: Any, **kwargs: Any) -> Any:
+        # Cached results are shared between invocations, so nothing downstream may modify them in place
+        async def run() -> Any:
+            return await self.bot.loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+        return await self.bot.report_cache.get_or_compute(key, run)
+
     def _summary(
             self, data: pd.DataFrame, grade_data: pd.DataFrame, server: bool = False
     ) -> list[pd.DataFrame, pd.DataFrame, Optional[pd.DataFrame], float]:
@@ -257,13 +332,13 @@ class Vocab(commands.Cog):
 
         ret.append(vocab_ranking.loc[:, ['authorid', 'unique_counts']])
 
-        vocab_unique = self._unique(vocab_ranking)
+        vocab_unique = self._unique(data)
 
         ret.append(vocab_unique.loc[:, ['authorid', 'word', 'counts', 'interesting_metric']])
 
         # Most interesting urban dictionary ones
         if server:
-            int_df = self._interesting(vocab_ranking)
+            int_df = self._interesting(data)
 
             ret.append(int_df.loc[:, ['word', 'engagement', 'counts', 'interesting_metric']])
         else:
@@ -292,6 +367,21 @@ class Vocab(commands.Cog):
                 await ctx.send(constant.RESPONSES['channel_not_added'])
             return
 
+    async def _check_status(self, ctx: commands.Context, channel_target: Optional[discord.TextChannel]) -> bool:
+        # The registry is in memory, so turning a command away doesn't need a connection
+        server_status = utility.server_status(self.bot, ctx.guild)
+        await self._handle_server_status_response(ctx, server_status)
+        if server_status != Status.AVAILABLE:
+            return False
+
+        if channel_target:
+            channel_status = utility.channel_status(self.bot, channel_target)
+            await self._handle_channel_status_response(ctx, channel_status)
+            if channel_status != Status.AVAILABLE:
+                return False
+
+        return True
+
     async def _add_ranking_field(
             self,
             summary: discord.Embed,
@@ -424,8 +514,8 @@ class Vocab(commands.Cog):
 
         return user_target, channel_target
 
-    def _word_freq_from_series(self, msgs: pd.Series) -> pd.DataFrame:
-        word_freq = msgs.str.split().explode().value_counts().rename_axis(['word']).reset_index(name='counts')
+    def _word_freq(self, data: pd.DataFrame) -> pd.DataFrame:
+        word_freq = data.loc[:, ['word', 'counts']].copy()
         word_freq.word = word_freq.word.apply(lambda x: self.wnl.lemmatize(x) if x in self.nltk_words else x)
         word_freq = word_freq.groupby('word', as_index=False).agg({'counts': 'sum'})
 
@@ -436,40 +526,37 @@ class Vocab(commands.Cog):
             self,
             ctx: commands.Context,
             arg1: Optional[Union[discord.Member, discord.TextChannel]],
-            arg2: Optional[Union[discord.Member, discord.TextChannel]]
+            arg2: Optional[Union[discord.Member, discord.TextChannel]],
+            *,
+            window: TimeRangeConverter = TimeRange()
     ) -> None:
         await self._check_vocab_args(arg1, arg2)
 
         (user_target, channel_target) = await self._assign_args(ctx, arg1, arg2)
 
-        async with get_conn(self.bot) as conn:
-            async with conn.transaction():
-                server_status = await utility.server_status(conn, ctx.guild)
-                await self._handle_server_status_response(ctx, server_status)
-                if server_status != Status.AVAILABLE:
-                    return
-
-                if channel_target:
-                    channel_status = await utility.channel_status(conn, ctx.channel)
-                    await self._handle_channel_status_response(ctx, channel_status)
-                    if channel_status != Status.AVAILABLE:
-                        return
-
-                    df = await self._get_agg_msgs(conn, ctx.guild.id, channel_id=channel_target.id)
-                    df_grade = await self._get_agg_msgs_grade(
-                        conn, ctx.guild.id, user_id=user_target.id, channel_id=channel_target.id
-                    )
-                else:
-                    df = await self._get_agg_msgs(conn, ctx.guild.id)
-                    df_grade = await self._get_agg_msgs_grade(conn, ctx.guild.id, user_id=user_target.id)
+        if not await self._check_status(ctx, channel_target):
+            return
+
+        channel_id = channel_target.id if channel_target else None
+        grade_window = self._grade_window(window)
+        async with utility.request_scope(self.bot, ctx) as scope:
+            df = await self._get_word_counts(scope, ctx.guild.id, channel_id=channel_id, window=window)
+            df_grade = await self._get_agg_msgs_grade(
+                scope, ctx.guild.id, grade_window, user_id=user_target.id, channel_id=channel_id
+            )
 
         if user_target.id not in df.authorid.to_list() or user_target.id not in df_grade.authorid.to_list():
-            target_name = '#' + channel_target.name if channel_target else '**' + ctx.guild.name + '**'
+            target_name = self._target_name(ctx, channel_target, window)
             await ctx.send('It looks like you don\'t have any messages sent in {}.'.format(target_name))
             return
 
         [ranking_result, unique_result, _, grade] \
-            = await self.bot.loop.run_in_executor(None, partial(self._summary, df, df_grade))
+            = await self._compute(
+                self._report_key('summary', ctx, channel_target, user_target, grade_window.key, window),
+                self._summary,
+                df,
+                df_grade
+            )
 
         if (user_target.id not in ranking_result.authorid.to_list()
                 or user_target.id not in unique_result.authorid.to_list()):
@@ -479,25 +566,23 @@ class Vocab(commands.Cog):
         title = user_target.name + '\'s Vocab Report'
         if channel_target:
             title += ' (#{})'.format(channel_target.name)
+        if window:
+            title += ' ({})'.format(window.describe())
         summary = discord.Embed(colour=discord.Colour(0xff6600), title=title)
 
         await self._add_ranking_field(summary, ranking_result, channel_target, user_target)
 
         await self._add_unique_field(summary, unique_result, user_target)
 
-        await self._add_grade_field(summary, grade)
+        await self._add_grade_field(summary, grade, grade_window)
 
         await ctx.send(embed=summary)
 
     def _unique_words_col(self, data: pd.DataFrame) -> pd.DataFrame:
-        vocab_ranking = data.copy()
-
-        vocab_ranking.msgs = vocab_ranking.msgs.apply(self._clean_content)
-        vocab_ranking.msgs.replace(to_replace=[r'^\s+$', ''], value=np.nan, regex=True, inplace=True)
-        vocab_ranking.dropna(inplace=True)
-        vocab_ranking.reset_index(drop=True, inplace=True)
+        vocab_ranking = data.groupby('authorid', as_index=False).agg({'word': list})
+        vocab_ranking.rename(columns={'word': 'words'}, inplace=True)
 
-        vocab_ranking['unique_words'] = vocab_ranking.msgs.str.split().apply(self._unique_words)
+        vocab_ranking['unique_words'] = vocab_ranking.words.apply(self._unique_words)
 
         vocab_ranking['less_common_words'] = vocab_ranking.unique_words.str.split().apply(self._filter_common_words)
         vocab_ranking.less_common_words.replace(to_replace=[r'^\s+$', ''], value=np.nan, regex=True, inplace=True)
@@ -520,35 +605,29 @@ class Vocab(commands.Cog):
             self,
             ctx: commands.Context,
             arg1: Optional[Union[discord.Member, discord.TextChannel]],
-            arg2: Optional[Union[discord.Member, discord.TextChannel]]
+            arg2: Optional[Union[discord.Member, discord.TextChannel]],
+            *,
+            window: TimeRangeConverter = TimeRange()
     ) -> None:
         await self._check_vocab_args(arg1, arg2)
 
         (user_target, channel_target) = await self._assign_args(ctx, arg1, arg2)
 
-        async with get_conn(self.bot) as conn:
-            async with conn.transaction():
-                server_status = await utility.server_status(conn, ctx.guild)
-                await self._handle_server_status_response(ctx, server_status)
-                if server_status != Status.AVAILABLE:
-                    return
-
-                if channel_target:
-                    channel_status = await utility.channel_status(conn, ctx.channel)
-                    await self._handle_channel_status_response(ctx, channel_status)
-                    if channel_status != Status.AVAILABLE:
-                        return
+        if not await self._check_status(ctx, channel_target):
+            return
 
-                    df = await self._get_agg_msgs(conn, ctx.guild.id, channel_id=channel_target.id)
-                else:
-                    df = await self._get_agg_msgs(conn, ctx.guild.id)
+        channel_id = channel_target.id if channel_target else None
+        async with utility.request_scope(self.bot, ctx) as scope:
+            df = await self._get_word_counts(scope, ctx.guild.id, channel_id=channel_id, window=window)
 
         if user_target.id not in df.authorid.to_list():
-            target_name = '#' + channel_target.name if channel_target else '**' + ctx.guild.name + '**'
+            target_name = self._target_name(ctx, channel_target, window)
             await ctx.send('It looks like you don\'t have any messages sent in {}.'.format(target_name))
             return
 
-        ranking_result = await self.bot.loop.run_in_executor(None, partial(self._ranking, df))
+        ranking_result = await self._compute(
+            self._report_key('ranking', ctx, channel_target, window=window), self._ranking, df
+        )
         ranking_result = ranking_result.loc[:, ['authorid', 'unique_counts']]
 
         if user_target.id not in ranking_result.authorid.to_list():
@@ -558,6 +637,8 @@ class Vocab(commands.Cog):
         title = user_target.name + '\'s Ranking Report'
         if channel_target:
             title += ' (#{})'.format(channel_target.name)
+        if window:
+            title += ' ({})'.format(window.describe())
         summary = discord.Embed(colour=discord.Colour(0xff6600), title=title)
 
         await self._add_ranking_field(summary, ranking_result, channel_target, user_target)
@@ -573,13 +654,13 @@ class Vocab(commands.Cog):
         vocab_ranking.dropna(inplace=True)
         vocab_ranking.reset_index(drop=True, inplace=True)
 
-        vocab_unique = vocab_ranking.copy().drop(columns=['msgs'])
+        vocab_unique = vocab_ranking.copy().drop(columns=['words'])
 
         vocab_unique = vocab_unique.assign(word=vocab_unique.unique_to_user.str.split()).explode('word')
         vocab_unique = pd.merge(vocab_unique, self.ud_df, on=['word'])
         vocab_unique.drop(columns=['less_common_words', 'unique_to_user'], inplace=True)
 
-        word_freq = self._word_freq_from_series(vocab_ranking.loc[:, 'msgs'])
+        word_freq = self._word_freq(data.loc[data.authorid.isin(vocab_ranking.authorid)])
 
         vocab_unique = pd.merge(vocab_unique, word_freq, how='left', on=['word'])
 
@@ -592,35 +673,29 @@ class Vocab(commands.Cog):
             self,
             ctx: commands.Context,
             arg1: Optional[Union[discord.Member, discord.TextChannel]],
-            arg2: Optional[Union[discord.Member, discord.TextChannel]]
+            arg2: Optional[Union[discord.Member, discord.TextChannel]],
+            *,
+            window: TimeRangeConverter = TimeRange()
     ) -> None:
         await self._check_vocab_args(arg1, arg2)
 
         (user_target, channel_target) = await self._assign_args(ctx, arg1, arg2)
 
-        async with get_conn(self.bot) as conn:
-            async with conn.transaction():
-                server_status = await utility.server_status(conn, ctx.guild)
-                await self._handle_server_status_response(ctx, server_status)
-                if server_status != Status.AVAILABLE:
-                    return
-
-                if channel_target:
-                    channel_status = await utility.channel_status(conn, ctx.channel)
-                    await self._handle_channel_status_response(ctx, channel_status)
-                    if channel_status != Status.AVAILABLE:
-                        return
+        if not await self._check_status(ctx, channel_target):
+            return
 
-                    df = await self._get_agg_msgs(conn, ctx.guild.id, channel_id=channel_target.id)
-                else:
-                    df = await self._get_agg_msgs(conn, ctx.guild.id)
+        channel_id = channel_target.id if channel_target else None
+        async with utility.request_scope(self.bot, ctx) as scope:
+            df = await self._get_word_counts(scope, ctx.guild.id, channel_id=channel_id, window=window)
 
         if user_target.id not in df.authorid.to_list():
-            target_name = '#' + channel_target.name if channel_target else '**' + ctx.guild.name + '**'
+            target_name = self._target_name(ctx, channel_target, window)
             await ctx.send('It looks like you don\'t have any messages sent in {}.'.format(target_name))
             return
 
-        unique_result = await self.bot.loop.run_in_executor(None, partial(self._unique, df))
+        unique_result = await self._compute(
+            self._report_key('unique', ctx, channel_target, window=window), self._unique, df
+        )
         unique_result = unique_result.loc[:, ['authorid', 'word', 'counts', 'interesting_metric']]
 
         if user_target.id not in unique_result.authorid.to_list():
@@ -630,6 +705,8 @@ class Vocab(commands.Cog):
         title = user_target.name + '\'s Unique Words Report'
         if channel_target:
             title += ' (#{})'.format(channel_target.name)
+        if window:
+            title += ' ({})'.format(window.describe())
         summary = discord.Embed(colour=discord.Colour(0xff6600), title=title)
 
         await self._add_unique_field(summary, unique_result, user_target)
@@ -654,7 +731,7 @@ class Vocab(commands.Cog):
 
         server_words_df = pd.DataFrame(columns=['word'],
                                        data=set(vocab_ranking.less_common_words.str.split().explode()))
-        word_freq = self._word_freq_from_series(vocab_ranking.loc[:, 'msgs'])
+        word_freq = self._word_freq(data.loc[data.authorid.isin(vocab_ranking.authorid)])
         int_df = pd.merge(server_words_df, word_freq, on='word')
         int_df = pd.merge(int_df, self.ud_df, on='word')
 
@@ -695,35 +772,31 @@ class Vocab(commands.Cog):
             self,
             ctx: commands.Context,
             arg1: Optional[Union[discord.Member, discord.TextChannel]],
-            arg2: Optional[Union[discord.Member, discord.TextChannel]]
+            arg2: Optional[Union[discord.Member, discord.TextChannel]],
+            *,
+            window: TimeRangeConverter = TimeRange()
     ) -> None:
         await self._check_vocab_args(arg1, arg2)
 
         (user_target, channel_target) = await self._assign_args(ctx, arg1, arg2)
 
-        async with get_conn(self.bot) as conn:
-            async with conn.transaction():
-                server_status = await utility.server_status(conn, ctx.guild)
-                await self._handle_server_status_response(ctx, server_status)
-                if server_status != Status.AVAILABLE:
-                    return
-
-                if channel_target:
-                    channel_status = await utility.channel_status(conn, ctx.channel)
-                    await self._handle_channel_status_response(ctx, channel_status)
-                    if channel_status != Status.AVAILABLE:
-                        return
+        if not await self._check_status(ctx, channel_target):
+            return
 
-                    df = await self._get_agg_msgs(conn, ctx.guild.id, channel_id=channel_target.id, user_id=user_target.id)
-                else:
-                    df = await self._get_agg_msgs(conn, ctx.guild.id, user_id=user_target.id)
+        channel_id = channel_target.id if channel_target else None
+        async with utility.request_scope(self.bot, ctx) as scope:
+            df = await self._get_word_counts(
+                scope, ctx.guild.id, user_id=user_target.id, channel_id=channel_id, window=window
+            )
 
         if len(df.index) == 0:
-            target_name = '#' + channel_target.name if channel_target else '**' + ctx.guild.name + '**'
+            target_name = self._target_name(ctx, channel_target, window)
             await ctx.send('It looks like you don\'t have any messages sent in {}.'.format(target_name))
             return
 
-        interesting_result = await self.bot.loop.run_in_executor(None, partial(self._interesting, df))
+        interesting_result = await self._compute(
+            self._report_key('interesting', ctx, channel_target, user_target, window=window), self._interesting, df
+        )
         interesting_result = interesting_result.loc[:, ['word', 'engagement', 'counts', 'interesting_metric']]
 
         if len(interesting_result.index) == 0:
@@ -733,6 +806,8 @@ class Vocab(commands.Cog):
         title = user_target.name + '\'s Interesting Words Report'
         if channel_target:
             title += ' (#{})'.format(channel_target.name)
+        if window:
+            title += ' ({})'.format(window.describe())
         summary = discord.Embed(colour=discord.Colour(0xff6600), title=title)
 
         await self._add_interesting_field(summary, interesting_result, user_target)
@@ -751,7 +826,9 @@ class Vocab(commands.Cog):
 
         return server_grade_level
 
-    async def _add_grade_field(self, summary: discord.Embed, grade: float, server: bool = False) -> None:
+    async def _add_grade_field(
+            self, summary: discord.Embed, grade: float, grade_window: TimeRange, server: bool = False
+    ) -> None:
         grade_ordinal_num = num2words(int(grade), to='ordinal_num')
         grade_ordinal = num2words(int(grade), to='ordinal')
         a_or_an = 'a' if grade_ordinal[0] not in ('a', 'e', 'i', 'o', 'u') else 'an'
@@ -761,51 +838,48 @@ class Vocab(commands.Cog):
             grade_str = 'Your '
         grade_str += 'messages are readable by {} ***{} grader!***'.format(a_or_an, grade_ordinal_num)
         summary.add_field(name='Message Readability', value=grade_str, inline=False)
-        summary.set_footer(text='(readability score is based on messages sent in the past month)')
+        summary.set_footer(text='(readability score is based on messages sent {})'.format(grade_window.describe()))
 
     @vocab.command(name='grade')
     async def vocab_grade(
             self,
             ctx: commands.Context,
             arg1: Optional[Union[discord.Member, discord.TextChannel]],
-            arg2: Optional[Union[discord.Member, discord.TextChannel]]
+            arg2: Optional[Union[discord.Member, discord.TextChannel]],
+            *,
+            window: TimeRangeConverter = TimeRange()
     ) -> None:
         await self._check_vocab_args(arg1, arg2)
 
         (user_target, channel_target) = await self._assign_args(ctx, arg1, arg2)
 
-        async with get_conn(self.bot) as conn:
-            async with conn.transaction():
-                server_status = await utility.server_status(conn, ctx.guild)
-                await self._handle_server_status_response(ctx, server_status)
-                if server_status != Status.AVAILABLE:
-                    return
-
-                if channel_target:
-                    channel_status = await utility.channel_status(conn, ctx.channel)
-                    await self._handle_channel_status_response(ctx, channel_status)
-                    if channel_status != Status.AVAILABLE:
-                        return
-
-                    df_grade = await self._get_agg_msgs_grade(
-                        conn, ctx.guild.id, user_id=user_target.id, channel_id=channel_target.id
-                    )
-                else:
-                    df_grade = await self._get_agg_msgs_grade(conn, ctx.guild.id, user_id=user_target.id)
+        if not await self._check_status(ctx, channel_target):
+            return
+
+        channel_id = channel_target.id if channel_target else None
+        grade_window = self._grade_window(window)
+        async with utility.request_scope(self.bot, ctx) as scope:
+            df_grade = await self._get_agg_msgs_grade(
+                scope, ctx.guild.id, grade_window, user_id=user_target.id, channel_id=channel_id
+            )
 
         if len(df_grade.index) == 0:
-            target_name = '#' + channel_target.name if channel_target else '**' + ctx.guild.name + '**'
+            target_name = self._target_name(ctx, channel_target, window)
             await ctx.send('It looks like you don\'t have any messages sent in {}.'.format(target_name))
             return
 
-        grade = await self.bot.loop.run_in_executor(None, partial(self._grade, df_grade))
+        grade = await self._compute(
+            self._report_key('grade', ctx, channel_target, user_target, window=grade_window), self._grade, df_grade
+        )
 
         title = user_target.name + '\'s Readability Report'
         if channel_target:
             title += ' (#{})'.format(channel_target.name)
+        if window:
+            title += ' ({})'.format(window.describe())
         summary = discord.Embed(colour=discord.Colour(0xff6600), title=title)
 
-        await self._add_grade_field(summary, grade)
+        await self._add_grade_field(summary, grade, grade_window)
 
         await ctx.send(embed=summary)
 
@@ -813,40 +887,36 @@ class Vocab(commands.Cog):
     async def vocab_server(
             self,
             ctx: commands.Context,
-            arg1: Optional[discord.TextChannel]
+            arg1: Optional[discord.TextChannel],
+            *,
+            window: TimeRangeConverter = TimeRange()
     ) -> None:
         channel_target = None
         if arg1:
             channel_target = arg1
 
-        async with get_conn(self.bot) as conn:
-            async with conn.transaction():
-                server_status = await utility.server_status(conn, ctx.guild)
-                await self._handle_server_status_response(ctx, server_status)
-                if server_status != Status.AVAILABLE:
-                    return
-
-                if channel_target:
-                    channel_status = await utility.channel_status(conn, ctx.channel)
-                    await self._handle_channel_status_response(ctx, channel_status)
-                    if channel_status != Status.AVAILABLE:
-                        return
-
-                    df = await self._get_agg_msgs(conn, ctx.guild.id, channel_id=channel_target.id)
-                    df_grade = await self._get_agg_msgs_grade(
-                        conn, ctx.guild.id, channel_id=channel_target.id
-                    )
-                else:
-                    df = await self._get_agg_msgs(conn, ctx.guild.id)
-                    df_grade = await self._get_agg_msgs_grade(conn, ctx.guild.id)
+        if not await self._check_status(ctx, channel_target):
+            return
+
+        channel_id = channel_target.id if channel_target else None
+        grade_window = self._grade_window(window)
+        async with utility.request_scope(self.bot, ctx) as scope:
+            df = await self._get_word_counts(scope, ctx.guild.id, channel_id=channel_id, window=window)
+            df_grade = await self._get_agg_msgs_grade(scope, ctx.guild.id, grade_window, channel_id=channel_id)
 
         if len(df.index) == 0 or len(df_grade.index) == 0:
-            target_name = '#' + channel_target.name if channel_target else '**' + ctx.guild.name + '**'
+            target_name = self._target_name(ctx, channel_target, window)
             await ctx.send('It looks like there are not enough words said in {}.'.format(target_name))
             return
 
         [ranking_result, unique_result, interesting_result, grade] \
-            = await self.bot.loop.run_in_executor(None, partial(self._summary, df, df_grade, server=True))
+            = await self._compute(
+                self._report_key('summary', ctx, channel_target, ('server', grade_window.key), window),
+                self._summary,
+                df,
+                df_grade,
+                server=True
+            )
 
         if len(ranking_result) == 0 or len(unique_result) == 0 or len(unique_result) == 0:
             await ctx.send(
@@ -857,6 +927,8 @@ class Vocab(commands.Cog):
         title = ctx.guild.name + '\'s Vocab Report'
         if channel_target:
             title += ' (#{})'.format(channel_target.name)
+        if window:
+            title += ' ({})'.format(window.describe())
         summary = discord.Embed(colour=discord.Colour(0xff6600), title=title)
 
         await self._add_ranking_field(summary, ranking_result, channel_target)
@@ -865,7 +937,7 @@ class Vocab(commands.Cog):
 
         await self._add_interesting_field(summary, interesting_result, inline=False)
 
-        await self._add_grade_field(summary, grade, server=True)
+        await self._add_grade_field(summary, grade, grade_window, server=True)
 
         await ctx.send(embed=summary)
 
@@ -873,35 +945,29 @@ class Vocab(commands.Cog):
     async def vocab_server_ranking(
             self,
             ctx: commands.Context,
-            arg1: Optional[discord.TextChannel]
+            arg1: Optional[discord.TextChannel],
+            *,
+            window: TimeRangeConverter = TimeRange()
     ) -> None:
         channel_target = None
         if arg1:
             channel_target = arg1
 
-        async with get_conn(self.bot) as conn:
-            async with conn.transaction():
-                server_status = await utility.server_status(conn, ctx.guild)
-                await self._handle_server_status_response(ctx, server_status)
-                if server_status != Status.AVAILABLE:
-                    return
-
-                if channel_target:
-                    channel_status = await utility.channel_status(conn, ctx.channel)
-                    await self._handle_channel_status_response(ctx, channel_status)
-                    if channel_status != Status.AVAILABLE:
-                        return
+        if not await self._check_status(ctx, channel_target):
+            return
 
-                    df = await self._get_agg_msgs(conn, ctx.guild.id, channel_id=channel_target.id)
-                else:
-                    df = await self._get_agg_msgs(conn, ctx.guild.id)
+        channel_id = channel_target.id if channel_target else None
+        async with utility.request_scope(self.bot, ctx) as scope:
+            df = await self._get_word_counts(scope, ctx.guild.id, channel_id=channel_id, window=window)
 
         if len(df.index) == 0:
-            target_name = '#' + channel_target.name if channel_target else '**' + ctx.guild.name + '**'
+            target_name = self._target_name(ctx, channel_target, window)
             await ctx.send('It looks like there are not enough words said in {}.'.format(target_name))
             return
 
-        ranking_result = await self.bot.loop.run_in_executor(None, partial(self._ranking, df))
+        ranking_result = await self._compute(
+            self._report_key('ranking', ctx, channel_target, window=window), self._ranking, df
+        )
 
         if len(ranking_result) == 0:
             await ctx.send(
@@ -912,6 +978,8 @@ class Vocab(commands.Cog):
         title = ctx.guild.name + '\'s Ranking Report'
         if channel_target:
             title += ' (#{})'.format(channel_target.name)
+        if window:
+            title += ' ({})'.format(window.describe())
         summary = discord.Embed(colour=discord.Colour(0xff6600), title=title)
 
         await self._add_ranking_field(summary, ranking_result, channel_target)
@@ -922,35 +990,29 @@ class Vocab(commands.Cog):
     async def vocab_server_unique(
             self,
             ctx: commands.Context,
-            arg1: Optional[discord.TextChannel]
+            arg1: Optional[discord.TextChannel],
+            *,
+            window: TimeRangeConverter = TimeRange()
     ) -> None:
         channel_target = None
         if arg1:
             channel_target = arg1
 
-        async with get_conn(self.bot) as conn:
-            async with conn.transaction():
-                server_status = await utility.server_status(conn, ctx.guild)
-                await self._handle_server_status_response(ctx, server_status)
-                if server_status != Status.AVAILABLE:
-                    return
-
-                if channel_target:
-                    channel_status = await utility.channel_status(conn, ctx.channel)
-                    await self._handle_channel_status_response(ctx, channel_status)
-                    if channel_status != Status.AVAILABLE:
-                        return
+        if not await self._check_status(ctx, channel_target):
+            return
 
-                    df = await self._get_agg_msgs(conn, ctx.guild.id, channel_id=channel_target.id)
-                else:
-                    df = await self._get_agg_msgs(conn, ctx.guild.id)
+        channel_id = channel_target.id if channel_target else None
+        async with utility.request_scope(self.bot, ctx) as scope:
+            df = await self._get_word_counts(scope, ctx.guild.id, channel_id=channel_id, window=window)
 
         if len(df.index) == 0:
-            target_name = '#' + channel_target.name if channel_target else '**' + ctx.guild.name + '**'
+            target_name = self._target_name(ctx, channel_target, window)
             await ctx.send('It looks like there are not enough words said in {}.'.format(target_name))
             return
 
-        unique_result = await self.bot.loop.run_in_executor(None, partial(self._unique, df))
+        unique_result = await self._compute(
+            self._report_key('unique', ctx, channel_target, window=window), self._unique, df
+        )
 
         if len(unique_result) == 0:
             await ctx.send(
@@ -961,6 +1023,8 @@ class Vocab(commands.Cog):
         title = ctx.guild.name + '\'s Unique Words Report'
         if channel_target:
             title += ' (#{})'.format(channel_target.name)
+        if window:
+            title += ' ({})'.format(window.describe())
         summary = discord.Embed(colour=discord.Colour(0xff6600), title=title)
 
         await self._add_unique_field(summary, unique_result)
@@ -971,35 +1035,29 @@ class Vocab(commands.Cog):
     async def vocab_server_interesting(
             self,
             ctx: commands.Context,
-            arg1: Optional[discord.TextChannel]
+            arg1: Optional[discord.TextChannel],
+            *,
+            window: TimeRangeConverter = TimeRange()
     ) -> None:
         channel_target = None
         if arg1:
             channel_target = arg1
 
-        async with get_conn(self.bot) as conn:
-            async with conn.transaction():
-                server_status = await utility.server_status(conn, ctx.guild)
-                await self._handle_server_status_response(ctx, server_status)
-                if server_status != Status.AVAILABLE:
-                    return
-
-                if channel_target:
-                    channel_status = await utility.channel_status(conn, ctx.channel)
-                    await self._handle_channel_status_response(ctx, channel_status)
-                    if channel_status != Status.AVAILABLE:
-                        return
+        if not await self._check_status(ctx, channel_target):
+            return
 
-                    df = await self._get_agg_msgs(conn, ctx.guild.id, channel_id=channel_target.id)
-                else:
-                    df = await self._get_agg_msgs(conn, ctx.guild.id)
+        channel_id = channel_target.id if channel_target else None
+        async with utility.request_scope(self.bot, ctx) as scope:
+            df = await self._get_word_counts(scope, ctx.guild.id, channel_id=channel_id, window=window)
 
         if len(df.index) == 0:
-            target_name = '#' + channel_target.name if channel_target else '**' + ctx.guild.name + '**'
+            target_name = self._target_name(ctx, channel_target, window)
             await ctx.send('It looks like there are not enough words said in {}.'.format(target_name))
             return
 
-        interesting_result = await self.bot.loop.run_in_executor(None, partial(self._interesting, df))
+        interesting_result = await self._compute(
+            self._report_key('interesting', ctx, channel_target, window=window), self._interesting, df
+        )
 
         if len(interesting_result) == 0:
             await ctx.send(
@@ -1010,6 +1068,8 @@ class Vocab(commands.Cog):
         title = ctx.guild.name + '\'s Interesting Words Report'
         if channel_target:
             title += ' (#{})'.format(channel_target.name)
+        if window:
+            title += ' ({})'.format(window.describe())
         summary = discord.Embed(colour=discord.Colour(0xff6600), title=title)
 
         await self._add_interesting_field(summary, interesting_result)
@@ -1020,42 +1080,39 @@ class Vocab(commands.Cog):
     async def vocab_server_grade(
             self,
             ctx: commands.Context,
-            arg1: Optional[discord.TextChannel]
+            arg1: Optional[discord.TextChannel],
+            *,
+            window: TimeRangeConverter = TimeRange()
     ) -> None:
         channel_target = None
         if arg1:
             channel_target = arg1
 
-        async with get_conn(self.bot) as conn:
-            async with conn.transaction():
-                server_status = await utility.server_status(conn, ctx.guild)
-                await self._handle_server_status_response(ctx, server_status)
-                if server_status != Status.AVAILABLE:
-                    return
-
-                if channel_target:
-                    channel_status = await utility.channel_status(conn, ctx.channel)
-                    await self._handle_channel_status_response(ctx, channel_status)
-                    if channel_status != Status.AVAILABLE:
-                        return
+        if not await self._check_status(ctx, channel_target):
+            return
 
-                    df_grade = await self._get_agg_msgs_grade(conn, ctx.guild.id, channel_id=channel_target.id)
-                else:
-                    df_grade = await self._get_agg_msgs_grade(conn, ctx.guild.id)
+        channel_id = channel_target.id if channel_target else None
+        grade_window = self._grade_window(window)
+        async with utility.request_scope(self.bot, ctx) as scope:
+            df_grade = await self._get_agg_msgs_grade(scope, ctx.guild.id, grade_window, channel_id=channel_id)
 
         if len(df_grade.index) == 0:
-            target_name = '#' + channel_target.name if channel_target else '**' + ctx.guild.name + '**'
+            target_name = self._target_name(ctx, channel_target, window)
             await ctx.send('It looks like there are not enough words said in {}.'.format(target_name))
             return
 
-        grade = await self.bot.loop.run_in_executor(None, partial(self._grade, df_grade))
+        grade = await self._compute(
+            self._report_key('grade', ctx, channel_target, window=grade_window), self._grade, df_grade
+        )
 
         title = ctx.guild.name + '\'s Readability Report'
         if channel_target:
             title += ' (#{})'.format(channel_target.name)
+        if window:
+            title += ' ({})'.format(window.describe())
         summary = discord.Embed(colour=discord.Colour(0xff6600), title=title)
 
-        await self._add_grade_field(summary, grade, server=True)
+        await self._add_grade_field(summary, grade, grade_window, server=True)
 
         await ctx.send(embed=summary)
 
@@ -0,0 +1,117 @@
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+import pandas as pd
+
+
+def _sizeof(value: Any) -> int:
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_sizeof(v) for v in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_sizeof(k) + _sizeof(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+class CacheEntry:
+    def __init__(self, value: Any, version: int, size: int) -> None:
+        self.value = value
+        self.version = version
+        self.size = size
+        self.stored = time.time()
+
+
+class ReportCache:
+    # Keys are (command, guild ID, channel ID, user ID, params), entries only count for the guild data version they
+    # were computed from
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.expired = 0
+        self.evicted = 0
+        self.bytes = 0
+
+        self._entries: OrderedDict[tuple, CacheEntry] = OrderedDict()
+        self._versions: dict[int, int] = dict()
+
+    def version(self, guild_id: int) -> int:
+        return self._versions.get(guild_id, 0)
+
+    def bump(self, guild_id: Optional[int]) -> None:
+        # Stale entries aren't hunted down, they just stop matching and age out of the LRU
+        if guild_id is not None:
+            self._versions[guild_id] = self._versions.get(guild_id, 0) + 1
+
+    def _remove(self, key: tuple) -> None:
+        entry = self._entries.pop(key)
+        self.bytes -= entry.size
+
+    def get(self, key: tuple) -> tuple[bool, Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+
+        if entry.version != self.version(key[1]):
+            self.stale += 1
+        elif time.time() - entry.stored > self.ttl:
+            self.expired += 1
+        else:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry.value
+
+        self._remove(key)
+        self.misses += 1
+        return False, None
+
+    def put(self, key: tuple, value: Any, version: int) -> None:
+        # A guild that changed while the value was being computed makes it stale already
+        if version != self.version(key[1]) or not self.max_entries:
+            return
+
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = CacheEntry(value, version, size)
+        self.bytes += size
+
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evicted += 1
+
+    async def get_or_compute(self, key: tuple, compute: Callable[[], Awaitable[Any]]) -> Any:
+        found, value = self.get(key)
+        if found:
+            return value
+
+        version = self.version(key[1])
+        value = await compute()
+        self.put(key, value, version)
+        return value
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.bytes = 0
+
+    def report(self) -> str:
+        lookups = self.hits + self.misses
+        hit_ratio = self.hits / lookups * 100 if lookups else 0.0
+
+        return ('Report Cache Status Report:\nEntries: {}/{}, Memory: {:.1f}/{:.0f} MB, TTL: {:.0f}s\n'
+                'Hits: {}, Misses: {}, Hit Ratio: {:.1f}%\n'
+                'Stale: {}, Expired: {}, Evicted: {}'
+                ''.format(len(self._entries), self.max_entries, self.bytes / 1024 / 1024,
+                          self.max_bytes / 1024 / 1024, self.ttl, self.hits, self.misses, hit_ratio,
+                          self.stale, self.expired, self.evicted))
@@ -0,0 +1,78 @@
+import asyncpg
+
+# Statement-level, so a COPY or batched insert updates each counter once rather than once per message
+INSERT_TRIGGER_FUNCTION = (
+    'CREATE OR REPLACE FUNCTION statbot_db.count_inserted_messages() RETURNS TRIGGER AS $$ '
+    'BEGIN '
+    '    INSERT INTO statbot_db.MESSAGE_COUNTS AS C (ServerID, ChannelID, AuthorID, Messages) '
+    '    SELECT ServerID, ChannelID, AuthorID, COUNT(*) FROM NEW_ROWS '
+    '    GROUP BY ServerID, ChannelID, AuthorID '
+    '    ON CONFLICT (ServerID, ChannelID, AuthorID) DO UPDATE SET Messages = C.Messages + EXCLUDED.Messages; '
+    '    RETURN NULL; '
+    'END; '
+    '$$ LANGUAGE plpgsql'
+)
+
+DELETE_TRIGGER_FUNCTION = (
+    'CREATE OR REPLACE FUNCTION statbot_db.count_deleted_messages() RETURNS TRIGGER AS $$ '
+    'BEGIN '
+    '    UPDATE statbot_db.MESSAGE_COUNTS AS C '
+    '    SET Messages = C.Messages - D.Messages '
+    '    FROM (SELECT ServerID, ChannelID, AuthorID, COUNT(*) AS Messages FROM OLD_ROWS '
+    '          GROUP BY ServerID, ChannelID, AuthorID) AS D '
+    '    WHERE C.ServerID = D.ServerID AND C.ChannelID = D.ChannelID AND C.AuthorID = D.AuthorID; '
+    '    RETURN NULL; '
+    'END; '
+    '$$ LANGUAGE plpgsql'
+)
+
+
+async def install_triggers(conn: asyncpg.Connection, table: str = 'MESSAGES') -> None:
+    await conn.execute(INSERT_TRIGGER_FUNCTION)
+    await conn.execute(DELETE_TRIGGER_FUNCTION)
+
+    await conn.execute('DROP TRIGGER IF EXISTS count_inserted_messages ON statbot_db.{}'.format(table))
+    await conn.execute(
+        'CREATE TRIGGER count_inserted_messages AFTER INSERT ON statbot_db.{} '
+        'REFERENCING NEW TABLE AS NEW_ROWS '
+        'FOR EACH STATEMENT EXECUTE FUNCTION statbot_db.count_inserted_messages()'.format(table)
+    )
+    await conn.execute('DROP TRIGGER IF EXISTS count_deleted_messages ON statbot_db.{}'.format(table))
+    await conn.execute(
+        'CREATE TRIGGER count_deleted_messages AFTER DELETE ON statbot_db.{} '
+        'REFERENCING OLD TABLE AS OLD_ROWS '
+        'FOR EACH STATEMENT EXECUTE FUNCTION statbot_db.count_deleted_messages()'.format(table)
+    )
+
+
+async def remove_triggers(conn: asyncpg.Connection, table: str = 'MESSAGES') -> None:
+    await conn.execute('DROP TRIGGER IF EXISTS count_inserted_messages ON statbot_db.{}'.format(table))
+    await conn.execute('DROP TRIGGER IF EXISTS count_deleted_messages ON statbot_db.{}'.format(table))
+
+
+async def recount_server(conn: asyncpg.Connection, server_id: int) -> None:
+    # Needed whenever messages move without passing through the triggers, e.g. a partition swap
+    async with conn.transaction():
+        await conn.execute('LOCK TABLE statbot_db.MESSAGE_COUNTS IN SHARE ROW EXCLUSIVE MODE')
+        await conn.execute('DELETE FROM statbot_db.MESSAGE_COUNTS WHERE ServerID = $1', server_id)
+        await conn.execute(
+            'INSERT INTO statbot_db.MESSAGE_COUNTS (ServerID, ChannelID, AuthorID, Messages) '
+            'SELECT ServerID, ChannelID, AuthorID, COUNT(*) FROM statbot_db.MESSAGES '
+            'WHERE ServerID = $1 '
+            'GROUP BY ServerID, ChannelID, AuthorID',
+            server_id
+        )
+
+
+async def check_server(conn: asyncpg.Connection, server_id: int) -> list[asyncpg.Record]:
+    return await conn.fetch(
+        'SELECT COALESCE(R.ChannelID, C.ChannelID) AS channelid, COALESCE(R.AuthorID, C.AuthorID) AS authorid, '
+        '       COALESCE(R.Messages, 0) AS actual, COALESCE(C.Messages, 0) AS counted '
+        'FROM (SELECT ChannelID, AuthorID, COUNT(*) AS Messages FROM statbot_db.MESSAGES '
+        '      WHERE ServerID = $1 GROUP BY ChannelID, AuthorID) AS R '
+        'FULL OUTER JOIN (SELECT ChannelID, AuthorID, Messages FROM statbot_db.MESSAGE_COUNTS '
+        '                 WHERE ServerID = $1) AS C '
+        'ON R.ChannelID = C.ChannelID AND R.AuthorID = C.AuthorID '
+        'WHERE COALESCE(R.Messages, 0) <> COALESCE(C.Messages, 0)',
+        server_id
+    )
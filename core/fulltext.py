@@ -0,0 +1,81 @@
+from typing import Optional
+
+import asyncpg
+
+from core import words
+
+CONFIG = 'statbot_db.statbot_words'
+COLUMN = 'ContentWords'
+INDEX_NAME = 'idx_MESSAGES_ContentWords'
+INDEX_SUFFIX = 'content_words'
+
+# Same cleaning and command skipping as the word counts. The simple dictionary only lower-cases, so nothing is
+# stemmed or dropped as a stopword, and whatever looks like a link to the parser isn't counted
+COLUMN_DEFINITION = (
+    '{} TSVECTOR GENERATED ALWAYS AS ('
+    '    CASE WHEN Content ~ {} THEN NULL ELSE to_tsvector({}::regconfig, {}) END'
+    ') STORED'.format(COLUMN, words.literal(words.COMMAND_PREFIXES), words.literal(CONFIG),
+                      words.cleaned_content('Content'))
+)
+
+
+async def is_enabled(conn: asyncpg.Connection, table: str = 'messages') -> bool:
+    return await conn.fetchval(
+        'SELECT EXISTS ('
+        '    SELECT 1 FROM pg_attribute '
+        '    WHERE attrelid = $1::regclass AND attname = $2 AND NOT attisdropped)',
+        'statbot_db.{}'.format(table),
+        COLUMN.lower()
+    )
+
+
+async def install_config(conn: asyncpg.Connection) -> None:
+    exists = await conn.fetchval(
+        'SELECT EXISTS ('
+        '    SELECT 1 FROM pg_ts_config AS C '
+        '    JOIN pg_namespace AS N ON N.oid = C.cfgnamespace '
+        '    WHERE N.nspname = $1 AND C.cfgname = $2)',
+        'statbot_db',
+        'statbot_words'
+    )
+    if exists:
+        return
+
+    await conn.execute('CREATE TEXT SEARCH CONFIGURATION {} (COPY = pg_catalog.simple)'.format(CONFIG))
+    await conn.execute(
+        'ALTER TEXT SEARCH CONFIGURATION {} DROP MAPPING IF EXISTS FOR email, url, url_path, host, file'.format(CONFIG)
+    )
+
+
+async def add_column(conn: asyncpg.Connection, table: str = 'messages') -> None:
+    # Computing the column for every stored message rewrites the whole table
+    await install_config(conn)
+    await conn.execute('ALTER TABLE statbot_db.{} ADD COLUMN IF NOT EXISTS {}'.format(table, COLUMN_DEFINITION))
+
+
+async def drop_column(conn: asyncpg.Connection) -> None:
+    # The index goes with the column
+    await conn.execute('ALTER TABLE statbot_db.messages DROP COLUMN IF EXISTS {}'.format(COLUMN))
+
+
+async def word_frequencies(
+        conn: asyncpg.Connection,
+        server_id: int,
+        author_id: Optional[int] = None,
+        channel_id: Optional[int] = None,
+        limit: Optional[int] = None
+) -> list[asyncpg.Record]:
+    # ts_stat only takes the text of a query, so the filters can't be bound as parameters
+    query = 'SELECT {} FROM statbot_db.MESSAGES WHERE ServerID = {}'.format(COLUMN, int(server_id))
+    if author_id:
+        query += ' AND AuthorID = {}'.format(int(author_id))
+    if channel_id:
+        query += ' AND ChannelID = {}'.format(int(channel_id))
+
+    return await conn.fetch(
+        'SELECT word, nentry AS counts FROM ts_stat($1) '
+        'ORDER BY nentry DESC, word '
+        'LIMIT $2',
+        query,
+        limit
+    )
@@ -0,0 +1,230 @@
+import asyncio
+import datetime
+import logging
+import time
+from typing import AsyncIterator, Iterable, Optional
+
+import asyncpg
+import discord
+
+from core import bot_config
+from core.ingest import is_loggable, message_row
+from core.loader import MessageLoader, create_loader
+from core.progress import ChannelProgress, ImportProgress
+from core.statbot import StatBot
+from core.utility import get_conn
+
+
+class ImportPlanner:
+    def __init__(self, bot: StatBot, max_workers: int, guild_workers: int) -> None:
+        self.bot = bot
+        self.guild_workers = guild_workers
+        self.log = logging.getLogger('statbot')
+        self.progress = ImportProgress()
+
+        # Shared by every guild import so the total stays within the import pool and Discord's rate limits
+        self._global_slots = asyncio.Semaphore(max_workers)
+
+    def _begin(
+            self,
+            text_channel: discord.TextChannel,
+            span_start: datetime.datetime,
+            span_end: datetime.datetime,
+            newest_first: bool
+    ) -> ChannelProgress:
+        return self.progress.begin(
+            text_channel.guild.id, text_channel.guild.name, text_channel.id, text_channel.name,
+            span_start, span_end, newest_first
+        )
+
+    async def _checkpoint(
+            self,
+            conn: asyncpg.Connection,
+            loader: MessageLoader,
+            text_channel: discord.TextChannel,
+            chunk: list[list],
+            oldest: int,
+            newest: int
+    ) -> None:
+        # Rows and the channel's import cursor commit together, so a restart resumes exactly where this left off
+        async with conn.transaction():
+            await loader.write(chunk)
+            await conn.execute(
+                'UPDATE statbot_db.CHANNELS '
+                'SET OldestImported = LEAST(OldestImported, $1), NewestImported = GREATEST(NewestImported, $2) '
+                'WHERE ChannelID = $3',
+                oldest,
+                newest,
+                text_channel.id
+            )
+
+    async def _load_history(
+            self,
+            conn: asyncpg.Connection,
+            loader: MessageLoader,
+            text_channel: discord.TextChannel,
+            history: AsyncIterator[discord.Message],
+            progress: ChannelProgress
+    ) -> int:
+        chunk = list()
+        oldest = None
+        newest = None
+        counter = 0
+
+        # Time spent waiting on the iterator is time spent fetching from Discord
+        last = time.perf_counter()
+        async for message in history:
+            progress.record_fetch(time.perf_counter() - last, message.created_at)
+
+            oldest = message.id if oldest is None else min(oldest, message.id)
+            newest = message.id if newest is None else max(newest, message.id)
+
+            if not is_loggable(message):
+                self.log.info('FAILED TO LOG MESSAGE: Type not default or reply')
+                self.log.debug(message)
+                self.log.debug('Message content: {}'.format(message.content))
+                continue
+
+            chunk.append(message_row(message))
+
+            counter += 1
+            if len(chunk) >= loader.batch_size:
+                start = time.perf_counter()
+                await self._checkpoint(conn, loader, text_channel, chunk, oldest, newest)
+                progress.record_write(len(chunk), time.perf_counter() - start)
+                chunk = list()
+
+            if counter % 10000 == 0:
+                self.log.info('Fetched 10000 messages from {} channel in {} server ({:.0f} rows/s, {:.0%} done, '
+                              'fetch {:.0%} of time)'.format(text_channel.name, text_channel.guild.name,
+                                                             progress.rows_per_second, progress.fraction,
+                                                             progress.fetch_share))
+
+            last = time.perf_counter()
+
+        if oldest is not None:
+            start = time.perf_counter()
+            await self._checkpoint(conn, loader, text_channel, chunk, oldest, newest)
+            progress.record_write(len(chunk), time.perf_counter() - start)
+
+        if counter % 10000 != 0:
+            self.log.info('Fetched {} messages from {} channel, '
+                          '{} server'.format((counter % 10000),
+                                             text_channel.name, text_channel.guild.name))
+
+        return counter
+
+    async def add_messages(
+            self, text_channel: discord.TextChannel, conn: asyncpg.Connection, before: Optional[int] = None
+    ) -> None:
+        loader = create_loader(conn, bot_config.IMPORT_LOADER, bot_config.IMPORT_BATCH_SIZE)
+        history = text_channel.history(limit=None, before=discord.Object(id=before) if before else None)
+
+        progress = self._begin(
+            text_channel, text_channel.created_at,
+            discord.utils.snowflake_time(before) if before else discord.utils.utcnow(), newest_first=True
+        )
+        await self._load_history(conn, loader, text_channel, history, progress)
+        self.progress.finish(progress)
+
+        self.log.info('Loaded {} messages from {} channel using {} loader ({:.0f} rows/s)'.format(
+            loader.rows_loaded, text_channel.name, bot_config.IMPORT_LOADER, loader.rows_per_second
+        ))
+
+    async def catch_up(self, text_channel: discord.TextChannel, conn: asyncpg.Connection, after: Optional[int]) -> None:
+        # Live ingestion may already have stored part of this range
+        loader = create_loader(conn, bot_config.IMPORT_LOADER, bot_config.IMPORT_BATCH_SIZE, expect_conflicts=True)
+        history = text_channel.history(
+            limit=None, after=discord.Object(id=after) if after else None, oldest_first=True
+        )
+
+        progress = self._begin(
+            text_channel, discord.utils.snowflake_time(after) if after else text_channel.created_at,
+            discord.utils.utcnow(), newest_first=False
+        )
+        counter = await self._load_history(conn, loader, text_channel, history, progress)
+        self.progress.finish(progress)
+        if counter:
+            self.log.info('Caught up {} messages in {} channel'.format(counter, text_channel.name))
+
+    async def import_channel(self, text_channel: discord.TextChannel, after: Optional[int] = None) -> None:
+        async with self._global_slots:
+            async with get_conn(self.bot, 'import') as conn:
+                row = await conn.fetchrow(
+                    'SELECT C.Importing, C.OldestImported '
+                    'FROM statbot_db.CHANNELS AS C, statbot_db.SERVERS AS S '
+                    'WHERE C.ChannelID = $1 AND C.ServerID = S.ServerID AND NOT C.Removing AND NOT S.Removing',
+                    text_channel.id
+                )
+                if row is None:
+                    self.log.info('FAILED TO IMPORT CHANNEL: Channel not in DB or being removed')
+                    self.log.debug(text_channel)
+                    return
+
+                if row['importing']:
+                    await self.add_messages(text_channel, conn, before=row['oldestimported'])
+
+                    status = await conn.execute(
+                        'UPDATE statbot_db.CHANNELS AS C SET Importing = $1 '
+                        'FROM statbot_db.SERVERS AS S '
+                        'WHERE C.ChannelID = $2 AND C.ServerID = S.ServerID AND NOT C.Removing AND NOT S.Removing',
+                        False,
+                        text_channel.id
+                    )
+                    # The channel or its server may have been removed while its history was being fetched
+                    if status == 'UPDATE 0':
+                        return
+                    self.bot.registry.set_channel(text_channel.id, text_channel.guild.id, importing=False)
+
+                if after is None:
+                    after = await conn.fetchval(
+                        'SELECT NewestImported FROM statbot_db.CHANNELS '
+                        'WHERE ChannelID = $1',
+                        text_channel.id
+                    )
+                await self.catch_up(text_channel, conn, after)
+
+    async def rebuild_channel(self, text_channel: discord.TextChannel, table: str) -> None:
+        async with self._global_slots:
+            async with get_conn(self.bot, 'import') as conn:
+                # The rebuild mirror trigger may already have copied some of these rows over
+                loader = create_loader(
+                    conn, bot_config.IMPORT_LOADER, bot_config.IMPORT_BATCH_SIZE, table=table, expect_conflicts=True
+                )
+                progress = self._begin(
+                    text_channel, text_channel.created_at, discord.utils.utcnow(), newest_first=True
+                )
+                counter = await self._load_history(
+                    conn, loader, text_channel, text_channel.history(limit=None), progress
+                )
+                self.progress.finish(progress)
+
+        self.log.info('Rebuilt {} messages from {} channel'.format(counter, text_channel.name))
+
+    async def rebuild_guild(
+            self, guild: discord.Guild, text_channels: Iterable[discord.TextChannel], table: str
+    ) -> None:
+        guild_slots = asyncio.Semaphore(self.guild_workers)
+        text_channels = list(text_channels)
+        self.progress.plan_guild(guild.id, len(text_channels))
+
+        async def unit(text_channel: discord.TextChannel) -> None:
+            async with guild_slots:
+                await self.rebuild_channel(text_channel, table)
+
+        # Any failure aborts the whole rebuild, as swapping in a partial copy would lose messages
+        await asyncio.gather(*[unit(c) for c in text_channels])
+
+    async def load_cursors(self) -> dict[int, dict[int, Optional[int]]]:
+        async with get_conn(self.bot, 'import') as conn:
+            rows = await conn.fetch(
+                'SELECT C.ChannelID, C.ServerID, C.NewestImported '
+                'FROM statbot_db.CHANNELS AS C, statbot_db.SERVERS AS S '
+                'WHERE C.ServerID = S.ServerID AND NOT C.Removing AND NOT S.Removing'
+            )
+
+        cursors = dict()
+        for row in rows:
+            cursors.setdefault(row['serverid'], dict())[row['channelid']] = row['newestimported']
+
+        return cursors
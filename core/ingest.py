@@ -0,0 +1,410 @@
+import asyncio
+import datetime
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Iterable, Optional
+
+import asyncpg
+import discord
+
+from core.cache import ReportCache
+from core.loader import MESSAGE_COLUMN_LIST, UNNEST_ROWS, unnest_args, upsert_clause
+from core.pools import TimedPool
+
+# Failures of the connection or the server rather than of the rows. The batch goes back in the queue and the next
+# flush retries it, writes are upserts so rows that made it in before the failure are written again harmlessly
+TRANSIENT_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.InterfaceError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.OperatorInterventionError
+)
+
+
+def is_loggable(message: discord.Message) -> bool:
+    return message.type == discord.MessageType.default or message.type == discord.MessageType.reply
+
+
+def message_row(message: discord.Message) -> list:
+    attachment_url_list = [attachment.url for attachment in message.attachments]
+
+    return [
+        message.id,
+        None if not message.reference else message.reference.message_id,
+        message.content,
+        attachment_url_list,
+        message.created_at,
+        message.edited_at,
+        message.guild.id,
+        message.channel.id,
+        message.author.id
+    ]
+
+
+class IngestStats:
+    def __init__(self) -> None:
+        self.enqueued = 0
+        self.dropped = 0
+        self.flushed_rows = 0
+        self.failed_rows = 0
+        self.batches = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+        self.delete_requested = 0
+        self.deleted_rows = 0
+        self.cancelled_inserts = 0
+        self.edit_requested = 0
+        self.edits_coalesced = 0
+        self.edits_merged = 0
+        self.edits_cancelled = 0
+        self.edit_batches = 0
+        self.edited_rows = 0
+
+    @property
+    def untracked_deletes(self) -> int:
+        return self.delete_requested - self.deleted_rows - self.cancelled_inserts
+
+    @property
+    def untracked_edits(self) -> int:
+        return (self.edit_requested - self.edits_coalesced - self.edits_merged - self.edits_cancelled -
+                self.edited_rows)
+
+    def record_flush(self, batch_size: int, latency: float) -> None:
+        self.batches += 1
+        self.flushed_rows += batch_size
+        self.last_batch_size = batch_size
+        self.max_batch_size = max(self.max_batch_size, batch_size)
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        self.total_flush_latency += latency
+
+    @property
+    def avg_batch_size(self) -> float:
+        return self.flushed_rows / self.batches if self.batches else 0.0
+
+    @property
+    def avg_flush_latency(self) -> float:
+        return self.total_flush_latency / self.batches if self.batches else 0.0
+
+
+class MessageBuffer:
+    def __init__(
+            self,
+            pool: TimedPool,
+            key: str,
+            batch_size: int,
+            flush_interval: float,
+            max_queue: int,
+            report_cache: Optional[ReportCache] = None
+    ) -> None:
+        self.pool = pool
+        self.key = key
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.report_cache = report_cache
+
+        self.log = logging.getLogger('statbot')
+        self.stats = IngestStats()
+
+        # Pending rows by MessageID in arrival order, so edits and deletes can find rows that haven't been written yet
+        self._pending: dict[int, list] = dict()
+        # Edits and deletes keep the ServerID of their message, so the guild's reports go stale once they're stored
+        self._pending_edits: dict[int, tuple[str, Optional[datetime.datetime], Optional[int]]] = dict()
+        self._pending_deletes: dict[int, Optional[int]] = dict()
+        # Rows put back after a failed write, some of which may have been stored before the connection went
+        self._requeued = set()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def insert_query(self) -> str:
+        # Rows are only written if their channel and server are tracked and not being purged, which replaces the
+        # per-message SERVERS/CHANNELS lookups. A backfill may have stored the message already
+        return (
+            'INSERT INTO statbot_db.MESSAGES ({}) {} '
+            'WHERE EXISTS (SELECT 1 FROM statbot_db.CHANNELS AS C, statbot_db.SERVERS AS S '
+            '              WHERE C.ChannelID = T.ChannelID AND C.ServerID = S.ServerID '
+            '              AND NOT C.Removing AND NOT S.Removing)'
+            '{}'.format(MESSAGE_COLUMN_LIST, UNNEST_ROWS, upsert_clause('messages', self.key))
+        )
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending) + len(self._pending_edits) + len(self._pending_deletes)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def put(self, row: list) -> None:
+        if len(self._pending) >= self.max_queue:
+            self.stats.dropped += 1
+            self.log.warning('INGEST QUEUE FULL: Dropping message {}'.format(row[0]))
+            return
+
+        self._pending[row[0]] = row
+        self.stats.enqueued += 1
+
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def delete(self, message_ids: Iterable[int], server_id: Optional[int] = None) -> None:
+        message_ids = set(message_ids)
+        self.stats.delete_requested += len(message_ids)
+
+        # Messages deleted before they were flushed never need to reach the DB
+        cancelled = {message_id for message_id in message_ids if self._pending.pop(message_id, None) is not None}
+        if cancelled:
+            # A row that went back after a failed write may be stored already, so its delete still goes out
+            retried = cancelled & self._requeued
+            self._requeued -= retried
+            self.stats.cancelled_inserts += len(cancelled - retried)
+            message_ids -= cancelled - retried
+
+        for message_id in message_ids:
+            if self._pending_edits.pop(message_id, None) is not None:
+                self.stats.edits_cancelled += 1
+
+        self._pending_deletes.update(dict.fromkeys(message_ids, server_id))
+
+        if len(message_ids) > 1 or len(self._pending_deletes) >= self.batch_size:
+            self._wakeup.set()
+
+    def edit(
+            self, message_id: int, content: str, edited_at: Optional[datetime.datetime], server_id: Optional[int] = None
+    ) -> None:
+        self.stats.edit_requested += 1
+
+        if message_id in self._pending_deletes:
+            self.stats.edits_cancelled += 1
+            return
+
+        row = self._pending.get(message_id)
+        if row is not None:
+            row[2] = content
+            row[5] = edited_at
+            self.stats.edits_merged += 1
+            return
+
+        # Only the latest edit to a message within a flush window is ever written
+        previous = self._pending_edits.get(message_id)
+        if previous is not None:
+            self.stats.edits_coalesced += 1
+            if previous[1] is not None and edited_at is not None and edited_at < previous[1]:
+                return
+
+        self._pending_edits[message_id] = (content, edited_at, server_id)
+
+        if len(self._pending_edits) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                await self.flush()
+            except Exception as e:
+                self.log.error('INGEST FLUSH FAILED: {!r}'.format(e))
+
+    def _take(self, count: int) -> list[list]:
+        return [self._pending.pop(message_id) for message_id in list(itertools.islice(self._pending, count))]
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            # Only the rows queued when the flush started, put() keeps adding to the queue while batches are written
+            inserts = len(self._pending)
+            while inserts > 0 and self._pending:
+                batch = self._take(min(self.batch_size, inserts))
+                inserts -= len(batch)
+
+                start = time.perf_counter()
+                try:
+                    await self._write_batch(batch)
+                except TRANSIENT_ERRORS:
+                    self._requeue(batch)
+                    raise
+                self._requeued.difference_update(row[0] for row in batch)
+                self._bump(row[6] for row in batch)
+                self.stats.record_flush(len(batch), time.perf_counter() - start)
+
+            # Edits and deletes of rows still queued were folded into the queue, so these only refer to messages that
+            # are stored by now. Deletes go last so a message logged and deleted in quick succession ends up gone
+            if self._pending_edits:
+                edits = self._pending_edits
+                self._pending_edits = dict()
+                try:
+                    await self._edit_batch(edits)
+                except TRANSIENT_ERRORS:
+                    self._requeue_edits(edits)
+                    raise
+                self._bump(edit[2] for edit in edits.values())
+
+            if self._pending_deletes:
+                deletes = self._pending_deletes
+                self._pending_deletes = dict()
+                try:
+                    await self._delete_batch(list(deletes))
+                except TRANSIENT_ERRORS:
+                    self._pending_deletes.update(deletes)
+                    raise
+                self._bump(deletes.values())
+
+    @asynccontextmanager
+    async def paused(self) -> AsyncIterator[None]:
+        # Holds off flushes, e.g. while MESSAGES is swapped for a table with another key. Events keep being queued
+        await self.flush()
+        async with self._flush_lock:
+            yield
+
+    def _bump(self, server_ids: Iterable[Optional[int]]) -> None:
+        # Only once the rows are committed, a report computed in the meantime would otherwise be cached as current
+        if self.report_cache is not None:
+            for server_id in set(server_ids):
+                self.report_cache.bump(server_id)
+
+    def _requeue(self, batch: list[list]) -> None:
+        # Back to the head of the queue. Edits and deletes that came in meanwhile stay queued, they run after it
+        self._pending = {**{row[0]: row for row in batch}, **self._pending}
+        self._requeued.update(row[0] for row in batch)
+
+    def _requeue_edits(self, edits: dict[int, tuple[str, Optional[datetime.datetime], Optional[int]]]) -> None:
+        for message_id, edit in edits.items():
+            if message_id in self._pending_deletes:
+                self.stats.edits_cancelled += 1
+                continue
+
+            # An edit that came in since is newer unless its timestamp says otherwise
+            newer = self._pending_edits.get(message_id)
+            if newer is not None:
+                self.stats.edits_coalesced += 1
+                if newer[1] is None or edit[1] is None or newer[1] >= edit[1]:
+                    continue
+
+            self._pending_edits[message_id] = edit
+
+    async def _edit_batch(self, edits: dict[int, tuple[str, Optional[datetime.datetime], Optional[int]]]) -> None:
+        async with self.pool.acquire() as conn:
+            try:
+                status = await conn.execute(
+                    'UPDATE statbot_db.MESSAGES AS M '
+                    'SET Content = E.Content, EditTime = E.EditTime '
+                    'FROM unnest($1::BIGINT[], $2::TEXT[], $3::TIMESTAMPTZ[]) AS E(MessageID, Content, EditTime) '
+                    'WHERE M.MessageID = E.MessageID '
+                    'AND (M.EditTime IS NULL OR E.EditTime IS NULL OR E.EditTime >= M.EditTime)',
+                    list(edits.keys()),
+                    [edit[0] for edit in edits.values()],
+                    [edit[1] for edit in edits.values()]
+                )
+            except TRANSIENT_ERRORS:
+                raise
+            except asyncpg.PostgresError as e:
+                self.log.error('FAILED TO UPDATE MESSAGES: {} messages'.format(len(edits)))
+                self.log.debug('{!r}: errno is {}'.format(e, e.args[0]))
+                return
+
+        self.stats.edit_batches += 1
+        self.stats.edited_rows += int(status.split()[-1])
+
+    async def _delete_batch(self, message_ids: list[int]) -> None:
+        async with self.pool.acquire() as conn:
+            try:
+                status = await conn.execute(
+                    'DELETE FROM statbot_db.MESSAGES '
+                    'WHERE MessageID = ANY($1::BIGINT[])',
+                    message_ids
+                )
+            except TRANSIENT_ERRORS:
+                raise
+            except asyncpg.PostgresError as e:
+                self.log.error('FAILED TO DELETE MESSAGES: {} messages'.format(len(message_ids)))
+                self.log.debug('{!r}: errno is {}'.format(e, e.args[0]))
+                return
+
+        deleted = int(status.split()[-1])
+        self.stats.deleted_rows += deleted
+        self.log.info('Deleted {} of {} messages'.format(deleted, len(message_ids)))
+
+    async def _advance_cursors(self, conn: asyncpg.Connection, batch: list[list]) -> None:
+        # Startup catch-up resumes from each channel's NewestImported
+        await conn.execute(
+            'UPDATE statbot_db.CHANNELS AS C '
+            'SET NewestImported = N.MessageID '
+            'FROM (SELECT ChannelID, MAX(MessageID) AS MessageID '
+            '      FROM unnest($1::BIGINT[], $2::BIGINT[]) AS T(MessageID, ChannelID) '
+            '      GROUP BY ChannelID) AS N '
+            'WHERE C.ChannelID = N.ChannelID AND (C.NewestImported IS NULL OR C.NewestImported < N.MessageID)',
+            [row[0] for row in batch],
+            [row[7] for row in batch]
+        )
+
+    async def _write_batch(self, batch: list[list]) -> None:
+        async with self.pool.acquire() as conn:
+            try:
+                async with conn.transaction():
+                    await conn.execute(self.insert_query, *unnest_args(batch))
+                    await self._advance_cursors(conn, batch)
+                return
+            except TRANSIENT_ERRORS:
+                raise
+            except asyncpg.PostgresError as e:
+                self.log.info('INGEST BATCH FAILED, retrying rows individually: {!r}'.format(e))
+
+            # One bad row (e.g. a channel removed mid-batch) shouldn't cost us the rest of the batch
+            written = list()
+            for row in batch:
+                try:
+                    await conn.execute(self.insert_query, *unnest_args([row]))
+                except TRANSIENT_ERRORS:
+                    raise
+                except asyncpg.PostgresError as e:
+                    self.stats.failed_rows += 1
+                    self.log.info('FAILED TO LOG MESSAGE: {}'.format(row[0]))
+                    self.log.debug('{!r}: errno is {}'.format(e, e.args[0]))
+                else:
+                    written.append(row)
+
+            # Cursors only move past rows that were stored, catch-up has to fetch the failed ones again
+            if written:
+                await self._advance_cursors(conn, written)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        # Each flush only takes what was queued when it started, so keep going until the events that came in
+        # meanwhile are written too
+        while self.depth:
+            await self.flush()
+
+    def report(self) -> str:
+        s = self.stats
+        return ('Ingest Queue Status Report:\nDepth: {}, Enqueued: {}, Dropped: {}, Failed: {}\n'
+                'Batches: {}, Rows Flushed: {}, Last Batch: {}, Avg Batch: {:.1f}, Max Batch: {}\n'
+                'Flush Latency (ms): Last {:.1f}, Avg {:.1f}, Max {:.1f}\n'
+                'Deletes: Requested {}, Deleted {}, Cancelled Before Insert {}, Untracked {}\n'
+                'Edits: Requested {}, Coalesced {}, Merged Into Insert {}, Cancelled By Delete {}, '
+                'Rows Updated {} in {} batches, Untracked {}'
+                ''.format(self.depth, s.enqueued, s.dropped, s.failed_rows,
+                          s.batches, s.flushed_rows, s.last_batch_size, s.avg_batch_size, s.max_batch_size,
+                          s.last_flush_latency * 1000, s.avg_flush_latency * 1000, s.max_flush_latency * 1000,
+                          s.delete_requested, s.deleted_rows, s.cancelled_inserts, s.untracked_deletes,
+                          s.edit_requested, s.edits_coalesced, s.edits_merged, s.edits_cancelled,
+                          s.edited_rows, s.edit_batches, s.untracked_edits))
@@ -0,0 +1,167 @@
+import json
+import time
+from typing import Optional
+
+import asyncpg
+
+MESSAGE_COLUMNS = [
+    'messageid', 'reference', 'content', 'attachmenturls', 'sent', 'edittime', 'serverid', 'channelid', 'authorid'
+]
+# Spelled out wherever rows are copied between tables, since MESSAGES may also carry generated columns
+MESSAGE_COLUMN_LIST = ', '.join(MESSAGE_COLUMNS)
+
+
+# A batch passed as one array per column, so it's a single statement and the statement-level counter triggers fire
+# once for all of it. Attachment lists travel as JSON since Postgres arrays can't be ragged
+UNNEST_ROWS = (
+    'SELECT T.MessageID, T.Reference, T.Content, ARRAY(SELECT jsonb_array_elements_text(T.AttachmentURLs::JSONB)), '
+    '       T.Sent, T.EditTime, T.ServerID, T.ChannelID, T.AuthorID '
+    'FROM unnest($1::BIGINT[], $2::BIGINT[], $3::TEXT[], $4::TEXT[], $5::TIMESTAMPTZ[], $6::TIMESTAMPTZ[], '
+    '            $7::BIGINT[], $8::BIGINT[], $9::BIGINT[]) '
+    'AS T(MessageID, Reference, Content, AttachmentURLs, Sent, EditTime, ServerID, ChannelID, AuthorID)'
+)
+
+
+def unnest_args(rows: list[list]) -> list[list]:
+    columns = [list(column) for column in zip(*rows)]
+    columns[3] = [json.dumps(urls) for urls in columns[3]]
+    return columns
+
+
+async def primary_key(conn: asyncpg.Connection, table: str) -> str:
+    # Partitioned MESSAGES carries ServerID (and Sent) in its key, so upserts have to look it up
+    return await conn.fetchval(
+        'SELECT string_agg(A.attname, \', \' ORDER BY array_position(I.indkey, A.attnum)) '
+        'FROM pg_index AS I '
+        'JOIN pg_attribute AS A ON A.attrelid = I.indrelid AND A.attnum = ANY(I.indkey) '
+        'WHERE I.indrelid = $1::regclass AND I.indisprimary',
+        table
+    )
+
+
+def upsert_clause(table: str, key: str) -> str:
+    # Keeps whichever copy of a message was edited last, so overlapping writes are harmless in any order
+    return (
+        ' ON CONFLICT ({0}) DO UPDATE '
+        'SET Content = EXCLUDED.Content, EditTime = EXCLUDED.EditTime '
+        'WHERE EXCLUDED.EditTime > {1}.EditTime '
+        'OR ({1}.EditTime IS NULL AND EXCLUDED.EditTime IS NOT NULL)'.format(key, table)
+    )
+
+
+class MessageLoader:
+    def __init__(
+            self,
+            conn: asyncpg.Connection,
+            batch_size: int,
+            schema: Optional[str] = 'statbot_db',
+            table: str = 'messages',
+            expect_conflicts: bool = False
+    ) -> None:
+        self.conn = conn
+        self.batch_size = batch_size
+        self.schema = schema
+        self.table = table
+        self.expect_conflicts = expect_conflicts
+        self.key: Optional[str] = None
+
+        self.rows_loaded = 0
+        self.batches = 0
+        self.elapsed = 0.0
+
+        self._rows = list()
+
+    @property
+    def qualified_table(self) -> str:
+        return '{}.{}'.format(self.schema, self.table) if self.schema else self.table
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows_loaded / self.elapsed if self.elapsed else 0.0
+
+    async def add(self, row: list) -> None:
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        rows = self._rows
+        self._rows = list()
+        await self.write(rows)
+
+    async def write(self, rows: list[list]) -> None:
+        if not rows:
+            return
+
+        start = time.perf_counter()
+        await self._write(rows)
+        self.elapsed += time.perf_counter() - start
+
+        self.rows_loaded += len(rows)
+        self.batches += 1
+
+    async def _upsert_clause(self) -> str:
+        if self.key is None:
+            self.key = await primary_key(self.conn, self.qualified_table)
+        return upsert_clause(self.table, self.key)
+
+    async def _write(self, rows: list[list]) -> None:
+        raise NotImplementedError
+
+
+class InsertLoader(MessageLoader):
+    async def _write(self, rows: list[list]) -> None:
+        await self.conn.execute(
+            'INSERT INTO {} ({}) {}{}'.format(
+                self.qualified_table, MESSAGE_COLUMN_LIST, UNNEST_ROWS, await self._upsert_clause()
+            ),
+            *unnest_args(rows)
+        )
+
+
+class CopyLoader(MessageLoader):
+    async def _write(self, rows: list[list]) -> None:
+        if not self.expect_conflicts:
+            try:
+                # Savepoint, so a conflict only costs this attempt rather than the caller's transaction
+                async with self.conn.transaction():
+                    await self.conn.copy_records_to_table(
+                        self.table,
+                        schema_name=self.schema,
+                        columns=MESSAGE_COLUMNS,
+                        records=rows
+                    )
+                return
+            except asyncpg.UniqueViolationError:
+                pass
+
+        # COPY can't resolve conflicts, so stage the rows and merge them with a set-based upsert
+        staging = '{}_staging'.format(self.table)
+        await self.conn.execute(
+            'CREATE TEMP TABLE IF NOT EXISTS {} (LIKE {} INCLUDING DEFAULTS INCLUDING GENERATED)'.format(
+                staging, self.qualified_table
+            )
+        )
+        await self.conn.copy_records_to_table(staging, columns=MESSAGE_COLUMNS, records=rows)
+        await self.conn.execute(
+            'INSERT INTO {0} ({1}) '
+            'SELECT DISTINCT ON (MessageID) {1} FROM {2} ORDER BY MessageID, EditTime DESC NULLS LAST{3}'.format(
+                self.qualified_table, MESSAGE_COLUMN_LIST, staging, await self._upsert_clause()
+            )
+        )
+        await self.conn.execute('TRUNCATE {}'.format(staging))
+
+
+LOADERS = {
+    'insert': InsertLoader,
+    'copy': CopyLoader,
+}
+
+
+def create_loader(conn: asyncpg.Connection, method: str, batch_size: int, **kwargs) -> MessageLoader:
+    try:
+        loader_cls = LOADERS[method]
+    except KeyError:
+        raise ValueError('Unknown loader method: {}'.format(method))
+
+    return loader_cls(conn, batch_size, **kwargs)
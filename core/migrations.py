@@ -0,0 +1,79 @@
+import importlib.util
+import logging
+import re
+from pathlib import Path
+
+import asyncpg
+
+log = logging.getLogger('statbot')
+
+MIGRATIONS_DIR = Path(__file__).resolve().parent.parent / 'sql' / 'migrations'
+MIGRATION_FILE = re.compile(r'^(\d{4})_(\w+)\.(sql|py)$')
+
+# Arbitrary, only has to be the same for every bot process sharing the database
+LOCK_ID = 0x57A7B07
+
+
+def discover() -> list[tuple[int, str, Path]]:
+    migrations = list()
+    for path in MIGRATIONS_DIR.iterdir():
+        match = MIGRATION_FILE.match(path.name)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), path))
+
+    return sorted(migrations)
+
+
+async def _applied(conn: asyncpg.Connection) -> set[int]:
+    await conn.execute(
+        'CREATE TABLE IF NOT EXISTS statbot_db.SCHEMA_MIGRATIONS '
+        '(Version    INT, '
+        'Name        TEXT            NOT NULL, '
+        'Applied     TIMESTAMPTZ     DEFAULT now(), '
+        'PRIMARY KEY(Version))'
+    )
+    return {row['version'] for row in await conn.fetch('SELECT Version FROM statbot_db.SCHEMA_MIGRATIONS')}
+
+
+async def _run(conn: asyncpg.Connection, path: Path) -> None:
+    if path.suffix == '.sql':
+        # A multi-statement script runs as one implicit transaction, unless it manages its own
+        await conn.execute(path.read_text())
+        # The scripts set search_path for running them by hand, which mustn't leak into the pool
+        await conn.execute('RESET search_path')
+        return
+
+    # Python migrations cover what plain SQL can't, e.g. building indexes CONCURRENTLY on every partition
+    spec = importlib.util.spec_from_file_location('statbot_migration_{}'.format(path.stem), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    if getattr(module, 'TRANSACTIONAL', True):
+        async with conn.transaction():
+            await module.migrate(conn)
+    else:
+        await module.migrate(conn)
+
+
+async def migrate(conn: asyncpg.Connection) -> list[str]:
+    applied_now = list()
+
+    await conn.execute('SELECT pg_advisory_lock($1)', LOCK_ID)
+    try:
+        applied = await _applied(conn)
+        for version, name, path in discover():
+            if version in applied:
+                continue
+
+            log.info('Applying migration {:04d}_{}'.format(version, name))
+            await _run(conn, path)
+            await conn.execute(
+                'INSERT INTO statbot_db.SCHEMA_MIGRATIONS (Version, Name) VALUES ($1, $2)',
+                version,
+                name
+            )
+            applied_now.append('{:04d}_{}'.format(version, name))
+    finally:
+        await conn.execute('SELECT pg_advisory_unlock($1)', LOCK_ID)
+
+    return applied_now
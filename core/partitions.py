@@ -0,0 +1,261 @@
+import datetime
+import logging
+from typing import Optional
+
+import asyncpg
+
+from core import counters, fulltext, words
+from core.loader import MESSAGE_COLUMN_LIST, MESSAGE_COLUMNS
+
+log = logging.getLogger('statbot')
+
+# Discord launched in 2015, so no message can be older than this
+FIRST_YEAR = 2015
+
+
+async def is_partitioned(conn: asyncpg.Connection) -> bool:
+    return await conn.fetchval(
+        'SELECT EXISTS ('
+        '    SELECT 1 FROM pg_partitioned_table AS P '
+        '    JOIN pg_class AS C ON C.oid = P.partrelid '
+        '    JOIN pg_namespace AS N ON N.oid = C.relnamespace '
+        '    WHERE N.nspname = $1 AND C.relname = $2)',
+        'statbot_db',
+        'messages'
+    )
+
+
+def _partition_name(server_id: Optional[int], parent: str = 'messages') -> str:
+    return '{}_{}'.format(parent, server_id if server_id is not None else 'default')
+
+
+async def create_server_partition(
+        conn: asyncpg.Connection, server_id: Optional[int], by_sent: bool, parent: str = 'messages'
+) -> None:
+    name = _partition_name(server_id, parent)
+    bound = 'FOR VALUES IN ({})'.format(int(server_id)) if server_id is not None else 'DEFAULT'
+    sub = ' PARTITION BY RANGE (Sent)' if by_sent else ''
+
+    await conn.execute(
+        'CREATE TABLE IF NOT EXISTS statbot_db.{} PARTITION OF statbot_db.{} {}{}'.format(name, parent, bound, sub)
+    )
+
+    if by_sent:
+        await create_sent_partitions(conn, name)
+
+
+async def create_sent_partitions(conn: asyncpg.Connection, name: str) -> None:
+    await conn.execute(
+        'CREATE TABLE IF NOT EXISTS statbot_db.{0}_default PARTITION OF statbot_db.{0} DEFAULT'.format(name)
+    )
+    for year in range(FIRST_YEAR, datetime.date.today().year + 2):
+        await conn.execute(
+            'CREATE TABLE IF NOT EXISTS statbot_db.{0}_{1} PARTITION OF statbot_db.{0} '
+            'FOR VALUES FROM (\'{1}-01-01\') TO (\'{2}-01-01\')'.format(name, year, year + 1)
+        )
+
+
+async def _children(conn: asyncpg.Connection, table: str) -> list[asyncpg.Record]:
+    return await conn.fetch(
+        'SELECT C.relname, C.relkind FROM pg_inherits AS I '
+        'JOIN pg_class AS C ON C.oid = I.inhrelid '
+        'WHERE I.inhparent = $1::regclass',
+        'statbot_db.{}'.format(table)
+    )
+
+
+async def _index_state(conn: asyncpg.Connection, name: str) -> Optional[bool]:
+    # None if the index doesn't exist, otherwise whether it's valid
+    return await conn.fetchval(
+        'SELECT I.indisvalid FROM pg_index AS I '
+        'JOIN pg_class AS C ON C.oid = I.indexrelid '
+        'JOIN pg_namespace AS N ON N.oid = C.relnamespace '
+        'WHERE N.nspname = $1 AND C.relname = $2',
+        'statbot_db',
+        name.lower()
+    )
+
+
+async def _create_leaf_index(conn: asyncpg.Connection, table: str, name: str, definition: str) -> None:
+    # A failed CONCURRENTLY build leaves an invalid index behind that IF NOT EXISTS would happily skip
+    if await _index_state(conn, name) is False:
+        await conn.execute('DROP INDEX CONCURRENTLY statbot_db.{}'.format(name))
+
+    await conn.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON statbot_db.{} {}'.format(name, table, definition))
+
+
+async def _create_tree_index(conn: asyncpg.Connection, table: str, name: str, suffix: str, definition: str) -> None:
+    # Partitioned tables can't be indexed CONCURRENTLY, but their leaves can, and attaching those is catalog-only
+    await conn.execute('CREATE INDEX IF NOT EXISTS {} ON ONLY statbot_db.{} {}'.format(name, table, definition))
+
+    for child in await _children(conn, table):
+        child_name = '{}_{}'.format(child['relname'], suffix)
+        if child['relkind'] == 'p':
+            await _create_tree_index(conn, child['relname'], child_name, suffix, definition)
+        else:
+            await _create_leaf_index(conn, child['relname'], child_name, definition)
+
+        attached = await conn.fetchval(
+            'SELECT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = $1::regclass AND inhparent = $2::regclass)',
+            'statbot_db.{}'.format(child_name.lower()),
+            'statbot_db.{}'.format(name.lower())
+        )
+        if not attached:
+            await conn.execute('ALTER INDEX statbot_db.{} ATTACH PARTITION statbot_db.{}'.format(name, child_name))
+
+
+async def create_index_concurrently(conn: asyncpg.Connection, name: str, suffix: str, definition: str) -> None:
+    if await is_partitioned(conn):
+        await _create_tree_index(conn, 'messages', name, suffix, definition)
+    else:
+        await _create_leaf_index(conn, 'messages', name, definition)
+
+
+async def drop_server_partition(conn: asyncpg.Connection, server_id: int) -> None:
+    name = _partition_name(server_id)
+    if await conn.fetchval('SELECT to_regclass($1)', 'statbot_db.{}'.format(name)) is None:
+        # Rows for servers added mid-migration live in the default partition and go with the cascading delete
+        return
+
+    await conn.execute('ALTER TABLE statbot_db.messages DETACH PARTITION statbot_db.{}'.format(name))
+    await conn.execute('DROP TABLE statbot_db.{}'.format(name))
+
+
+async def prepare_migration(conn: asyncpg.Connection, by_sent: bool) -> list[int]:
+    key = 'MessageID, ServerID, Sent' if by_sent else 'MessageID, ServerID'
+
+    async with conn.transaction():
+        await conn.execute(
+            'CREATE TABLE statbot_db.MESSAGES_PARTITIONED '
+            '(MessageID       BIGINT, '
+            'Reference        BIGINT, '
+            'Content          VARCHAR(2000)   NOT NULL, '
+            'AttachmentURLS   TEXT[]          NOT NULL, '
+            'Sent             TIMESTAMPTZ     NOT NULL, '
+            'EditTime         TIMESTAMPTZ, '
+            'ServerID         BIGINT          NOT NULL, '
+            'ChannelID        BIGINT          NOT NULL, '
+            'AuthorID         BIGINT          NOT NULL, '
+            'PRIMARY KEY({}), '
+            'FOREIGN KEY(ServerID) REFERENCES statbot_db.SERVERS(ServerID) '
+            '       ON DELETE CASCADE '
+            '       ON UPDATE CASCADE, '
+            'FOREIGN KEY(ChannelID) REFERENCES statbot_db.CHANNELS(ChannelID) '
+            '       ON DELETE CASCADE '
+            '       ON UPDATE CASCADE) '
+            'PARTITION BY LIST (ServerID)'.format(key)
+        )
+        await conn.execute(
+            'CREATE INDEX idx_MESSAGES_PARTITIONED_AuthorID ON statbot_db.MESSAGES_PARTITIONED (AuthorID)'
+        )
+        await conn.execute(
+            'CREATE INDEX idx_MESSAGES_PARTITIONED_ServerID_AuthorID '
+            'ON statbot_db.MESSAGES_PARTITIONED (ServerID, AuthorID)'
+        )
+        await conn.execute(
+            'CREATE INDEX idx_MESSAGES_PARTITIONED_ServerID_ChannelID_AuthorID '
+            'ON statbot_db.MESSAGES_PARTITIONED (ServerID, ChannelID, AuthorID)'
+        )
+        await conn.execute(
+            'CREATE INDEX idx_MESSAGES_PARTITIONED_ServerID_Sent '
+            'ON statbot_db.MESSAGES_PARTITIONED (ServerID, Sent) INCLUDE (ChannelID, AuthorID)'
+        )
+        if await fulltext.is_enabled(conn):
+            # Still empty, so the column and its index cost nothing here
+            await fulltext.add_column(conn, 'messages_partitioned')
+            await conn.execute(
+                'CREATE INDEX idx_MESSAGES_PARTITIONED_ContentWords '
+                'ON statbot_db.MESSAGES_PARTITIONED USING GIN ({})'.format(fulltext.COLUMN)
+            )
+
+        await create_server_partition(conn, None, by_sent, parent='messages_partitioned')
+        server_ids = [row['serverid'] for row in await conn.fetch('SELECT ServerID FROM statbot_db.SERVERS')]
+        for server_id in server_ids:
+            await create_server_partition(conn, server_id, by_sent, parent='messages_partitioned')
+
+        # Mirror every write made while the copy runs, so nothing is lost between the copy and the swap
+        await conn.execute(
+            'CREATE FUNCTION statbot_db.mirror_messages() RETURNS TRIGGER AS $$ '
+            'BEGIN '
+            '    IF TG_OP = \'DELETE\' THEN '
+            '        DELETE FROM statbot_db.MESSAGES_PARTITIONED '
+            '        WHERE MessageID = OLD.MessageID AND ServerID = OLD.ServerID; '
+            '        RETURN OLD; '
+            '    ELSIF TG_OP = \'UPDATE\' THEN '
+            '        UPDATE statbot_db.MESSAGES_PARTITIONED '
+            '        SET Content = NEW.Content, EditTime = NEW.EditTime '
+            '        WHERE MessageID = NEW.MessageID AND ServerID = NEW.ServerID; '
+            '        RETURN NEW; '
+            '    END IF; '
+            '    INSERT INTO statbot_db.MESSAGES_PARTITIONED ({}) VALUES ({}) ON CONFLICT DO NOTHING; '
+            '    RETURN NEW; '
+            'END; '
+            '$$ LANGUAGE plpgsql'.format(MESSAGE_COLUMN_LIST, ', '.join('NEW.' + c for c in MESSAGE_COLUMNS))
+        )
+        await conn.execute(
+            'CREATE TRIGGER mirror_messages AFTER INSERT OR UPDATE OR DELETE ON statbot_db.MESSAGES '
+            'FOR EACH ROW EXECUTE FUNCTION statbot_db.mirror_messages()'
+        )
+
+    return server_ids
+
+
+async def copy_server(conn: asyncpg.Connection, server_id: int, batch_size: int) -> int:
+    last_id = -1
+    copied = 0
+
+    while True:
+        # FOR SHARE holds off concurrent edits/deletes of the batch until it's copied and the trigger can see it
+        async with conn.transaction():
+            row = await conn.fetchrow(
+                'WITH BATCH AS ('
+                '    SELECT * FROM statbot_db.MESSAGES '
+                '    WHERE ServerID = $1 AND MessageID > $2 '
+                '    ORDER BY MessageID '
+                '    LIMIT $3 '
+                '    FOR SHARE), '
+                'COPIED AS ('
+                '    INSERT INTO statbot_db.MESSAGES_PARTITIONED ({0}) '
+                '    SELECT {0} FROM BATCH '
+                '    ON CONFLICT DO NOTHING) '
+                'SELECT COUNT(*) AS count, MAX(MessageID) AS last_id FROM BATCH'.format(MESSAGE_COLUMN_LIST),
+                server_id,
+                last_id,
+                batch_size
+            )
+
+        if row['count'] == 0:
+            return copied
+
+        copied += row['count']
+        last_id = row['last_id']
+        log.info('Partitioning: copied {} messages from server {}'.format(copied, server_id))
+
+
+async def finish_migration(conn: asyncpg.Connection) -> None:
+    async with conn.transaction():
+        await conn.execute('LOCK TABLE statbot_db.MESSAGES IN ACCESS EXCLUSIVE MODE')
+        await conn.execute('DROP TRIGGER mirror_messages ON statbot_db.MESSAGES')
+        await conn.execute('DROP FUNCTION statbot_db.mirror_messages()')
+        await conn.execute('ALTER TABLE statbot_db.MESSAGES RENAME TO MESSAGES_UNPARTITIONED')
+        await conn.execute('ALTER TABLE statbot_db.MESSAGES_PARTITIONED RENAME TO MESSAGES')
+
+        # Partitions keep the name of the parent they were created under
+        rows = await conn.fetch(
+            'SELECT C.relname FROM pg_inherits AS I '
+            'JOIN pg_class AS C ON C.oid = I.inhrelid '
+            'JOIN pg_namespace AS N ON N.oid = C.relnamespace '
+            'WHERE N.nspname = $1 AND C.relname LIKE $2',
+            'statbot_db',
+            'messages\\_partitioned\\_%'
+        )
+        for row in rows:
+            await conn.execute('ALTER TABLE statbot_db.{} RENAME TO {}'.format(
+                row['relname'], row['relname'].replace('messages_partitioned_', 'messages_', 1)
+            ))
+
+        # The copy never went through the counter triggers, and the table it was copied into had none
+        await counters.remove_triggers(conn, 'MESSAGES_UNPARTITIONED')
+        await counters.install_triggers(conn)
+        await words.remove_triggers(conn, 'MESSAGES_UNPARTITIONED')
+        await words.install_triggers(conn)
@@ -0,0 +1,148 @@
+import asyncio
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import asyncpg
+
+from core import queries
+
+# ingest: live messages, events and owner commands. import: history imports, rebuilds and purges, which hold
+# connections for hours. analytics: vocab, wordcloud and msgcount reads, optionally served by a replica
+POOL_NAMES = ['ingest', 'import', 'analytics']
+
+
+class PoolStats:
+    def __init__(self) -> None:
+        self.acquires = 0
+        self.timeouts = 0
+        self.waited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float) -> None:
+        self.acquires += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        # Anything over a millisecond had to wait for a connection to come back rather than take an idle one
+        if wait > 0.001:
+            self.waited += 1
+
+    @property
+    def avg_wait(self) -> float:
+        return self.total_wait / self.acquires if self.acquires else 0.0
+
+
+class HoldStats:
+    def __init__(self) -> None:
+        self.holds = 0
+        self.total_hold = 0.0
+        self.max_hold = 0.0
+
+    def record(self, hold: float) -> None:
+        self.holds += 1
+        self.total_hold += hold
+        self.max_hold = max(self.max_hold, hold)
+
+    @property
+    def avg_hold(self) -> float:
+        return self.total_hold / self.holds if self.holds else 0.0
+
+
+class TimedPool:
+    def __init__(self, name: str, pool: asyncpg.Pool, acquire_timeout: Optional[float], replica: bool) -> None:
+        self.name = name
+        self.pool = pool
+        self.acquire_timeout = acquire_timeout
+        self.replica = replica
+        self.stats = PoolStats()
+        # How long each command kept a connection checked out, to catch ones holding it through CPU-bound work
+        self.holds: dict[str, HoldStats] = dict()
+
+    @asynccontextmanager
+    async def acquire(self, label: Optional[str] = None) -> AsyncIterator[asyncpg.Connection]:
+        start = time.perf_counter()
+        try:
+            conn = await self.pool.acquire(timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.stats.timeouts += 1
+            raise
+        self.stats.record(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        try:
+            yield conn
+        finally:
+            await self.pool.release(conn)
+            if label is not None:
+                self.holds.setdefault(label, HoldStats()).record(time.perf_counter() - start)
+
+    def report(self) -> str:
+        p = self.pool
+        s = self.stats
+        report = ('{}{}: Min Size: {}, Max Size: {}, Size: {}, Idle: {}\n'
+                  'Acquires: {}, Waited: {}, Timeouts: {}, Wait (ms): Avg {:.1f}, Max {:.1f}'
+                  ''.format(self.name, ' (replica)' if self.replica else '', p.get_min_size(), p.get_max_size(),
+                            p.get_size(), p.get_idle_size(), s.acquires, s.waited, s.timeouts,
+                            s.avg_wait * 1000, s.max_wait * 1000))
+        for label, h in sorted(self.holds.items(), key=lambda item: item[1].max_hold, reverse=True):
+            report += '\n  {}: {} holds, Hold (ms): Avg {:.1f}, Max {:.1f}'.format(
+                label, h.holds, h.avg_hold * 1000, h.max_hold * 1000
+            )
+        return report
+
+
+class RequestScope:
+    # Checks a connection out only once a query really has to run (not at all when every result comes from the
+    # report cache) and hands it back on exit, before the command moves on to CPU-bound work
+    def __init__(self, pool: TimedPool, label: Optional[str]) -> None:
+        self.pool = pool
+        self.label = label
+        self._conn = None
+        self._stack = AsyncExitStack()
+
+    async def connection(self) -> asyncpg.Connection:
+        if self._conn is None:
+            self._conn = await self._stack.enter_async_context(self.pool.acquire(self.label))
+            await self._stack.enter_async_context(self._conn.transaction())
+        return self._conn
+
+    async def __aenter__(self) -> 'RequestScope':
+        return self
+
+    async def __aexit__(self, *exc_info) -> Optional[bool]:
+        self._conn = None
+        return await self._stack.__aexit__(*exc_info)
+
+
+class DatabasePools:
+    def __init__(self) -> None:
+        self.pools: dict[str, TimedPool] = dict()
+
+    def __getitem__(self, name: str) -> TimedPool:
+        return self.pools[name]
+
+    async def open(self, settings: dict[str, dict], analytics_dsn: Optional[str], **connect_kwargs) -> None:
+        for name in POOL_NAMES:
+            replica = name == 'analytics' and bool(analytics_dsn)
+            pool = await asyncpg.create_pool(
+                dsn=analytics_dsn if replica else None,
+                min_size=settings[name]['min_size'],
+                max_size=settings[name]['max_size'],
+                connection_class=queries.CatalogConnection,
+                init=queries.catalog.prepare_all,
+                **(dict() if replica else connect_kwargs)
+            )
+            self.pools[name] = TimedPool(name, pool, settings[name]['acquire_timeout'], replica)
+
+    async def expire_connections(self) -> None:
+        for pool in self.pools.values():
+            await pool.pool.expire_connections()
+
+    async def close(self) -> None:
+        for pool in self.pools.values():
+            await pool.pool.close()
+        self.pools.clear()
+
+    def report(self) -> str:
+        return 'Database Pool Connection Status Report:\n' + '\n'.join(p.report() for p in self.pools.values())
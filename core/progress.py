@@ -0,0 +1,190 @@
+import datetime
+import time
+from typing import Optional
+
+
+class ChannelProgress:
+    def __init__(
+            self,
+            guild_id: int,
+            guild_name: str,
+            channel_id: int,
+            channel_name: str,
+            span_start: datetime.datetime,
+            span_end: datetime.datetime,
+            newest_first: bool
+    ) -> None:
+        self.guild_id = guild_id
+        self.guild_name = guild_name
+        self.channel_id = channel_id
+        self.channel_name = channel_name
+
+        # How far along the import is gets estimated from where the last fetched message falls in the span
+        self.span_start = span_start
+        self.span_end = span_end
+        self.newest_first = newest_first
+        self.position: Optional[datetime.datetime] = None
+
+        self.rows = 0
+        self.fetch_time = 0.0
+        self.write_time = 0.0
+        self.started = time.time()
+        self.finished: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def fraction(self) -> float:
+        if self.finished:
+            return 1.0
+
+        span = (self.span_end - self.span_start).total_seconds()
+        if self.position is None or span <= 0:
+            return 0.0
+
+        if self.newest_first:
+            covered = (self.span_end - self.position).total_seconds()
+        else:
+            covered = (self.position - self.span_start).total_seconds()
+
+        return min(max(covered / span, 0.0), 1.0)
+
+    @property
+    def eta(self) -> Optional[float]:
+        if self.finished:
+            return 0.0
+        if not self.fraction:
+            return None
+        return self.elapsed / self.fraction - self.elapsed
+
+    @property
+    def fetch_share(self) -> float:
+        total = self.fetch_time + self.write_time
+        return self.fetch_time / total if total else 0.0
+
+    def record_fetch(self, seconds: float, position: datetime.datetime) -> None:
+        self.fetch_time += seconds
+        self.position = position
+
+    def record_write(self, rows: int, seconds: float) -> None:
+        self.rows += rows
+        self.write_time += seconds
+
+
+def _format_eta(eta: Optional[float]) -> str:
+    return 'unknown' if eta is None else str(datetime.timedelta(seconds=round(eta)))
+
+
+def _bottleneck(fetch_share: float) -> str:
+    return 'Discord' if fetch_share >= 0.5 else 'Postgres'
+
+
+class ImportProgress:
+    def __init__(self) -> None:
+        self.channels: dict[int, ChannelProgress] = dict()
+        self.planned: dict[int, int] = dict()
+
+    def plan_guild(self, guild_id: int, channel_count: int) -> None:
+        self.planned[guild_id] = channel_count
+        self.channels = {k: v for k, v in self.channels.items() if v.guild_id != guild_id}
+
+    def begin(
+            self,
+            guild_id: int,
+            guild_name: str,
+            channel_id: int,
+            channel_name: str,
+            span_start: datetime.datetime,
+            span_end: datetime.datetime,
+            newest_first: bool
+    ) -> ChannelProgress:
+        progress = ChannelProgress(
+            guild_id, guild_name, channel_id, channel_name, span_start, span_end, newest_first
+        )
+
+        # Catching up after a history import continues the same channel's tally
+        previous = self.channels.get(channel_id)
+        if previous is not None and previous.guild_id == guild_id:
+            progress.rows = previous.rows
+            progress.fetch_time = previous.fetch_time
+            progress.write_time = previous.write_time
+            progress.started = previous.started
+
+        self.channels[channel_id] = progress
+        return progress
+
+    def finish(self, progress: ChannelProgress) -> None:
+        progress.finished = time.time()
+
+    def active(self) -> list[ChannelProgress]:
+        return [p for p in self.channels.values() if not p.finished]
+
+    def guild_summary(self, guild_id: int) -> dict:
+        channels = [p for p in self.channels.values() if p.guild_id == guild_id]
+        total = max(self.planned.get(guild_id, 0), len(channels))
+        rows = sum(p.rows for p in channels)
+        fetch_time = sum(p.fetch_time for p in channels)
+        write_time = sum(p.write_time for p in channels)
+
+        started = min((p.started for p in channels), default=time.time())
+        elapsed = time.time() - started
+        # Planned channels that haven't started yet count as 0% done
+        fraction = sum(p.fraction for p in channels) / total if total else 0.0
+
+        return {
+            'channels': total,
+            'channels_done': sum(1 for p in channels if p.finished),
+            'rows': rows,
+            'rows_per_second': rows / elapsed if elapsed else 0.0,
+            'fetch_seconds': fetch_time,
+            'write_seconds': write_time,
+            'fraction': fraction,
+            'eta_seconds': elapsed / fraction - elapsed if fraction else None,
+        }
+
+    def metrics(self) -> dict:
+        active = self.active()
+        fetch_time = sum(p.fetch_time for p in self.channels.values())
+        write_time = sum(p.write_time for p in self.channels.values())
+        etas = [p.eta for p in active if p.eta is not None]
+
+        return {
+            'import_active_channels': len(active),
+            'import_rows_total': sum(p.rows for p in self.channels.values()),
+            'import_rows_per_second': sum(p.rows_per_second for p in active),
+            'import_fetch_seconds_total': fetch_time,
+            'import_write_seconds_total': write_time,
+            'import_eta_seconds': max(etas) if etas else 0.0,
+        }
+
+    def report(self) -> str:
+        if not self.channels:
+            return 'No imports have run since startup.'
+
+        lines = ['Import Progress Report:']
+        for guild_id in dict.fromkeys(p.guild_id for p in self.channels.values()):
+            s = self.guild_summary(guild_id)
+            name = next(p.guild_name for p in self.channels.values() if p.guild_id == guild_id)
+            total_time = s['fetch_seconds'] + s['write_seconds']
+            fetch_share = s['fetch_seconds'] / total_time if total_time else 0.0
+
+            lines.append('{}: {}/{} channels, {} rows, {:.0f} rows/s, {:.0%} done, ETA {}, '
+                         'fetch {:.0f}s / write {:.0f}s (bottleneck: {})'
+                         ''.format(name, s['channels_done'], s['channels'], s['rows'], s['rows_per_second'],
+                                   s['fraction'], _format_eta(s['eta_seconds']), s['fetch_seconds'],
+                                   s['write_seconds'], _bottleneck(fetch_share)))
+
+            for p in self.active():
+                if p.guild_id != guild_id:
+                    continue
+                lines.append('    #{}: {} rows, {:.0f} rows/s, {:.0%} done, ETA {}, fetch {:.0%} of time'
+                             ''.format(p.channel_name, p.rows, p.rows_per_second, p.fraction,
+                                       _format_eta(p.eta), p.fetch_share))
+
+        return '\n'.join(lines)
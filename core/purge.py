@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from core import rebuild
+from core.statbot import StatBot
+from core.utility import get_conn
+
+
+class PurgeJob:
+    def __init__(self, kind: str, target_id: int, server_id: int, name: str) -> None:
+        self.kind = kind
+        self.target_id = target_id
+        self.server_id = server_id
+        self.name = name
+
+        self.deleted = 0
+        self.batches = 0
+        self.queued = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.done = asyncio.Event()
+
+    @property
+    def state(self) -> str:
+        if self.finished:
+            return 'done'
+        return 'purging' if self.started else 'queued'
+
+    def report(self) -> str:
+        elapsed = (self.finished or time.time()) - (self.started or time.time())
+        return '[{}] {} {} ({}): {} messages deleted in {} batches, {:.0f}s'.format(
+            self.state, self.kind, self.name, self.target_id, self.deleted, self.batches, elapsed
+        )
+
+
+class Purger:
+    def __init__(self, bot: StatBot, batch_size: int, delay: float) -> None:
+        self.bot = bot
+        self.batch_size = batch_size
+        self.delay = delay
+        self.log = logging.getLogger('statbot')
+
+        self.jobs: dict[tuple[str, int], PurgeJob] = dict()
+        self._queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def enqueue(self, kind: str, target_id: int, server_id: int, name: str) -> PurgeJob:
+        if self.is_pending(kind, target_id):
+            return self.jobs[(kind, target_id)]
+
+        job = PurgeJob(kind, target_id, server_id, name)
+        self.jobs[(kind, target_id)] = job
+        self._queue.put_nowait(job)
+        return job
+
+    def is_pending(self, kind: str, target_id: int) -> bool:
+        job = self.jobs.get((kind, target_id))
+        return job is not None and job.state != 'done'
+
+    async def wait_for(self, kind: str, target_id: int) -> None:
+        job = self.jobs.get((kind, target_id))
+        if job is not None:
+            await job.done.wait()
+
+    async def resume(self) -> None:
+        async with get_conn(self.bot, 'import') as conn:
+            servers = await conn.fetch('SELECT ServerID FROM statbot_db.SERVERS WHERE Removing')
+            # A removed server's purge covers its channels too
+            channels = await conn.fetch(
+                'SELECT C.ChannelID, C.ServerID '
+                'FROM statbot_db.CHANNELS AS C, statbot_db.SERVERS AS S '
+                'WHERE C.ServerID = S.ServerID AND C.Removing AND NOT S.Removing'
+            )
+
+        for row in servers:
+            self.enqueue('server', row['serverid'], row['serverid'], str(row['serverid']))
+        for row in channels:
+            self.enqueue('channel', row['channelid'], row['serverid'], str(row['channelid']))
+
+    async def _run(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._purge(job)
+            except Exception as e:
+                self.log.error('PURGE FAILED: {} {}'.format(job.kind, job.target_id))
+                self.log.error('{!r}: errno is {}'.format(e, e.args[0] if e.args else None))
+                # Leave it flagged as Removing so it's picked up again on the next startup
+                self.jobs.pop((job.kind, job.target_id), None)
+                job.done.set()
+
+    async def _purge(self, job: PurgeJob) -> None:
+        job.started = time.time()
+        if job.kind == 'retired':
+            await self._drop_retired(job)
+            return
+
+        column = 'ServerID' if job.kind == 'server' else 'ChannelID'
+
+        while True:
+            # Bounded batches keep lock hold times and WAL bursts small while live ingestion carries on
+            async with get_conn(self.bot, 'import') as conn:
+                status = await conn.execute(
+                    'DELETE FROM statbot_db.MESSAGES '
+                    'WHERE ServerID = $1 AND MessageID IN ('
+                    '    SELECT MessageID FROM statbot_db.MESSAGES '
+                    '    WHERE ServerID = $1 AND {} = $2 '
+                    '    LIMIT $3)'.format(column),
+                    job.server_id,
+                    job.target_id,
+                    self.batch_size
+                )
+
+            deleted = int(status.split()[-1])
+            job.deleted += deleted
+            job.batches += 1
+
+            # Writes that were in flight when the removal started can still land after a short batch, so only an
+            # empty one means the parent row can go without a cascade over leftover messages
+            if not deleted:
+                break
+
+            await asyncio.sleep(self.delay)
+
+        async with get_conn(self.bot, 'import') as conn:
+            if job.kind == 'server':
+                await conn.execute('DELETE FROM statbot_db.SERVERS WHERE ServerID = $1', job.target_id)
+            else:
+                await conn.execute('DELETE FROM statbot_db.CHANNELS WHERE ChannelID = $1', job.target_id)
+
+        # Reports computed while the purge was running may still include some of the messages
+        self.bot.report_cache.bump(job.server_id)
+        job.finished = time.time()
+        job.done.set()
+        self.log.info('Purge complete: ' + job.report())
+
+    async def _drop_retired(self, job: PurgeJob) -> None:
+        # The rows a rebuild replaced, already out of MESSAGES, so the table can go without touching live data
+        async with get_conn(self.bot, 'import') as conn:
+            await rebuild.drop_retired(conn, job.server_id)
+
+        job.finished = time.time()
+        job.done.set()
+        self.log.info('Purge complete: ' + job.report())
+
+    def report(self) -> str:
+        if not self.jobs:
+            return 'No purges have run since startup.'
+
+        return 'Purge Status Report:\n' + '\n'.join(job.report() for job in self.jobs.values())
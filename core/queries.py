@@ -0,0 +1,275 @@
+import time
+from typing import Any, Optional
+
+import asyncpg
+
+# Statements run for every message or every report, prepared once on each pooled connection
+
+BLOCKED_USERS = 'SELECT UserID FROM statbot_db.USERS WHERE Restricted = $1'
+
+MSGCOUNT_SERVER = (
+    'SELECT COALESCE(SUM(Messages) FILTER (WHERE AuthorID = $2), 0) AS count, '
+    '       COALESCE(SUM(Messages), 0) AS total '
+    'FROM statbot_db.MESSAGE_COUNTS '
+    'WHERE ServerID = $1'
+)
+MSGCOUNT_CHANNEL = (
+    'SELECT COALESCE(SUM(Messages) FILTER (WHERE AuthorID = $3), 0) AS count, '
+    '       COALESCE(SUM(Messages), 0) AS total '
+    'FROM statbot_db.MESSAGE_COUNTS '
+    'WHERE ServerID = $1 AND ChannelID = $2'
+)
+
+WORDCLOUD_COUNTS = (
+    'SELECT W.Word AS word, SUM(W.Uses)::BIGINT AS uses '
+    'FROM statbot_db.WORD_COUNTS AS W '
+    'WHERE W.ServerID = $1 AND W.AuthorID = $2 '
+    'GROUP BY W.Word'
+)
+
+WORD_COUNTS_CHANNEL_MEMBER = (
+    "SELECT W.authorid, W.word, SUM(W.uses)::BIGINT as counts "
+    "FROM statbot_db.WORD_COUNTS as W "
+    "WHERE W.serverid = $1 AND W.channelid = $2 AND W.authorid = $3 AND W.word NOT LIKE ':%' "
+    "GROUP BY W.authorid, W.word"
+)
+WORD_COUNTS_CHANNEL = (
+    "SELECT W.authorid, W.word, SUM(W.uses)::BIGINT as counts "
+    "FROM statbot_db.WORD_COUNTS as W "
+    "WHERE W.serverid = $1 AND W.channelid = $2 AND W.word NOT LIKE ':%' "
+    "GROUP BY W.authorid, W.word"
+)
+WORD_COUNTS_MEMBER = (
+    "SELECT W.authorid, W.word, SUM(W.uses)::BIGINT as counts "
+    "FROM statbot_db.WORD_COUNTS as W "
+    "WHERE W.serverid = $1 AND W.authorid = $2 AND W.word NOT LIKE ':%' "
+    "GROUP BY W.authorid, W.word"
+)
+WORD_COUNTS_SERVER = (
+    "SELECT W.authorid, W.word, SUM(W.uses)::BIGINT as counts "
+    "FROM statbot_db.WORD_COUNTS as W "
+    "WHERE W.serverid = $1 AND W.word NOT LIKE ':%' "
+    "GROUP BY W.authorid, W.word"
+)
+
+# Grade always reads a window of messages, GRADE_WINDOW_DAYS unless the command was given one
+GRADE_MSGS_CHANNEL_MEMBER = (
+    "SELECT M.authorid, M.content as msgs, M.sent "
+    "FROM statbot_db.MESSAGES as M "
+    "WHERE M.serverid = $1 AND M.authorid = $2 AND M.channelid = $3 "
+    "AND M.sent >= $4 AND M.sent < $5 "
+    "ORDER BY M.sent"
+)
+GRADE_MSGS_CHANNEL = (
+    "SELECT M.authorid, M.content as msgs, M.sent "
+    "FROM statbot_db.MESSAGES as M "
+    "WHERE M.serverid = $1 AND M.channelid = $2 "
+    "AND M.sent >= $3 AND M.sent < $4 "
+    "ORDER BY M.sent"
+)
+GRADE_MSGS_MEMBER = (
+    "SELECT M.authorid, M.content as msgs, M.sent "
+    "FROM statbot_db.MESSAGES as M "
+    "WHERE M.serverid = $1 AND M.authorid = $2 AND M.sent >= $3 AND M.sent < $4 "
+    "ORDER BY M.sent"
+)
+GRADE_MSGS_SERVER = (
+    "SELECT M.authorid, M.content as msgs, M.sent "
+    "FROM statbot_db.MESSAGES as M "
+    "WHERE M.serverid = $1 AND M.sent >= $2 AND M.sent < $3 "
+    "ORDER BY M.sent"
+)
+
+# The counting tables have no notion of time, so time-ranged reports split the messages in the window into words the
+# same way the counts were made. The Sent range goes through idx_MESSAGES_ServerID_Sent
+WINDOW_WORD_COUNTS_CHANNEL_MEMBER = (
+    "SELECT M.authorid, W.word, COUNT(*)::BIGINT as counts "
+    "FROM statbot_db.MESSAGES as M, statbot_db.message_words(M.content) as W(word) "
+    "WHERE M.serverid = $1 AND M.channelid = $2 AND M.authorid = $3 AND M.sent >= $4 AND M.sent < $5 "
+    "AND W.word NOT LIKE ':%' "
+    "GROUP BY M.authorid, W.word"
+)
+WINDOW_WORD_COUNTS_CHANNEL = (
+    "SELECT M.authorid, W.word, COUNT(*)::BIGINT as counts "
+    "FROM statbot_db.MESSAGES as M, statbot_db.message_words(M.content) as W(word) "
+    "WHERE M.serverid = $1 AND M.channelid = $2 AND M.sent >= $3 AND M.sent < $4 AND W.word NOT LIKE ':%' "
+    "GROUP BY M.authorid, W.word"
+)
+WINDOW_WORD_COUNTS_MEMBER = (
+    "SELECT M.authorid, W.word, COUNT(*)::BIGINT as counts "
+    "FROM statbot_db.MESSAGES as M, statbot_db.message_words(M.content) as W(word) "
+    "WHERE M.serverid = $1 AND M.authorid = $2 AND M.sent >= $3 AND M.sent < $4 AND W.word NOT LIKE ':%' "
+    "GROUP BY M.authorid, W.word"
+)
+WINDOW_WORD_COUNTS_SERVER = (
+    "SELECT M.authorid, W.word, COUNT(*)::BIGINT as counts "
+    "FROM statbot_db.MESSAGES as M, statbot_db.message_words(M.content) as W(word) "
+    "WHERE M.serverid = $1 AND M.sent >= $2 AND M.sent < $3 AND W.word NOT LIKE ':%' "
+    "GROUP BY M.authorid, W.word"
+)
+
+WINDOW_WORDCLOUD_COUNTS = (
+    'SELECT W.Word AS word, COUNT(*)::BIGINT AS uses '
+    'FROM statbot_db.MESSAGES AS M, statbot_db.message_words(M.Content) AS W(Word) '
+    'WHERE M.ServerID = $1 AND M.AuthorID = $2 AND M.Sent >= $3 AND M.Sent < $4 '
+    'GROUP BY W.Word'
+)
+
+WINDOW_MSGCOUNT_SERVER = (
+    'SELECT COUNT(*) FILTER (WHERE AuthorID = $2) AS count, COUNT(*) AS total '
+    'FROM statbot_db.MESSAGES '
+    'WHERE ServerID = $1 AND Sent >= $3 AND Sent < $4'
+)
+WINDOW_MSGCOUNT_CHANNEL = (
+    'SELECT COUNT(*) FILTER (WHERE AuthorID = $3) AS count, COUNT(*) AS total '
+    'FROM statbot_db.MESSAGES '
+    'WHERE ServerID = $1 AND ChannelID = $2 AND Sent >= $4 AND Sent < $5'
+)
+
+QUERIES = {
+    'blocked_users': BLOCKED_USERS,
+    'msgcount_server': MSGCOUNT_SERVER,
+    'msgcount_channel': MSGCOUNT_CHANNEL,
+    'wordcloud_counts': WORDCLOUD_COUNTS,
+    'word_counts_channel_member': WORD_COUNTS_CHANNEL_MEMBER,
+    'word_counts_channel': WORD_COUNTS_CHANNEL,
+    'word_counts_member': WORD_COUNTS_MEMBER,
+    'word_counts_server': WORD_COUNTS_SERVER,
+    'grade_msgs_channel_member': GRADE_MSGS_CHANNEL_MEMBER,
+    'grade_msgs_channel': GRADE_MSGS_CHANNEL,
+    'grade_msgs_member': GRADE_MSGS_MEMBER,
+    'grade_msgs_server': GRADE_MSGS_SERVER,
+    'window_word_counts_channel_member': WINDOW_WORD_COUNTS_CHANNEL_MEMBER,
+    'window_word_counts_channel': WINDOW_WORD_COUNTS_CHANNEL,
+    'window_word_counts_member': WINDOW_WORD_COUNTS_MEMBER,
+    'window_word_counts_server': WINDOW_WORD_COUNTS_SERVER,
+    'window_wordcloud_counts': WINDOW_WORDCLOUD_COUNTS,
+    'window_msgcount_server': WINDOW_MSGCOUNT_SERVER,
+    'window_msgcount_channel': WINDOW_MSGCOUNT_CHANNEL,
+}
+
+# What the report commands pass for each numbered parameter, so the statements can be run outside of them (explainhot)
+REPORT_PARAMETERS = {
+    'msgcount_server': ('server', 'author'),
+    'msgcount_channel': ('server', 'channel', 'author'),
+    'wordcloud_counts': ('server', 'author'),
+    'word_counts_channel_member': ('server', 'channel', 'author'),
+    'word_counts_channel': ('server', 'channel'),
+    'word_counts_member': ('server', 'author'),
+    'word_counts_server': ('server',),
+    'grade_msgs_channel_member': ('server', 'author', 'channel', 'since', 'until'),
+    'grade_msgs_channel': ('server', 'channel', 'since', 'until'),
+    'grade_msgs_member': ('server', 'author', 'since', 'until'),
+    'grade_msgs_server': ('server', 'since', 'until'),
+    'window_word_counts_channel_member': ('server', 'channel', 'author', 'since', 'until'),
+    'window_word_counts_channel': ('server', 'channel', 'since', 'until'),
+    'window_word_counts_member': ('server', 'author', 'since', 'until'),
+    'window_word_counts_server': ('server', 'since', 'until'),
+    'window_wordcloud_counts': ('server', 'author', 'since', 'until'),
+    'window_msgcount_server': ('server', 'author', 'since', 'until'),
+    'window_msgcount_channel': ('server', 'channel', 'author', 'since', 'until'),
+}
+
+
+class CatalogConnection(asyncpg.Connection):
+    # asyncpg.Connection has __slots__, a subclass is the only place to keep per-connection statements
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.statements: dict[str, asyncpg.prepared_stmt.PreparedStatement] = dict()
+
+
+class StatementStats:
+    def __init__(self) -> None:
+        self.prepares = 0
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed: float) -> None:
+        self.calls += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    @property
+    def avg_time(self) -> float:
+        return self.total_time / self.calls if self.calls else 0.0
+
+
+class QueryCatalog:
+    def __init__(self, queries: dict[str, str]) -> None:
+        self.queries = queries
+        self.names = {query: name for name, query in queries.items()}
+        self.stats = {name: StatementStats() for name in queries}
+
+    async def prepare_all(self, conn: asyncpg.Connection) -> None:
+        # Pool init hook. The schema may still be missing tables until migrations ran, those statements are prepared
+        # on first use instead
+        for name in self.queries:
+            try:
+                await self._prepare(conn, name)
+            except asyncpg.PostgresError:
+                pass
+
+    async def _prepare(self, conn: asyncpg.Connection, name: str) -> asyncpg.prepared_stmt.PreparedStatement:
+        stmt = await conn.prepare(self.queries[name])
+        conn.statements[name] = stmt
+        self.stats[name].prepares += 1
+        return stmt
+
+    async def statement(self, conn: asyncpg.Connection, query: str) -> asyncpg.prepared_stmt.PreparedStatement:
+        # Takes the SQL so callers like fetch_as_dataframe work the same for ad hoc queries
+        name = self.names.get(query)
+        if name is None or not hasattr(conn, 'statements'):
+            return await conn.prepare(query)
+
+        stmt = conn.statements.get(name)
+        if stmt is None:
+            stmt = await self._prepare(conn, name)
+        return stmt
+
+    def forget(self, conn: asyncpg.Connection, query: str) -> None:
+        # A statement prepared before a schema change (e.g. a partition swap) can't be run anymore
+        name = self.names.get(query)
+        if name is not None and hasattr(conn, 'statements'):
+            conn.statements.pop(name, None)
+
+    def record(self, query: str, elapsed: float) -> None:
+        name = self.names.get(query)
+        if name is not None:
+            self.stats[name].record(elapsed)
+
+    async def _run(self, conn: asyncpg.Connection, query: str, method: str, *args: Any) -> Any:
+        start = time.perf_counter()
+        stmt = await self.statement(conn, query)
+        try:
+            result = await getattr(stmt, method)(*args)
+        except (asyncpg.InvalidCachedStatementError, asyncpg.exceptions.OutdatedSchemaCacheError):
+            self.forget(conn, query)
+            # Inside a transaction the failed statement already aborted it, so only retry outside of one
+            if conn.is_in_transaction():
+                raise
+            stmt = await self.statement(conn, query)
+            result = await getattr(stmt, method)(*args)
+
+        self.record(query, time.perf_counter() - start)
+        return result
+
+    async def fetch(self, conn: asyncpg.Connection, query: str, *args: Any) -> list[asyncpg.Record]:
+        return await self._run(conn, query, 'fetch', *args)
+
+    async def fetchrow(self, conn: asyncpg.Connection, query: str, *args: Any) -> Optional[asyncpg.Record]:
+        return await self._run(conn, query, 'fetchrow', *args)
+
+    async def fetchval(self, conn: asyncpg.Connection, query: str, *args: Any) -> Any:
+        return await self._run(conn, query, 'fetchval', *args)
+
+    def report(self) -> str:
+        report = 'Prepared Statement Report:\n'
+        for name, s in sorted(self.stats.items(), key=lambda item: item[1].total_time, reverse=True):
+            report += '{}: {} calls, {} prepares, Total {:.0f} ms, Avg {:.1f} ms, Max {:.1f} ms\n'.format(
+                name, s.calls, s.prepares, s.total_time * 1000, s.avg_time * 1000, s.max_time * 1000
+            )
+        return report
+
+
+catalog = QueryCatalog(QUERIES)
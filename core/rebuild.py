@@ -0,0 +1,241 @@
+import logging
+
+import asyncpg
+
+from core import counters, partitions, words
+from core.loader import MESSAGE_COLUMN_LIST
+
+log = logging.getLogger('statbot')
+
+
+def shadow_name(server_id: int) -> str:
+    return 'messages_rebuild_{}'.format(server_id)
+
+
+def _retired_name(server_id: int) -> str:
+    return 'messages_retired_{}'.format(server_id)
+
+
+async def install_mirror(conn: asyncpg.Connection) -> None:
+    # Live writes for a server that has a shadow table are copied into it, so the rebuild misses nothing. A write that
+    # waited on the swap finds the shadow renamed or gone, which is no reason to fail the write itself
+    await conn.execute(
+        'CREATE OR REPLACE FUNCTION statbot_db.mirror_rebuild() RETURNS TRIGGER AS $$ '
+        'DECLARE '
+        '    shadow TEXT; '
+        'BEGIN '
+        '    IF current_setting(\'statbot.rebuild_apply\', true) = \'on\' THEN '
+        '        RETURN NULL; '
+        '    END IF; '
+        '    IF TG_OP = \'DELETE\' THEN '
+        '        shadow := \'messages_rebuild_\' || OLD.ServerID; '
+        '    ELSE '
+        '        shadow := \'messages_rebuild_\' || NEW.ServerID; '
+        '    END IF; '
+        '    IF to_regclass(\'statbot_db.\' || shadow) IS NULL THEN '
+        '        RETURN NULL; '
+        '    END IF; '
+        '    BEGIN '
+        '        IF TG_OP = \'DELETE\' THEN '
+        '            EXECUTE format(\'DELETE FROM statbot_db.%I WHERE MessageID = $1\', shadow) USING OLD.MessageID; '
+        '        ELSIF TG_OP = \'UPDATE\' THEN '
+        '            EXECUTE format(\'UPDATE statbot_db.%I SET Content = $1, EditTime = $2 WHERE MessageID = $3\', '
+        '                           shadow) '
+        '            USING NEW.Content, NEW.EditTime, NEW.MessageID; '
+        '        ELSE '
+        '            EXECUTE format(\'INSERT INTO statbot_db.%I ({0}) SELECT {0} FROM (SELECT ($1).*) AS N \''
+        '                           \'ON CONFLICT DO NOTHING\', shadow) USING NEW; '
+        '        END IF; '
+        '    EXCEPTION WHEN undefined_table THEN '
+        '        NULL; '
+        '    END; '
+        '    RETURN NULL; '
+        'END; '
+        '$$ LANGUAGE plpgsql'.format(MESSAGE_COLUMN_LIST)
+    )
+    await conn.execute('DROP TRIGGER IF EXISTS mirror_rebuild ON statbot_db.MESSAGES')
+    await conn.execute(
+        'CREATE TRIGGER mirror_rebuild AFTER INSERT OR UPDATE OR DELETE ON statbot_db.MESSAGES '
+        'FOR EACH ROW EXECUTE FUNCTION statbot_db.mirror_rebuild()'
+    )
+
+
+async def remove_mirror(conn: asyncpg.Connection) -> None:
+    await conn.execute('DROP TRIGGER IF EXISTS mirror_rebuild ON statbot_db.MESSAGES')
+    await conn.execute('DROP FUNCTION IF EXISTS statbot_db.mirror_rebuild()')
+
+
+async def create_shadow(conn: asyncpg.Connection, server_id: int, partitioned: bool, by_sent: bool) -> str:
+    name = shadow_name(server_id)
+    await conn.execute('DROP TABLE IF EXISTS statbot_db.{}'.format(name))
+
+    # Shaped like the server's partition, keys, indexes and CHECK included, so attaching it is catalog-only.
+    # Without partitions the shadow is only ever read back by MessageID, so it just needs its key
+    if partitioned:
+        like = 'LIKE statbot_db.MESSAGES INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING INDEXES'
+    else:
+        like = 'LIKE statbot_db.MESSAGES INCLUDING DEFAULTS INCLUDING GENERATED, PRIMARY KEY(MessageID)'
+    sub = ' PARTITION BY RANGE (Sent)' if partitioned and by_sent else ''
+
+    await conn.execute(
+        'CREATE TABLE statbot_db.{} ('
+        '    {}, '
+        '    CHECK (ServerID = {}), '
+        '    FOREIGN KEY(ServerID) REFERENCES statbot_db.SERVERS(ServerID) '
+        '       ON DELETE CASCADE '
+        '       ON UPDATE CASCADE, '
+        '    FOREIGN KEY(ChannelID) REFERENCES statbot_db.CHANNELS(ChannelID) '
+        '       ON DELETE CASCADE '
+        '       ON UPDATE CASCADE){}'.format(name, like, int(server_id), sub)
+    )
+
+    if partitioned and by_sent:
+        await partitions.create_sent_partitions(conn, name)
+
+    return name
+
+
+async def _rename_children(conn: asyncpg.Connection, parent: str, old_prefix: str, new_prefix: str) -> None:
+    rows = await conn.fetch(
+        'SELECT C.relname FROM pg_inherits AS I '
+        'JOIN pg_class AS C ON C.oid = I.inhrelid '
+        'WHERE I.inhparent = $1::regclass',
+        'statbot_db.{}'.format(parent)
+    )
+    for row in rows:
+        await conn.execute('ALTER TABLE statbot_db.{} RENAME TO {}'.format(
+            row['relname'], row['relname'].replace(old_prefix, new_prefix, 1)
+        ))
+
+
+async def _apply_upserts(conn: asyncpg.Connection, shadow: str, batch_size: int) -> int:
+    changed = 0
+    last = 0
+    while True:
+        async with conn.transaction():
+            # These rows came from the shadow, the mirror doesn't need to write them back
+            await conn.execute('SET LOCAL statbot.rebuild_apply = \'on\'')
+            upper = await conn.fetchval(
+                'SELECT MAX(MessageID) FROM ('
+                '    SELECT MessageID FROM statbot_db.{} WHERE MessageID > $1 ORDER BY MessageID LIMIT $2) AS B'
+                ''.format(shadow),
+                last,
+                batch_size
+            )
+            if upper is None:
+                return changed
+
+            status = await conn.execute(
+                'INSERT INTO statbot_db.MESSAGES ({0}) SELECT {0} FROM statbot_db.{1} '
+                'WHERE MessageID > $1 AND MessageID <= $2 '
+                'ON CONFLICT (MessageID) DO UPDATE '
+                'SET Reference = EXCLUDED.Reference, Content = EXCLUDED.Content, '
+                '    AttachmentURLS = EXCLUDED.AttachmentURLS, EditTime = EXCLUDED.EditTime '
+                'WHERE (MESSAGES.Reference, MESSAGES.Content, MESSAGES.AttachmentURLS, MESSAGES.EditTime) '
+                '    IS DISTINCT FROM '
+                '    (EXCLUDED.Reference, EXCLUDED.Content, EXCLUDED.AttachmentURLS, EXCLUDED.EditTime)'.format(
+                    MESSAGE_COLUMN_LIST, shadow
+                ),
+                last,
+                upper
+            )
+
+        changed += int(status.split()[-1])
+        last = upper
+
+
+async def _apply_deletes(conn: asyncpg.Connection, server_id: int, shadow: str, batch_size: int) -> int:
+    deleted = 0
+    last = 0
+    while True:
+        upper = await conn.fetchval(
+            'SELECT MAX(MessageID) FROM ('
+            '    SELECT MessageID FROM statbot_db.MESSAGES WHERE ServerID = $1 AND MessageID > $2 '
+            '    ORDER BY MessageID LIMIT $3) AS B',
+            server_id,
+            last,
+            batch_size
+        )
+        if upper is None:
+            return deleted
+
+        status = await conn.execute(
+            'DELETE FROM statbot_db.MESSAGES AS M '
+            'WHERE M.ServerID = $1 AND M.MessageID > $2 AND M.MessageID <= $3 AND NOT EXISTS ('
+            '    SELECT 1 FROM statbot_db.{} AS S WHERE S.MessageID = M.MessageID)'.format(shadow),
+            server_id,
+            last,
+            upper
+        )
+
+        deleted += int(status.split()[-1])
+        last = upper
+
+
+async def swap_shadow(conn: asyncpg.Connection, server_id: int, partitioned: bool, batch_size: int) -> None:
+    name = shadow_name(server_id)
+    retired = _retired_name(server_id)
+
+    if partitioned:
+        live = 'messages_{}'.format(server_id)
+
+        # Catalog changes and the server's recount happen under the lock, the old partition is dropped afterwards
+        async with conn.transaction():
+            if await conn.fetchval('SELECT to_regclass($1)', 'statbot_db.{}'.format(live)) is not None:
+                await conn.execute('ALTER TABLE statbot_db.messages DETACH PARTITION statbot_db.{}'.format(live))
+                await _rename_children(conn, live, live, retired)
+                await conn.execute('ALTER TABLE statbot_db.{} RENAME TO {}'.format(live, retired))
+            else:
+                # Servers added mid-migration keep their rows in the default partition
+                await conn.execute('DELETE FROM statbot_db.messages_default WHERE ServerID = $1', server_id)
+
+            await _rename_children(conn, name, name, live)
+            await conn.execute('ALTER TABLE statbot_db.{} RENAME TO {}'.format(name, live))
+            await conn.execute('ALTER TABLE statbot_db.messages ATTACH PARTITION statbot_db.{} FOR VALUES IN ({})'
+                               ''.format(live, int(server_id)))
+
+            # Attaching a partition bypasses the counter triggers. Recounting before commit means msgcount and vocab
+            # never see counters that don't match the attached rows, and a failed recount undoes the swap
+            await counters.recount_server(conn, server_id)
+            await words.recount_server(conn, server_id)
+        return
+
+    # Without partitions the rows can't be swapped wholesale, so the difference is written in batches of short
+    # transactions, which lock at most batch_size live rows at a time. The mirror keeps the shadow current meanwhile,
+    # so live writes land in both and the two stay in step
+    deleted = await _apply_deletes(conn, server_id, name, batch_size)
+    upserted = await _apply_upserts(conn, name, batch_size)
+
+    # The cut-over only has to stop the mirror, renaming takes a lock on the shadow and nothing else
+    async with conn.transaction():
+        await conn.execute('ALTER TABLE statbot_db.{} RENAME TO {}'.format(name, retired))
+
+    log.info('Rebuild of server {}: {} stale messages removed, {} added or changed'.format(
+        server_id, deleted, upserted
+    ))
+
+
+async def drop_retired(conn: asyncpg.Connection, server_id: int) -> None:
+    await conn.execute('DROP TABLE IF EXISTS statbot_db.{}'.format(_retired_name(server_id)))
+
+
+async def drop_shadow(conn: asyncpg.Connection, server_id: int) -> None:
+    await conn.execute('DROP TABLE IF EXISTS statbot_db.{}'.format(shadow_name(server_id)))
+
+
+async def drop_stale(conn: asyncpg.Connection) -> int:
+    # Shadow and retired tables left behind by a rebuild that was interrupted
+    rows = await conn.fetch(
+        'SELECT C.relname FROM pg_class AS C '
+        'JOIN pg_namespace AS N ON N.oid = C.relnamespace '
+        'WHERE N.nspname = $1 AND C.relkind IN (\'r\', \'p\') AND NOT C.relispartition '
+        'AND (C.relname LIKE $2 OR C.relname LIKE $3)',
+        'statbot_db',
+        'messages\\_rebuild\\_%',
+        'messages\\_retired\\_%'
+    )
+    for row in rows:
+        await conn.execute('DROP TABLE statbot_db.{}'.format(row['relname']))
+
+    await remove_mirror(conn)
+    return len(rows)
@@ -0,0 +1,79 @@
+import time
+from enum import Enum
+from typing import Optional
+
+import asyncpg
+
+
+class Status(Enum):
+    AVAILABLE = 1
+    NOT_ADDED = 2
+    IMPORTING = 3
+
+
+class GuildRegistry:
+    def __init__(self) -> None:
+        self.servers: dict[int, bool] = dict()
+        self.channels: dict[int, tuple[int, bool]] = dict()
+
+        # Every lookup is answered from memory, untracked counts the ones for servers and channels that aren't added
+        self.tracked = 0
+        self.untracked = 0
+        self.refreshes = 0
+        self.last_refresh: Optional[float] = None
+        self.last_refresh_duration = 0.0
+
+    async def refresh(self, conn: asyncpg.Connection) -> None:
+        start = time.perf_counter()
+
+        server_rows = await conn.fetch('SELECT ServerID, Importing FROM statbot_db.SERVERS WHERE NOT Removing')
+        channel_rows = await conn.fetch(
+            'SELECT C.ChannelID, C.ServerID, C.Importing '
+            'FROM statbot_db.CHANNELS AS C, statbot_db.SERVERS AS S '
+            'WHERE C.ServerID = S.ServerID AND NOT C.Removing AND NOT S.Removing'
+        )
+
+        self.servers = {row['serverid']: row['importing'] for row in server_rows}
+        self.channels = {row['channelid']: (row['serverid'], row['importing']) for row in channel_rows}
+
+        self.refreshes += 1
+        self.last_refresh = time.time()
+        self.last_refresh_duration = time.perf_counter() - start
+
+    def _status(self, importing: Optional[bool]) -> Status:
+        if importing is None:
+            self.untracked += 1
+            return Status.NOT_ADDED
+
+        self.tracked += 1
+        return Status.IMPORTING if importing else Status.AVAILABLE
+
+    def server_status(self, server_id: int) -> Status:
+        return self._status(self.servers.get(server_id))
+
+    def channel_status(self, channel_id: int) -> Status:
+        entry = self.channels.get(channel_id)
+        return self._status(entry[1] if entry else None)
+
+    def set_server(self, server_id: int, importing: bool) -> None:
+        self.servers[server_id] = importing
+
+    def remove_server(self, server_id: int) -> None:
+        self.servers.pop(server_id, None)
+        self.channels = {k: v for k, v in self.channels.items() if v[0] != server_id}
+
+    def set_channel(self, channel_id: int, server_id: int, importing: bool) -> None:
+        self.channels[channel_id] = (server_id, importing)
+
+    def remove_channel(self, channel_id: int) -> None:
+        self.channels.pop(channel_id, None)
+
+    def report(self) -> str:
+        age = '{:.0f}s ago'.format(time.time() - self.last_refresh) if self.last_refresh else 'never'
+
+        return ('Registry Status Report:\nServers: {}, Channels: {}\n'
+                'Lookups: {}, Tracked: {}, Untracked: {}\n'
+                'Refreshes: {}, Last Refresh: {} ({:.1f} ms)'
+                ''.format(len(self.servers), len(self.channels), self.tracked + self.untracked, self.tracked,
+                          self.untracked,
+                          self.refreshes, age, self.last_refresh_duration * 1000))
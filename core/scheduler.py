@@ -0,0 +1,340 @@
+import asyncio
+import logging
+import math
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Iterable, Optional
+
+import asyncpg
+import discord
+
+from core.importer import ImportPlanner
+from core.registry import Status
+from core.statbot import StatBot
+from core.utility import get_conn
+
+# Lower runs first. Servers nobody can use yet beat catch-up of servers that already serve commands
+PRIORITY_IMPORTING = 0
+PRIORITY_CATCH_UP = 100
+
+RETRY_AFTER = re.compile(r'Retrying in ([\d.]+) seconds')
+
+
+class RateLimitMonitor(logging.Handler):
+    # discord.py retries 429s itself and doesn't expose the rate limit headers, but it logs every one it hits
+    def __init__(self) -> None:
+        super().__init__(level=logging.WARNING)
+        self.hits = 0
+        self.last_hit = 0.0
+        self.resume_at = 0.0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        match = RETRY_AFTER.search(record.getMessage())
+        if match is None:
+            return
+
+        self.hits += 1
+        self.last_hit = time.time()
+        self.resume_at = max(self.resume_at, self.last_hit + float(match.group(1)))
+
+    @property
+    def paused_for(self) -> float:
+        return max(self.resume_at - time.time(), 0.0)
+
+
+def estimate_size(text_channel: discord.TextChannel, after: Optional[int]) -> int:
+    # Message counts aren't known up front, so the time span left to fetch stands in for them
+    start = discord.utils.snowflake_time(after) if after else text_channel.created_at
+    end = (discord.utils.snowflake_time(text_channel.last_message_id) if text_channel.last_message_id
+           else discord.utils.utcnow())
+    days = max((end - start).total_seconds() / 86400, 0.0)
+    return int(math.log2(days + 1))
+
+
+class ImportScheduler:
+    MAX_ATTEMPTS = 3
+    POLL_INTERVAL = 30.0
+    # Time without a 429 before the budget is allowed to grow back
+    RECOVERY_WINDOW = 60.0
+
+    def __init__(self, bot: StatBot, planner: ImportPlanner, max_workers: int, guild_workers: int) -> None:
+        self.bot = bot
+        self.planner = planner
+        self.max_workers = max_workers
+        self.guild_workers = guild_workers
+        self.log = logging.getLogger('statbot')
+
+        self.budget = max_workers
+        self.rate_limits = RateLimitMonitor()
+        self.completed = 0
+        self.failed = 0
+
+        self._running: dict[int, asyncio.Task] = dict()
+        self._running_servers: dict[int, int] = dict()
+        self._seen_hits = 0
+        self._paused = False
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            logging.getLogger('discord.http').addHandler(self.rate_limits)
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        logging.getLogger('discord.http').removeHandler(self.rate_limits)
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in self._running.values():
+            task.cancel()
+
+    async def recover(self) -> None:
+        # Jobs that were running when the bot went down start over
+        async with get_conn(self.bot, 'import') as conn:
+            status = await conn.execute(
+                'UPDATE statbot_db.IMPORT_JOBS SET State = $1 '
+                'WHERE State = $2',
+                'queued',
+                'running'
+            )
+        self.log.info('Requeued {} interrupted import jobs'.format(status.split()[-1]))
+
+    async def enqueue(
+            self, conn: asyncpg.Connection, text_channel: discord.TextChannel, after: Optional[int] = None
+    ) -> None:
+        if self.bot.registry.server_status(text_channel.guild.id) == Status.AVAILABLE:
+            base = PRIORITY_CATCH_UP
+        else:
+            base = PRIORITY_IMPORTING
+
+        # A job that ran out of attempts keeps its server from being served, asking for the channel again retries it
+        await conn.execute(
+            'DELETE FROM statbot_db.IMPORT_JOBS WHERE ChannelID = $1 AND State = $2',
+            text_channel.id,
+            'failed'
+        )
+        # A channel only ever has one pending job, which has to start from the oldest cursor asked for. Enqueued marks
+        # a running job as asked for again, so it's queued once more instead of being deleted when it completes
+        await conn.execute(
+            'INSERT INTO statbot_db.IMPORT_JOBS (ServerID, ChannelID, Priority, After) '
+            'VALUES ($1, $2, $3, $4) '
+            'ON CONFLICT (ChannelID) WHERE State IN (\'queued\', \'running\') DO UPDATE '
+            'SET After = LEAST(IMPORT_JOBS.After, EXCLUDED.After), '
+            '    Priority = LEAST(IMPORT_JOBS.Priority, EXCLUDED.Priority), '
+            '    Enqueued = clock_timestamp()',
+            text_channel.guild.id,
+            text_channel.id,
+            base + estimate_size(text_channel, after),
+            after
+        )
+        self._wakeup.set()
+
+    async def enqueue_guild(
+            self,
+            guild: discord.Guild,
+            text_channels: Iterable[discord.TextChannel],
+            cursors: Optional[dict[int, Optional[int]]] = None
+    ) -> None:
+        text_channels = list(text_channels)
+        cursors = cursors or dict()
+        self.planner.progress.plan_guild(guild.id, len(text_channels))
+
+        async with get_conn(self.bot, 'import') as conn:
+            async with conn.transaction():
+                for text_channel in text_channels:
+                    await self.enqueue(conn, text_channel, after=cursors.get(text_channel.id))
+
+            # With nothing to import there's no job whose completion would mark the server as imported
+            if not text_channels:
+                await self._finish_guild(conn, guild.id)
+
+        self.log.info('Queued {} channel imports for {}'.format(len(text_channels), guild.name))
+
+    async def forget_guild(self, conn: asyncpg.Connection, server_id: int) -> None:
+        # Part of the transaction that marks the server as Removing, so no job for it can be claimed afterwards
+        await conn.execute('DELETE FROM statbot_db.IMPORT_JOBS WHERE ServerID = $1', server_id)
+
+    async def cancel_guild(self, server_id: int) -> None:
+        # Imports that are already running would keep writing while the server is purged
+        job_ids = [job_id for job_id, s in self._running_servers.items() if s == server_id]
+        await self._cancel(job_ids)
+
+        if job_ids:
+            self.log.info('Cancelled {} running imports for server {}'.format(len(job_ids), server_id))
+
+    @asynccontextmanager
+    async def paused(self) -> AsyncIterator[None]:
+        # Running imports are stopped and queued again, their loaders hold on to the MESSAGES they started with.
+        # Imports are checkpointed, so they carry on from the last stored batch afterwards
+        self._paused = True
+        try:
+            job_ids = list(self._running)
+            await self._cancel(job_ids)
+            await self._requeue(job_ids)
+            self.log.info('Import scheduler paused, {} running imports requeued'.format(len(job_ids)))
+            yield
+        finally:
+            self._paused = False
+            self._wakeup.set()
+
+    async def _cancel(self, job_ids: list[int]) -> None:
+        tasks = [self._running[job_id] for job_id in job_ids if job_id in self._running]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _requeue(self, job_ids: list[int]) -> None:
+        # Not a failed attempt, so it doesn't count towards MAX_ATTEMPTS
+        async with get_conn(self.bot, 'import') as conn:
+            await conn.execute(
+                'UPDATE statbot_db.IMPORT_JOBS SET State = $1, Attempts = Attempts - 1 '
+                'WHERE JobID = ANY($2::BIGINT[]) AND State = $3',
+                'queued',
+                job_ids,
+                'running'
+            )
+
+    def _adjust_budget(self) -> None:
+        # Halve the budget whenever Discord pushes back, and grow it by one once things have been quiet for a while
+        if self.rate_limits.hits > self._seen_hits:
+            self._seen_hits = self.rate_limits.hits
+            self.budget = max(1, self.budget // 2)
+            self.log.info('Rate limited by Discord, import budget lowered to {}'.format(self.budget))
+        elif time.time() - self.rate_limits.last_hit > self.RECOVERY_WINDOW:
+            self.budget = min(self.max_workers, self.budget + 1)
+
+    async def _claim(self) -> Optional[asyncpg.Record]:
+        async with get_conn(self.bot, 'import') as conn:
+            return await conn.fetchrow(
+                'UPDATE statbot_db.IMPORT_JOBS SET State = $1, Attempts = Attempts + 1 '
+                'WHERE JobID = ('
+                '    SELECT JobID FROM statbot_db.IMPORT_JOBS AS J '
+                '    WHERE J.State = $2 AND ('
+                '        SELECT COUNT(*) FROM statbot_db.IMPORT_JOBS AS R '
+                '        WHERE R.ServerID = J.ServerID AND R.State = $1) < $3 '
+                '    ORDER BY J.Priority, J.JobID '
+                '    LIMIT 1 '
+                '    FOR UPDATE SKIP LOCKED) '
+                'RETURNING JobID, ServerID, ChannelID, After, Enqueued',
+                'running',
+                'queued',
+                self.guild_workers
+            )
+
+    async def _run(self) -> None:
+        await self.bot.wait_until_ready()
+
+        while True:
+            self._wakeup.clear()
+            self._adjust_budget()
+
+            if self.rate_limits.paused_for:
+                await asyncio.sleep(self.rate_limits.paused_for)
+                continue
+
+            job = None
+            if len(self._running) < self.budget and not self._paused:
+                try:
+                    job = await self._claim()
+                except Exception as e:
+                    self.log.error('FAILED TO CLAIM IMPORT JOB: {!r}'.format(e))
+
+            # Claimed while the scheduler was being paused
+            if job is not None and self._paused:
+                await self._requeue([job['jobid']])
+                job = None
+
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._running[job['jobid']] = asyncio.create_task(self._execute(job))
+            self._running_servers[job['jobid']] = job['serverid']
+
+    async def _execute(self, job: asyncpg.Record) -> None:
+        try:
+            text_channel = self.bot.get_channel(job['channelid'])
+            if not isinstance(text_channel, discord.TextChannel):
+                raise LookupError('Channel {} is no longer visible'.format(job['channelid']))
+
+            if text_channel.permissions_for(text_channel.guild.me).read_message_history:
+                await self.planner.import_channel(text_channel, after=job['after'])
+        except Exception as e:
+            self.log.error('FAILED TO IMPORT CHANNEL: {}'.format(job['channelid']))
+            self.log.error('{!r}: errno is {}'.format(e, e.args[0] if e.args else None))
+            await self._fail(job, e)
+        else:
+            await self._complete(job)
+        finally:
+            self._running.pop(job['jobid'], None)
+            self._running_servers.pop(job['jobid'], None)
+            self._wakeup.set()
+
+    async def _fail(self, job: asyncpg.Record, error: Exception) -> None:
+        self.failed += 1
+        async with get_conn(self.bot, 'import') as conn:
+            state = await conn.fetchval(
+                'UPDATE statbot_db.IMPORT_JOBS '
+                'SET State = CASE WHEN Attempts < $1 THEN \'queued\' ELSE \'failed\' END, Error = $2 '
+                'WHERE JobID = $3 '
+                'RETURNING State',
+                self.MAX_ATTEMPTS,
+                repr(error),
+                job['jobid']
+            )
+
+        if state == 'failed':
+            self.log.error('IMPORT GAVE UP: Channel {} failed {} times, server {} stays unavailable until it is '
+                           'imported again'.format(job['channelid'], self.MAX_ATTEMPTS, job['serverid']))
+
+    async def _complete(self, job: asyncpg.Record) -> None:
+        self.completed += 1
+        # Catch-up imports add to servers that are already serving reports
+        self.bot.report_cache.bump(job['serverid'])
+        async with get_conn(self.bot, 'import') as conn:
+            status = await conn.execute(
+                'DELETE FROM statbot_db.IMPORT_JOBS WHERE JobID = $1 AND Enqueued = $2',
+                job['jobid'],
+                job['enqueued']
+            )
+            if status == 'DELETE 0':
+                await conn.execute(
+                    'UPDATE statbot_db.IMPORT_JOBS SET State = $1, Attempts = 0 WHERE JobID = $2',
+                    'queued',
+                    job['jobid']
+                )
+                self._wakeup.set()
+            await self._finish_guild(conn, job['serverid'])
+
+    async def _finish_guild(self, conn: asyncpg.Connection, server_id: int) -> None:
+        # The server becomes usable once the last of its channels is through. A failed channel would be missing from
+        # its reports, so that holds it back too
+        status = await conn.execute(
+            'UPDATE statbot_db.SERVERS SET Importing = $1 '
+            'WHERE ServerID = $2 AND Importing AND NOT Removing AND NOT EXISTS ('
+            '    SELECT 1 FROM statbot_db.IMPORT_JOBS '
+            '    WHERE ServerID = $2 AND State IN (\'queued\', \'running\', \'failed\'))',
+            False,
+            server_id
+        )
+
+        if status != 'UPDATE 0':
+            self.bot.registry.set_server(server_id, importing=False)
+            self.log.info('Server {} import complete'.format(server_id))
+
+    async def report(self) -> str:
+        async with get_conn(self.bot, 'import') as conn:
+            rows = await conn.fetch('SELECT State, COUNT(*) AS count FROM statbot_db.IMPORT_JOBS GROUP BY State')
+        counts = {row['state']: row['count'] for row in rows}
+
+        return ('Import Queue Status Report:\nQueued: {}, Running: {}, Failed: {}\n'
+                'Completed: {}, Failed Attempts: {} (since startup)\n'
+                'Budget: {}/{} workers, Rate Limits Hit: {}, Paused For: {:.1f}s'
+                ''.format(counts.get('queued', 0), counts.get('running', 0), counts.get('failed', 0),
+                          self.completed, self.failed,
+                          self.budget, self.max_workers, self.rate_limits.hits, self.rate_limits.paused_for))
@@ -4,7 +4,12 @@ from concurrent.futures.process import ProcessPoolExecutor
 
 import asyncpg
 import discord
-from core import bot_config
+from core import bot_config, migrations, partitions
+from core.cache import ReportCache
+from core.ingest import MessageBuffer
+from core.loader import primary_key
+from core.pools import DatabasePools
+from core.registry import GuildRegistry
 from discord.ext import commands
 
 
@@ -35,7 +40,17 @@ class StatBot(commands.Bot):
         self.shutting_down = False
 
         self.exit_code = 0
-        self.pool = None
+        self.pools = DatabasePools()
+        self.message_buffer = None
+        self.registry = GuildRegistry()
+        # Versions are bumped once the primary commits, a lagging replica could still hand back the old data to be
+        # cached under the new version. So reports are only cached when they're read from the primary
+        self.report_cache = ReportCache(
+            0 if bot_config.DB_ANALYTICS_DSN else bot_config.REPORT_CACHE_MAX_ENTRIES,
+            bot_config.REPORT_CACHE_MAX_MB * 1024 * 1024,
+            bot_config.REPORT_CACHE_TTL
+        )
+        self.messages_partitioned = False
 
     async def setup_hook(self) -> None:
         self.process_executor = ProcessPoolExecutor(os.cpu_count())
@@ -49,9 +64,9 @@ class StatBot(commands.Bot):
             print('Opened ' + str(os.cpu_count()) + ' processes successfully')
 
         try:
-            self.pool = await asyncpg.create_pool(
-                min_size=2,
-                max_size=15,
+            await self.pools.open(
+                bot_config.DB_POOLS,
+                bot_config.DB_ANALYTICS_DSN,
                 host=bot_config.DB_HOST,
                 port=bot_config.DB_PORT,
                 user=bot_config.DB_USER,
@@ -66,6 +81,31 @@ class StatBot(commands.Bot):
             print('{!r}: errno is {}'.format(e, e.args[0]))
             return
 
+        async with self.pools['ingest'].acquire() as conn:
+            try:
+                applied = await migrations.migrate(conn)
+            except (asyncpg.PostgresError, OSError) as e:
+                print('Migration Exception: Unable to bring the database schema up to date')
+                print('{!r}: errno is {}'.format(e, e.args[0] if e.args else None))
+                return
+            if applied:
+                print('Applied database migrations: {}'.format(', '.join(applied)))
+
+            await self.registry.refresh(conn)
+            self.messages_partitioned = await partitions.is_partitioned(conn)
+            message_key = await primary_key(conn, 'statbot_db.messages')
+        print('Loaded {} tracked servers and {} channels'.format(len(self.registry.servers), len(self.registry.channels)))
+
+        self.message_buffer = MessageBuffer(
+            self.pools['ingest'],
+            key=message_key,
+            batch_size=bot_config.INGEST_BATCH_SIZE,
+            flush_interval=bot_config.INGEST_FLUSH_INTERVAL,
+            max_queue=bot_config.INGEST_MAX_QUEUE,
+            report_cache=self.report_cache
+        )
+        self.message_buffer.start()
+
         for extension in self.initial_extensions:
             if extension == '':
                 continue
@@ -84,12 +124,19 @@ class StatBot(commands.Bot):
                 print('No further extensions will be loaded ')
 
     async def close(self) -> None:
+        if self.message_buffer is not None:
+            try:
+                await self.message_buffer.close()
+                print('Flushed ingest queue')
+            except Exception as e:
+                print('Something went wrong while trying to flush the ingest queue')
+                print('{}: {}'.format(type(e).__name__, e))
+
         try:
-            await asyncio.wait_for(self.pool.close(), timeout=120)
-            self.pool = None
-            print('Closed DB connection pool')
+            await asyncio.wait_for(self.pools.close(), timeout=120)
+            print('Closed DB connection pools')
         except (Exception, asyncio.CancelledError) as e:
-            print('Something went wrong while trying to close the DB connection pool')
+            print('Something went wrong while trying to close the DB connection pools')
             print('{}: {}'.format(type(e).__name__, e))
 
         self.process_executor.shutdown()
@@ -0,0 +1,97 @@
+import datetime
+from typing import Optional
+
+from discord.ext import commands
+
+DATE_FORMAT = '%Y-%m-%d'
+
+# Stand-ins for an open end, so every time-ranged query takes the same two Sent parameters
+EARLIEST = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+LATEST = datetime.datetime.max.replace(tzinfo=datetime.timezone.utc)
+
+
+def _parse_date(value: str) -> datetime.datetime:
+    try:
+        return datetime.datetime.strptime(value, DATE_FORMAT).replace(tzinfo=datetime.timezone.utc)
+    except ValueError:
+        raise commands.BadArgument('Dates need to look like 2022-06-30, `{}` doesn\'t.'.format(value))
+
+
+def _days_back(days: int) -> datetime.datetime:
+    # Start of the first of the last N days, today being one of them
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return now.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=days - 1)
+
+
+class TimeRange:
+    # Half-open [since, until) window over Sent, whole UTC days so results can be cached for the rest of the day
+    def __init__(
+            self, since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None,
+            days: Optional[int] = None
+    ) -> None:
+        self.since = since
+        self.until = until
+        self.days = days
+
+    @classmethod
+    def last_days(cls, days: int) -> 'TimeRange':
+        return cls(since=_days_back(days), days=days)
+
+    def __bool__(self) -> bool:
+        return self.since is not None or self.until is not None
+
+    @property
+    def bounds(self) -> tuple[datetime.datetime, datetime.datetime]:
+        return self.since or EARLIEST, self.until or LATEST
+
+    @property
+    def key(self) -> tuple[Optional[datetime.datetime], Optional[datetime.datetime]]:
+        return self.since, self.until
+
+    def update(self, token: str) -> bool:
+        # Reads a since:YYYY-MM-DD, until:YYYY-MM-DD or days:N argument, returns False for anything else
+        name, _, value = token.partition(':')
+        name = name.lower()
+        if not value or name not in ('since', 'until', 'days'):
+            return False
+
+        if name == 'since':
+            self.since = _parse_date(value)
+            self.days = None
+        elif name == 'until':
+            # The whole day is included
+            self.until = _parse_date(value) + datetime.timedelta(days=1)
+        else:
+            if not value.isdigit() or int(value) < 1:
+                raise commands.BadArgument('`days:` takes a number of days, like `days:30`.')
+            self.days = int(value)
+            self.since = _days_back(self.days)
+
+        if self.since is not None and self.until is not None and self.since >= self.until:
+            raise commands.BadArgument('The start of the time range has to be before its end.')
+        return True
+
+    def describe(self) -> str:
+        last_day = self.until - datetime.timedelta(days=1) if self.until else None
+        if self.days is not None and self.until is None:
+            return 'in the last {} days'.format(self.days)
+        if self.since and last_day:
+            return 'between {} and {}'.format(self.since.strftime(DATE_FORMAT), last_day.strftime(DATE_FORMAT))
+        if self.since:
+            return 'since {}'.format(self.since.strftime(DATE_FORMAT))
+        if last_day:
+            return 'up to {}'.format(last_day.strftime(DATE_FORMAT))
+        return 'in total'
+
+
+class TimeRangeConverter(commands.Converter):
+    # For a keyword-only parameter, which gets the rest of the message, e.g. "days:30" or "since:2022-01-01"
+    async def convert(self, ctx: commands.Context, argument: str) -> TimeRange:
+        time_range = TimeRange()
+        for token in argument.split():
+            if not time_range.update(token):
+                raise commands.BadArgument(
+                    'I don\'t understand `{}`. Time ranges look like `since:2022-01-01`, `until:2022-06-30` or '
+                    '`days:30`.'.format(token)
+                )
+        return time_range
@@ -1,13 +1,21 @@
+import io
+import os
+import sys
+import time
 from contextlib import asynccontextmanager
-from enum import Enum
 from functools import partial
+from typing import Optional
 
 import asyncpg
 import discord
 import numpy as np
 import pandas as pd
 from PIL import Image
+from discord.ext import commands
 
+from core import bot_config, queries
+from core.pools import RequestScope
+from core.registry import Status
 from core.statbot import StatBot
 
 
@@ -25,75 +33,194 @@ async def get_image_array(loop, image_name):
 
 
 @asynccontextmanager
-async def get_conn(bot: StatBot) -> None:
+async def get_conn(bot: StatBot, pool: str = 'ingest', label: Optional[str] = None) -> None:
     # ENTER SECTION
-    conn = await bot.pool.acquire()
-
-    try:
+    async with bot.pools[pool].acquire(label) as conn:
         yield conn
-    finally:
-        # EXIT SECTION
-        await bot.pool.release(connection=conn)
+    # EXIT SECTION
+
+
+def request_scope(bot: StatBot, ctx: commands.Context, pool: str = 'analytics') -> RequestScope:
+    return RequestScope(bot.pools[pool], ctx.command.qualified_name)
+
+
+class ResultTooLarge(Exception):
+    pass
+
+
+class FetchStats:
+    def __init__(self) -> None:
+        self.queries = 0
+        self.rows = 0
+        self.chunks = 0
+        self.too_large = 0
+        self.max_rows = 0
+        self.max_bytes = 0
+        self.peak_rss = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, rows: int, chunks: int, size: int, rss: int, latency: float) -> None:
+        self.queries += 1
+        self.rows += rows
+        self.chunks += chunks
+        self.max_rows = max(self.max_rows, rows)
+        self.max_bytes = max(self.max_bytes, size)
+        self.peak_rss = max(self.peak_rss, rss)
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
 
+    @property
+    def avg_rows(self) -> float:
+        return self.rows / self.queries if self.queries else 0.0
+
+    @property
+    def avg_latency(self) -> float:
+        return self.total_latency / self.queries if self.queries else 0.0
+
+    def report(self) -> str:
+        return ('DataFrame Fetch Status Report:\nQueries: {}, Rows: {}, Chunks: {}, Too Large: {}\n'
+                'Rows per Query: Avg {:.1f}, Max {}, Largest Result: {:.1f} MB, Peak RSS After Fetch: {:.1f} MB\n'
+                'Fetch Latency (ms): Avg {:.1f}, Max {:.1f}'
+                ''.format(self.queries, self.rows, self.chunks, self.too_large,
+                          self.avg_rows, self.max_rows, self.max_bytes / 1024 / 1024, self.peak_rss / 1024 / 1024,
+                          self.avg_latency * 1000, self.max_latency * 1000))
+
+
+fetch_stats = FetchStats()
+
+
+def _rss() -> int:
+    # Current resident set size, ru_maxrss would only ever give the peak of the whole process
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+async def _read_cursor(
+        con: asyncpg.Connection, stmt: asyncpg.prepared_stmt.PreparedStatement, args: tuple, chunk_size: int,
+        max_bytes: int
+) -> tuple[list[list], int, int, int]:
+    data = [list() for _ in stmt.get_attributes()]
+    rows = 0
+    chunks = 0
+    size = 0
+    # Cursors only exist inside a transaction, this is a savepoint if the caller already opened one
+    async with con.transaction():
+        cursor = await stmt.cursor(*args)
+        while True:
+            records = await cursor.fetch(chunk_size)
+            if not records:
+                break
+
+            rows += len(records)
+            chunks += 1
+            for column, values in zip(data, zip(*records)):
+                column.extend(values)
+                # Rough, but counts the strings themselves, which is what makes message results big
+                size += sum(map(sys.getsizeof, values)) + 8 * len(values)
+            del records
+
+            if size > max_bytes:
+                fetch_stats.too_large += 1
+                raise ResultTooLarge('Query result went over {} MB after {} rows'.format(
+                    max_bytes // 1024 // 1024, rows
+                ))
+
+    return data, rows, chunks, size
+
+
+async def fetch_as_dataframe(
+        con: asyncpg.Connection,
+        query: str,
+        *args: str,
+        chunk_size: int = bot_config.FETCH_CHUNK_SIZE,
+        max_bytes: int = bot_config.FETCH_MAX_MB * 1024 * 1024
+) -> pd.DataFrame:
+    # Rows come over from a server-side cursor a chunk at a time and go straight into per-column lists, so only one
+    # chunk of asyncpg.Records is alive at once instead of the whole result next to the DataFrame built from it
+    start = time.perf_counter()
+    stmt = await queries.catalog.statement(con, query)
+    try:
+        data, rows, chunks, size = await _read_cursor(con, stmt, args, chunk_size, max_bytes)
+    except (asyncpg.InvalidCachedStatementError, asyncpg.exceptions.OutdatedSchemaCacheError):
+        # Only the savepoint was rolled back, so the statement can be prepared again and rerun
+        queries.catalog.forget(con, query)
+        stmt = await queries.catalog.statement(con, query)
+        data, rows, chunks, size = await _read_cursor(con, stmt, args, chunk_size, max_bytes)
 
-async def fetch_as_dataframe(con: asyncpg.Connection, query: str, *args: str) -> pd.DataFrame:
-    stmt = await con.prepare(query)
     columns = [a.name for a in stmt.get_attributes()]
-    data = await stmt.fetch(*args)
-    return pd.DataFrame(columns=columns, data=data)
-
-
-class Status(Enum):
-    AVAILABLE = 1
-    NOT_ADDED = 2
-    IMPORTING = 3
-
-
-async def server_status(conn: asyncpg.Connection, server: discord.Guild, lock_for_update: bool = False) -> Status:
-    if lock_for_update:
-        row = await conn.fetchrow(
-            'SELECT Importing '
-            'FROM statbot_db.SERVERS '
-            'WHERE ServerID = $1 FOR UPDATE',
-            server.id
-        )
-    else:
-        row = await conn.fetchrow(
-            'SELECT Importing '
-            'FROM statbot_db.SERVERS '
-            'WHERE ServerID = $1 FOR KEY SHARE',
-            server.id
-        )
-
-    if not row:
-        return Status.NOT_ADDED
-    elif row['importing'] is True:
-        return Status.IMPORTING
-
-    return Status.AVAILABLE
-
-
-async def channel_status(
-        conn: asyncpg.Connection, channel: discord.TextChannel, lock_for_update: bool = False
-) -> Status:
-    if lock_for_update:
-        row = await conn.fetchrow(
-            'SELECT Importing '
-            'FROM statbot_db.CHANNELS '
-            'WHERE ChannelID = $1 FOR UPDATE',
-            channel.id
-        )
-    else:
-        row = await conn.fetchrow(
-            'SELECT Importing '
-            'FROM statbot_db.CHANNELS '
-            'WHERE ChannelID = $1 FOR KEY SHARE',
-            channel.id
-        )
-
-    if not row:
-        return Status.NOT_ADDED
-    elif row['importing'] is True:
-        return Status.IMPORTING
-
-    return Status.AVAILABLE
+    df = pd.DataFrame(dict(zip(columns, data)), columns=columns)
+    elapsed = time.perf_counter() - start
+    fetch_stats.record(rows, chunks, size, _rss(), elapsed)
+    queries.catalog.record(query, elapsed)
+    return df
+
+
+# Postgres types read_csv shouldn't guess at, a message like "123" or "nan" has to stay text
+TEXT_TYPES = {'text', 'varchar', 'bpchar', 'name', 'json', 'jsonb'}
+TIMESTAMP_TYPES = {'timestamp', 'timestamptz', 'date'}
+
+
+async def copy_as_dataframe(
+        con: asyncpg.Connection,
+        query: str,
+        *args: str,
+        max_bytes: int = bot_config.FETCH_MAX_MB * 1024 * 1024
+) -> pd.DataFrame:
+    # Bulk path for big results: COPY streams the whole result as CSV and pandas' C parser turns it into typed columns
+    # in one pass, instead of asyncpg decoding a Record per row. Unlike fetch_as_dataframe, NULL and empty text both
+    # come back as NaN, and arrays stay in their text form
+    start = time.perf_counter()
+    # Only the column types are needed from the statement, COPY itself can't run a prepared one
+    stmt = await queries.catalog.statement(con, query)
+    attributes = stmt.get_attributes()
+    buffer = io.BytesIO()
+    chunks = 0
+
+    async def write(data: bytes) -> None:
+        nonlocal chunks
+        chunks += 1
+        buffer.write(data)
+        if buffer.tell() > max_bytes:
+            fetch_stats.too_large += 1
+            raise ResultTooLarge('Query result went over {} MB of CSV'.format(max_bytes // 1024 // 1024))
+
+    await con.copy_from_query(query, *args, output=write, format='csv')
+
+    size = buffer.tell()
+    if size == 0:
+        fetch_stats.record(0, chunks, size, _rss(), time.perf_counter() - start)
+        queries.catalog.record(query, time.perf_counter() - start)
+        return pd.DataFrame(columns=[a.name for a in attributes])
+
+    buffer.seek(0)
+    df = pd.read_csv(
+        buffer,
+        names=[a.name for a in attributes],
+        dtype={a.name: object for a in attributes if a.type.name in TEXT_TYPES},
+        true_values=['t'],
+        false_values=['f'],
+        keep_default_na=False,
+        na_values=['']
+    )
+    buffer.close()
+
+    for a in attributes:
+        if a.type.name in TIMESTAMP_TYPES:
+            df[a.name] = pd.to_datetime(df[a.name], utc=a.type.name == 'timestamptz')
+
+    elapsed = time.perf_counter() - start
+    fetch_stats.record(len(df.index), chunks, size, _rss(), elapsed)
+    queries.catalog.record(query, elapsed)
+    return df
+
+
+def server_status(bot: StatBot, server: discord.Guild) -> Status:
+    return bot.registry.server_status(server.id)
+
+
+def channel_status(bot: StatBot, channel: discord.TextChannel) -> Status:
+    return bot.registry.channel_status(channel.id)
@@ -0,0 +1,184 @@
+import string
+from typing import Optional
+
+import asyncpg
+
+# Command invocations never made it into wordclouds, so they don't get counted at all
+with open('wordcloud/prefixes.txt', 'r') as prefixes_file:
+    COMMAND_PREFIXES = '^(' + '|'.join(p for p in prefixes_file.read().split('\n') if p) + ')'
+
+# Postgres (ARE) spellings of constant.REGEX, applied to lower-cased content like vocab always did
+URLS = (
+    r'https?://(www\.)?'
+    r'[-a-z0-9@:%._+~#=]{1,255}\.[a-z0-9()]{1,6}\y([-a-z0-9()@:%_+.~#?&/=]*)'
+)
+MENTIONS = r'<@!?\d+>|<#\d+>'
+EMOJIS = r'<a?:\w+:\d+>'
+EMOJI_NAMES = r'<a?:(\w+):\d+>'
+
+# Longer "words" are spam, and couldn't always fit in a btree entry anyway
+MAX_WORD_LENGTH = 64
+
+
+def literal(value: str) -> str:
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def cleaned_content(column: str) -> str:
+    # SQL expression for a message with links, mentions, emojis and punctuation taken out
+    return 'translate(regexp_replace(lower({}), {}, \'\', \'g\'), {}, \'\')'.format(
+        column, literal('|'.join([URLS, MENTIONS, EMOJIS])), literal(string.punctuation)
+    )
+
+
+# Words are split the way vocab cleans messages, custom emojis are kept as separate :name: tokens for wordclouds
+WORDS_FUNCTION = (
+    'CREATE OR REPLACE FUNCTION statbot_db.message_words(Content TEXT) RETURNS SETOF TEXT AS $$ '
+    '    SELECT T.Word FROM ('
+    '        SELECT regexp_split_to_table({0}, \'\\s+\') AS Word '
+    '        UNION ALL '
+    '        SELECT \':\' || E.Name[1] || \':\' FROM regexp_matches(Content, {1}, \'g\') AS E(Name)'
+    '    ) AS T '
+    '    WHERE Content !~ {2} AND T.Word <> \'\' AND length(T.Word) <= {3} '
+    '$$ LANGUAGE sql IMMUTABLE'.format(
+        cleaned_content('Content'),
+        literal(EMOJI_NAMES),
+        literal(COMMAND_PREFIXES),
+        MAX_WORD_LENGTH
+    )
+)
+
+INSERT_TRIGGER_FUNCTION = (
+    'CREATE OR REPLACE FUNCTION statbot_db.count_inserted_words() RETURNS TRIGGER AS $$ '
+    'BEGIN '
+    '    INSERT INTO statbot_db.WORD_COUNTS AS C (ServerID, ChannelID, AuthorID, Word, Uses) '
+    '    SELECT N.ServerID, N.ChannelID, N.AuthorID, W.Word, COUNT(*) '
+    '    FROM NEW_ROWS AS N, statbot_db.message_words(N.Content) AS W(Word) '
+    '    GROUP BY N.ServerID, N.ChannelID, N.AuthorID, W.Word '
+    '    ON CONFLICT (ServerID, ChannelID, AuthorID, Word) DO UPDATE SET Uses = C.Uses + EXCLUDED.Uses; '
+    '    RETURN NULL; '
+    'END; '
+    '$$ LANGUAGE plpgsql'
+)
+
+# Counts that drop to zero are removed, only the channel/author pairs the statement touched need looking at
+DELETE_TRIGGER_FUNCTION = (
+    'CREATE OR REPLACE FUNCTION statbot_db.count_deleted_words() RETURNS TRIGGER AS $$ '
+    'BEGIN '
+    '    UPDATE statbot_db.WORD_COUNTS AS C '
+    '    SET Uses = C.Uses - D.Uses '
+    '    FROM (SELECT O.ServerID, O.ChannelID, O.AuthorID, W.Word, COUNT(*) AS Uses '
+    '          FROM OLD_ROWS AS O, statbot_db.message_words(O.Content) AS W(Word) '
+    '          GROUP BY O.ServerID, O.ChannelID, O.AuthorID, W.Word) AS D '
+    '    WHERE C.ServerID = D.ServerID AND C.ChannelID = D.ChannelID AND C.AuthorID = D.AuthorID '
+    '    AND C.Word = D.Word; '
+    '    DELETE FROM statbot_db.WORD_COUNTS AS C '
+    '    USING (SELECT DISTINCT ServerID, ChannelID, AuthorID FROM OLD_ROWS) AS D '
+    '    WHERE C.ServerID = D.ServerID AND C.ChannelID = D.ChannelID AND C.AuthorID = D.AuthorID '
+    '    AND C.Uses <= 0; '
+    '    RETURN NULL; '
+    'END; '
+    '$$ LANGUAGE plpgsql'
+)
+
+# An edit takes back the old message's words and counts the new ones, as a single net change per word
+UPDATE_TRIGGER_FUNCTION = (
+    'CREATE OR REPLACE FUNCTION statbot_db.count_edited_words() RETURNS TRIGGER AS $$ '
+    'BEGIN '
+    '    INSERT INTO statbot_db.WORD_COUNTS AS C (ServerID, ChannelID, AuthorID, Word, Uses) '
+    '    SELECT D.ServerID, D.ChannelID, D.AuthorID, D.Word, SUM(D.Uses) '
+    '    FROM (SELECT N.ServerID, N.ChannelID, N.AuthorID, W.Word, 1 AS Uses '
+    '          FROM NEW_ROWS AS N JOIN OLD_ROWS AS O ON O.MessageID = N.MessageID, '
+    '               statbot_db.message_words(N.Content) AS W(Word) '
+    '          WHERE N.Content IS DISTINCT FROM O.Content '
+    '          UNION ALL '
+    '          SELECT O.ServerID, O.ChannelID, O.AuthorID, W.Word, -1 AS Uses '
+    '          FROM OLD_ROWS AS O JOIN NEW_ROWS AS N ON N.MessageID = O.MessageID, '
+    '               statbot_db.message_words(O.Content) AS W(Word) '
+    '          WHERE N.Content IS DISTINCT FROM O.Content) AS D '
+    '    GROUP BY D.ServerID, D.ChannelID, D.AuthorID, D.Word '
+    '    HAVING SUM(D.Uses) <> 0 '
+    '    ON CONFLICT (ServerID, ChannelID, AuthorID, Word) DO UPDATE SET Uses = C.Uses + EXCLUDED.Uses; '
+    '    DELETE FROM statbot_db.WORD_COUNTS AS C '
+    '    USING (SELECT DISTINCT ServerID, ChannelID, AuthorID FROM NEW_ROWS) AS D '
+    '    WHERE C.ServerID = D.ServerID AND C.ChannelID = D.ChannelID AND C.AuthorID = D.AuthorID '
+    '    AND C.Uses <= 0; '
+    '    RETURN NULL; '
+    'END; '
+    '$$ LANGUAGE plpgsql'
+)
+
+TRIGGERS = [
+    ('count_inserted_words', 'INSERT', 'NEW TABLE AS NEW_ROWS'),
+    ('count_deleted_words', 'DELETE', 'OLD TABLE AS OLD_ROWS'),
+    ('count_edited_words', 'UPDATE', 'OLD TABLE AS OLD_ROWS NEW TABLE AS NEW_ROWS'),
+]
+
+
+async def install_triggers(conn: asyncpg.Connection, table: str = 'MESSAGES') -> None:
+    await conn.execute(WORDS_FUNCTION)
+    await conn.execute(INSERT_TRIGGER_FUNCTION)
+    await conn.execute(DELETE_TRIGGER_FUNCTION)
+    await conn.execute(UPDATE_TRIGGER_FUNCTION)
+
+    for name, event, transition in TRIGGERS:
+        await conn.execute('DROP TRIGGER IF EXISTS {} ON statbot_db.{}'.format(name, table))
+        await conn.execute(
+            'CREATE TRIGGER {0} AFTER {1} ON statbot_db.{2} '
+            'REFERENCING {3} '
+            'FOR EACH STATEMENT EXECUTE FUNCTION statbot_db.{0}()'.format(name, event, table, transition)
+        )
+
+
+async def remove_triggers(conn: asyncpg.Connection, table: str = 'MESSAGES') -> None:
+    for name, _, _ in TRIGGERS:
+        await conn.execute('DROP TRIGGER IF EXISTS {} ON statbot_db.{}'.format(name, table))
+
+
+async def recount_server(conn: asyncpg.Connection, server_id: int) -> None:
+    # Needed whenever messages move without passing through the triggers, e.g. a partition swap
+    async with conn.transaction():
+        await conn.execute('LOCK TABLE statbot_db.WORD_COUNTS IN SHARE ROW EXCLUSIVE MODE')
+        await conn.execute('DELETE FROM statbot_db.WORD_COUNTS WHERE ServerID = $1', server_id)
+        await conn.execute(
+            'INSERT INTO statbot_db.WORD_COUNTS (ServerID, ChannelID, AuthorID, Word, Uses) '
+            'SELECT M.ServerID, M.ChannelID, M.AuthorID, W.Word, COUNT(*) '
+            'FROM statbot_db.MESSAGES AS M, statbot_db.message_words(M.Content) AS W(Word) '
+            'WHERE M.ServerID = $1 '
+            'GROUP BY M.ServerID, M.ChannelID, M.AuthorID, W.Word',
+            server_id
+        )
+
+
+async def recount_all(conn: asyncpg.Connection) -> None:
+    # Every server's counts have to come from the same tokenizer, so a change to it recounts them all
+    async with conn.transaction():
+        await conn.execute('LOCK TABLE statbot_db.WORD_COUNTS IN SHARE ROW EXCLUSIVE MODE')
+        await conn.execute('DELETE FROM statbot_db.WORD_COUNTS')
+        await conn.execute(
+            'INSERT INTO statbot_db.WORD_COUNTS (ServerID, ChannelID, AuthorID, Word, Uses) '
+            'SELECT M.ServerID, M.ChannelID, M.AuthorID, W.Word, COUNT(*) '
+            'FROM statbot_db.MESSAGES AS M, statbot_db.message_words(M.Content) AS W(Word) '
+            'GROUP BY M.ServerID, M.ChannelID, M.AuthorID, W.Word'
+        )
+
+
+async def word_frequencies(
+        conn: asyncpg.Connection,
+        server_id: int,
+        author_id: Optional[int] = None,
+        channel_id: Optional[int] = None,
+        limit: Optional[int] = None
+) -> list[asyncpg.Record]:
+    return await conn.fetch(
+        'SELECT Word AS word, SUM(Uses)::BIGINT AS counts FROM statbot_db.WORD_COUNTS '
+        'WHERE ServerID = $1 AND ($2::BIGINT IS NULL OR AuthorID = $2) AND ($3::BIGINT IS NULL OR ChannelID = $3) '
+        'AND Word NOT LIKE \':%\' '
+        'GROUP BY Word '
+        'ORDER BY counts DESC, word '
+        'LIMIT $4',
+        server_id,
+        author_id,
+        channel_id,
+        limit
+    )
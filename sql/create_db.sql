@@ -6,12 +6,16 @@ CREATE TABLE SERVERS
 (ServerID		BIGINT,
 Importing	 	BOOL DEFAULT TRUE,
 ImportHistory	BOOL DEFAULT FALSE,
+Removing		BOOL DEFAULT FALSE,
 PRIMARY KEY(ServerID));
 
 CREATE TABLE CHANNELS
 (ChannelID	BIGINT,
 ServerID	BIGINT	NOT NULL,
 Importing	BOOL	DEFAULT TRUE,
+OldestImported	BIGINT,
+NewestImported	BIGINT,
+Removing	BOOL	DEFAULT FALSE,
 PRIMARY KEY(ChannelID),
 FOREIGN KEY(ServerID) REFERENCES SERVERS(ServerID)
        ON DELETE CASCADE
@@ -53,3 +57,46 @@ FOREIGN KEY(ChannelID) REFERENCES CHANNELS(ChannelID)
 
 CREATE INDEX idx_MESSAGES_AuthorID
 ON MESSAGES (AuthorID);
+
+CREATE INDEX idx_MESSAGES_ServerID_AuthorID
+ON MESSAGES (ServerID, AuthorID);
+
+CREATE INDEX idx_MESSAGES_ServerID_ChannelID_AuthorID
+ON MESSAGES (ServerID, ChannelID, AuthorID);
+
+CREATE INDEX idx_MESSAGES_ServerID_Sent
+ON MESSAGES (ServerID, Sent) INCLUDE (ChannelID, AuthorID);
+
+CREATE TABLE IMPORT_JOBS
+(JobID		BIGSERIAL,
+ServerID	BIGINT		NOT NULL,
+ChannelID	BIGINT		NOT NULL,
+Priority	INT			NOT NULL,
+After		BIGINT,
+State		VARCHAR(16)	DEFAULT 'queued',
+Attempts	INT			DEFAULT 0,
+Error		TEXT,
+Enqueued	TIMESTAMPTZ	DEFAULT now(),
+PRIMARY KEY(JobID),
+FOREIGN KEY(ChannelID) REFERENCES CHANNELS(ChannelID)
+       ON DELETE CASCADE
+       ON UPDATE CASCADE);
+
+CREATE UNIQUE INDEX idx_IMPORT_JOBS_Active
+ON IMPORT_JOBS (ChannelID) WHERE State IN ('queued', 'running');
+
+-- MESSAGE_COUNTS and WORD_COUNTS and the triggers that keep them current come from migrations 0004 and 0006,
+-- which the bot applies on its first startup
+
+-- Migrations already reflected in this script, so the bot doesn't apply them again on startup
+CREATE TABLE SCHEMA_MIGRATIONS
+(Version	INT,
+Name		TEXT		NOT NULL,
+Applied		TIMESTAMPTZ	DEFAULT now(),
+PRIMARY KEY(Version));
+
+INSERT INTO SCHEMA_MIGRATIONS (Version, Name) VALUES
+(1, 'import_cursors'),
+(2, 'removal_flags'),
+(3, 'import_jobs'),
+(5, 'analytics_indexes');
@@ -0,0 +1,12 @@
+SET search_path TO STATBOT_DB;
+
+ALTER TABLE CHANNELS ADD COLUMN IF NOT EXISTS OldestImported BIGINT;
+ALTER TABLE CHANNELS ADD COLUMN IF NOT EXISTS NewestImported BIGINT;
+
+-- Seed cursors for channels imported before cursors existed, so startup catch-up doesn't re-fetch them
+UPDATE CHANNELS AS C
+SET OldestImported = M.OldestImported, NewestImported = M.NewestImported
+FROM (SELECT ChannelID, MIN(MessageID) AS OldestImported, MAX(MessageID) AS NewestImported
+      FROM MESSAGES
+      GROUP BY ChannelID) AS M
+WHERE C.ChannelID = M.ChannelID AND C.NewestImported IS NULL;
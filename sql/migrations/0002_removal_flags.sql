@@ -0,0 +1,5 @@
+SET search_path TO STATBOT_DB;
+
+-- Servers and channels flagged as Removing are hidden from the bot while their messages are purged in the background
+ALTER TABLE SERVERS ADD COLUMN IF NOT EXISTS Removing BOOL DEFAULT FALSE;
+ALTER TABLE CHANNELS ADD COLUMN IF NOT EXISTS Removing BOOL DEFAULT FALSE;
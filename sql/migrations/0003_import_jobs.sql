@@ -0,0 +1,20 @@
+SET search_path TO STATBOT_DB;
+
+-- Persistent queue of channel imports, worked through by the import scheduler
+CREATE TABLE IF NOT EXISTS IMPORT_JOBS
+(JobID		BIGSERIAL,
+ServerID	BIGINT		NOT NULL,
+ChannelID	BIGINT		NOT NULL,
+Priority	INT			NOT NULL,
+After		BIGINT,
+State		VARCHAR(16)	DEFAULT 'queued',
+Attempts	INT			DEFAULT 0,
+Error		TEXT,
+Enqueued	TIMESTAMPTZ	DEFAULT now(),
+PRIMARY KEY(JobID),
+FOREIGN KEY(ChannelID) REFERENCES CHANNELS(ChannelID)
+       ON DELETE CASCADE
+       ON UPDATE CASCADE);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_IMPORT_JOBS_Active
+ON IMPORT_JOBS (ChannelID) WHERE State IN ('queued', 'running');
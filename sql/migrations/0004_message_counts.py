@@ -0,0 +1,30 @@
+import asyncpg
+
+from core import counters
+
+
+async def migrate(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        'CREATE TABLE IF NOT EXISTS statbot_db.MESSAGE_COUNTS '
+        '(ServerID       BIGINT, '
+        'ChannelID       BIGINT, '
+        'AuthorID        BIGINT, '
+        'Messages        BIGINT  NOT NULL DEFAULT 0, '
+        'PRIMARY KEY(ServerID, ChannelID, AuthorID), '
+        'FOREIGN KEY(ServerID) REFERENCES statbot_db.SERVERS(ServerID) '
+        '       ON DELETE CASCADE '
+        '       ON UPDATE CASCADE, '
+        'FOREIGN KEY(ChannelID) REFERENCES statbot_db.CHANNELS(ChannelID) '
+        '       ON DELETE CASCADE '
+        '       ON UPDATE CASCADE)'
+    )
+    await counters.install_triggers(conn)
+
+    # Writes wait while the counters are seeded, so none of them are counted twice or missed
+    await conn.execute('LOCK TABLE statbot_db.MESSAGES IN SHARE MODE')
+    await conn.execute(
+        'INSERT INTO statbot_db.MESSAGE_COUNTS (ServerID, ChannelID, AuthorID, Messages) '
+        'SELECT ServerID, ChannelID, AuthorID, COUNT(*) FROM statbot_db.MESSAGES '
+        'GROUP BY ServerID, ChannelID, AuthorID '
+        'ON CONFLICT DO NOTHING'
+    )
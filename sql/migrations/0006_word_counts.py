@@ -0,0 +1,32 @@
+import asyncpg
+
+from core import words
+
+
+async def migrate(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        'CREATE TABLE IF NOT EXISTS statbot_db.WORD_COUNTS '
+        '(ServerID       BIGINT, '
+        'ChannelID       BIGINT, '
+        'AuthorID        BIGINT, '
+        'Word            TEXT, '
+        'Uses            BIGINT  NOT NULL DEFAULT 0, '
+        'PRIMARY KEY(ServerID, ChannelID, AuthorID, Word), '
+        'FOREIGN KEY(ServerID) REFERENCES statbot_db.SERVERS(ServerID) '
+        '       ON DELETE CASCADE '
+        '       ON UPDATE CASCADE, '
+        'FOREIGN KEY(ChannelID) REFERENCES statbot_db.CHANNELS(ChannelID) '
+        '       ON DELETE CASCADE '
+        '       ON UPDATE CASCADE)'
+    )
+    await words.install_triggers(conn)
+
+    # Existing messages are counted once, with writes held off until the triggers take over at commit
+    await conn.execute('LOCK TABLE statbot_db.MESSAGES IN SHARE MODE')
+    await conn.execute(
+        'INSERT INTO statbot_db.WORD_COUNTS (ServerID, ChannelID, AuthorID, Word, Uses) '
+        'SELECT M.ServerID, M.ChannelID, M.AuthorID, W.Word, COUNT(*) '
+        'FROM statbot_db.MESSAGES AS M, statbot_db.message_words(M.Content) AS W(Word) '
+        'GROUP BY M.ServerID, M.ChannelID, M.AuthorID, W.Word '
+        'ON CONFLICT DO NOTHING'
+    )
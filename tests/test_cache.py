@@ -0,0 +1,156 @@
+import sys
+import unittest
+from unittest import mock
+
+from core.cache import ReportCache
+
+GUILD_ID = 10
+
+
+def key(name: str, guild_id: int = GUILD_ID) -> tuple:
+    return name, guild_id, None, None, ()
+
+
+def make_cache(max_entries: int = 10, max_bytes: int = 1024 * 1024, ttl: float = 60) -> ReportCache:
+    return ReportCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+
+
+class ReportCacheTests(unittest.TestCase):
+    def test_hit_and_miss(self) -> None:
+        cache = make_cache()
+
+        self.assertEqual(cache.get(key('vocab')), (False, None))
+        cache.put(key('vocab'), 'result', cache.version(GUILD_ID))
+
+        self.assertEqual(cache.get(key('vocab')), (True, 'result'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_bump_makes_guild_entries_stale(self) -> None:
+        cache = make_cache()
+        cache.put(key('vocab'), 'result', cache.version(GUILD_ID))
+        cache.put(key('vocab', guild_id=11), 'other', cache.version(11))
+
+        cache.bump(GUILD_ID)
+
+        self.assertEqual(cache.get(key('vocab')), (False, None))
+        self.assertEqual(cache.get(key('vocab', guild_id=11)), (True, 'other'))
+        self.assertEqual(cache.stale, 1)
+        self.assertEqual(cache.bytes, sys.getsizeof('other'))
+
+    def test_bump_without_guild_is_ignored(self) -> None:
+        cache = make_cache()
+
+        cache.bump(None)
+
+        self.assertEqual(cache.version(GUILD_ID), 0)
+
+    def test_put_is_ignored_if_guild_changed_meanwhile(self) -> None:
+        cache = make_cache()
+        version = cache.version(GUILD_ID)
+
+        cache.bump(GUILD_ID)
+        cache.put(key('vocab'), 'result', version)
+
+        self.assertEqual(cache.get(key('vocab')), (False, None))
+        self.assertEqual(cache.bytes, 0)
+
+    def test_entries_expire_after_ttl(self) -> None:
+        cache = make_cache(ttl=60)
+        with mock.patch('core.cache.time.time', return_value=1000.0):
+            cache.put(key('vocab'), 'result', cache.version(GUILD_ID))
+
+        with mock.patch('core.cache.time.time', return_value=1060.0):
+            self.assertEqual(cache.get(key('vocab')), (True, 'result'))
+        with mock.patch('core.cache.time.time', return_value=1061.0):
+            self.assertEqual(cache.get(key('vocab')), (False, None))
+
+        self.assertEqual(cache.expired, 1)
+        self.assertEqual(cache.bytes, 0)
+
+    def test_least_recently_used_evicted_past_max_entries(self) -> None:
+        cache = make_cache(max_entries=2)
+        cache.put(key('a'), 'a', 0)
+        cache.put(key('b'), 'b', 0)
+        cache.get(key('a'))
+
+        cache.put(key('c'), 'c', 0)
+
+        self.assertEqual(cache.get(key('b')), (False, None))
+        self.assertEqual(cache.get(key('a')), (True, 'a'))
+        self.assertEqual(cache.get(key('c')), (True, 'c'))
+        self.assertEqual(cache.evicted, 1)
+
+    def test_least_recently_used_evicted_past_max_bytes(self) -> None:
+        value = 'x' * 100
+        size = sys.getsizeof(value)
+        cache = make_cache(max_bytes=size * 2)
+        cache.put(key('a'), value, 0)
+        cache.put(key('b'), value, 0)
+
+        cache.put(key('c'), value, 0)
+
+        self.assertEqual(cache.get(key('a')), (False, None))
+        self.assertEqual(cache.bytes, size * 2)
+        self.assertEqual(cache.evicted, 1)
+
+    def test_value_larger_than_cache_is_not_stored(self) -> None:
+        cache = make_cache(max_bytes=10)
+
+        cache.put(key('vocab'), 'x' * 100, 0)
+
+        self.assertEqual(cache.get(key('vocab')), (False, None))
+        self.assertEqual(cache.evicted, 0)
+
+    def test_cache_without_entries_stores_nothing(self) -> None:
+        cache = make_cache(max_entries=0)
+
+        cache.put(key('vocab'), 'result', 0)
+
+        self.assertEqual(cache.get(key('vocab')), (False, None))
+        self.assertEqual((cache.bytes, cache.evicted), (0, 0))
+
+    def test_replacing_entry_keeps_size_accurate(self) -> None:
+        cache = make_cache()
+
+        cache.put(key('vocab'), 'x' * 100, 0)
+        cache.put(key('vocab'), 'y', 0)
+
+        self.assertEqual(cache.bytes, sys.getsizeof('y'))
+
+    def test_clear(self) -> None:
+        cache = make_cache()
+        cache.put(key('vocab'), 'result', 0)
+
+        cache.clear()
+
+        self.assertEqual(cache.get(key('vocab')), (False, None))
+        self.assertEqual(cache.bytes, 0)
+
+
+class ReportCacheComputeTests(unittest.IsolatedAsyncioTestCase):
+    async def test_computes_once(self) -> None:
+        cache = make_cache()
+        calls = list()
+
+        async def compute() -> str:
+            calls.append(1)
+            return 'result'
+
+        self.assertEqual(await cache.get_or_compute(key('vocab'), compute), 'result')
+        self.assertEqual(await cache.get_or_compute(key('vocab'), compute), 'result')
+        self.assertEqual(len(calls), 1)
+
+    async def test_result_not_cached_if_guild_changed_during_compute(self) -> None:
+        cache = make_cache()
+
+        async def compute() -> str:
+            # New messages were written while the query ran
+            cache.bump(GUILD_ID)
+            return 'result'
+
+        self.assertEqual(await cache.get_or_compute(key('vocab'), compute), 'result')
+        self.assertEqual(cache.get(key('vocab')), (False, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,324 @@
+import asyncio
+import datetime
+import unittest
+from contextlib import asynccontextmanager
+
+import asyncpg
+
+from core.ingest import MessageBuffer
+
+SERVER_ID = 10
+CHANNEL_ID = 20
+
+
+def row(message_id: int, content: str = 'hello', edited_at: datetime.datetime = None) -> list:
+    sent = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+    return [message_id, None, content, [], sent, edited_at, SERVER_ID, CHANNEL_ID, 1]
+
+
+class FakeConnection:
+    def __init__(self) -> None:
+        self.inserted = list()
+        self.cursor_rows = list()
+        self.updates = list()
+        self.deletes = list()
+        self.statements = 0
+        # Raised by the next write, then cleared
+        self.fail_with = None
+        self.bad_rows = set()
+
+    def _maybe_fail(self) -> None:
+        if self.fail_with is not None:
+            error, self.fail_with = self.fail_with, None
+            raise error
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def execute(self, query: str, *args):
+        self._maybe_fail()
+        if query.startswith('INSERT INTO statbot_db.MESSAGES'):
+            # One array per column, the whole batch is a single statement
+            self.statements += 1
+            if any(message_id in self.bad_rows for message_id in args[0]):
+                raise asyncpg.UniqueViolationError('bad row')
+            self.inserted.extend(args[0])
+            return 'INSERT 0 {}'.format(len(args[0]))
+        if query.startswith('UPDATE statbot_db.CHANNELS'):
+            self.cursor_rows.extend(args[0])
+            return 'UPDATE 1'
+        if query.startswith('UPDATE statbot_db.MESSAGES'):
+            self.updates.append(dict(zip(args[0], zip(args[1], args[2]))))
+            return 'UPDATE {}'.format(len(args[0]))
+        if query.startswith('DELETE FROM statbot_db.MESSAGES'):
+            self.deletes.extend(args[0])
+            return 'DELETE {}'.format(len(args[0]))
+        raise AssertionError('Unexpected query: {}'.format(query))
+
+
+class FakePool:
+    def __init__(self) -> None:
+        self.conn = FakeConnection()
+
+    @asynccontextmanager
+    async def acquire(self, label: str = None):
+        yield self.conn
+
+
+class FakeCache:
+    def __init__(self) -> None:
+        self.bumped = list()
+
+    def bump(self, guild_id: int) -> None:
+        self.bumped.append(guild_id)
+
+
+def make_buffer(batch_size: int = 100) -> MessageBuffer:
+    return MessageBuffer(
+        FakePool(), key='MessageID', batch_size=batch_size, flush_interval=60, max_queue=1000,
+        report_cache=FakeCache()
+    )
+
+
+class MessageBufferInsertTests(unittest.IsolatedAsyncioTestCase):
+    async def test_flush_writes_pending_rows_in_batches(self) -> None:
+        buffer = make_buffer(batch_size=2)
+        for message_id in range(1, 6):
+            buffer.put(row(message_id))
+
+        await buffer.flush()
+
+        self.assertEqual(buffer.pool.conn.inserted, [1, 2, 3, 4, 5])
+        self.assertEqual(buffer.pool.conn.statements, 3)
+        self.assertEqual(buffer.stats.batches, 3)
+        self.assertEqual(buffer.depth, 0)
+
+    async def test_delete_cancels_pending_insert(self) -> None:
+        buffer = make_buffer()
+        buffer.put(row(1))
+        buffer.put(row(2))
+
+        buffer.delete([1, 3], SERVER_ID)
+        await buffer.flush()
+
+        self.assertEqual(buffer.pool.conn.inserted, [2])
+        # Only the message that wasn't pending has to be deleted from the DB
+        self.assertEqual(buffer.pool.conn.deletes, [3])
+        self.assertEqual(buffer.stats.cancelled_inserts, 1)
+
+    async def test_full_queue_drops_rows(self) -> None:
+        buffer = MessageBuffer(FakePool(), key='MessageID', batch_size=10, flush_interval=60, max_queue=2)
+        for message_id in range(1, 4):
+            buffer.put(row(message_id))
+
+        self.assertEqual(buffer.depth, 2)
+        self.assertEqual(buffer.stats.dropped, 1)
+
+    async def test_connection_failure_requeues_batch(self) -> None:
+        buffer = make_buffer()
+        buffer.put(row(1))
+        buffer.put(row(2))
+        buffer.pool.conn.fail_with = asyncpg.ConnectionDoesNotExistError('connection lost')
+
+        with self.assertRaises(asyncpg.ConnectionDoesNotExistError):
+            await buffer.flush()
+
+        self.assertEqual(buffer.pool.conn.inserted, [])
+        self.assertEqual(buffer.depth, 2)
+
+        buffer.put(row(3))
+        await buffer.flush()
+
+        # Retried ahead of what came in meanwhile
+        self.assertEqual(buffer.pool.conn.inserted, [1, 2, 3])
+
+    async def test_os_error_requeues_batch(self) -> None:
+        buffer = make_buffer()
+        buffer.put(row(1))
+        buffer.pool.conn.fail_with = ConnectionRefusedError()
+
+        with self.assertRaises(OSError):
+            await buffer.flush()
+        await buffer.flush()
+
+        self.assertEqual(buffer.pool.conn.inserted, [1])
+
+    async def test_delete_of_requeued_row_still_reaches_db(self) -> None:
+        buffer = make_buffer()
+        buffer.put(row(1))
+        buffer.pool.conn.fail_with = asyncpg.ConnectionDoesNotExistError('connection lost')
+        with self.assertRaises(asyncpg.ConnectionDoesNotExistError):
+            await buffer.flush()
+
+        # The failed batch may have been stored before the connection went
+        buffer.delete([1], SERVER_ID)
+        await buffer.flush()
+
+        self.assertEqual(buffer.pool.conn.inserted, [])
+        self.assertEqual(buffer.pool.conn.deletes, [1])
+
+    async def test_failed_deletes_are_requeued(self) -> None:
+        buffer = make_buffer()
+        buffer.delete([1, 2], SERVER_ID)
+        buffer.pool.conn.fail_with = asyncpg.ConnectionDoesNotExistError('connection lost')
+
+        with self.assertRaises(asyncpg.ConnectionDoesNotExistError):
+            await buffer.flush()
+        await buffer.flush()
+
+        self.assertEqual(sorted(buffer.pool.conn.deletes), [1, 2])
+
+    async def test_flush_only_takes_rows_queued_when_it_started(self) -> None:
+        buffer = make_buffer(batch_size=1)
+        buffer.put(row(1))
+        buffer.delete([100], SERVER_ID)
+
+        conn = buffer.pool.conn
+        execute = conn.execute
+
+        async def busy_execute(query: str, *args):
+            status = await execute(query, *args)
+            # A busy guild keeps the queue full while each batch is written
+            if query.startswith('INSERT INTO statbot_db.MESSAGES'):
+                buffer.put(row(args[0][0] + 1))
+            return status
+
+        conn.execute = busy_execute
+        await buffer.flush()
+
+        self.assertEqual(conn.inserted, [1])
+        self.assertEqual(conn.deletes, [100])
+        self.assertEqual(buffer.depth, 1)
+
+    async def test_row_failures_only_advance_cursors_past_written_rows(self) -> None:
+        buffer = make_buffer()
+        buffer.put(row(1))
+        buffer.put(row(2))
+        buffer.put(row(3))
+        buffer.pool.conn.bad_rows = {3}
+
+        await buffer.flush()
+
+        self.assertEqual(buffer.pool.conn.inserted, [1, 2])
+        self.assertEqual(buffer.pool.conn.cursor_rows, [1, 2])
+        self.assertEqual(buffer.stats.failed_rows, 1)
+
+    async def test_paused_buffer_flushes_first_and_then_holds_writes(self) -> None:
+        buffer = make_buffer()
+        buffer.put(row(1))
+
+        async with buffer.paused():
+            self.assertEqual(buffer.pool.conn.inserted, [1])
+            buffer.put(row(2))
+            flush = asyncio.create_task(buffer.flush())
+            await asyncio.sleep(0)
+            self.assertEqual(buffer.pool.conn.inserted, [1])
+            buffer.key = 'MessageID, ServerID'
+
+        await flush
+        self.assertEqual(buffer.pool.conn.inserted, [1, 2])
+
+    async def test_cache_is_bumped_after_commit(self) -> None:
+        buffer = make_buffer()
+        buffer.put(row(1))
+        self.assertEqual(buffer.report_cache.bumped, [])
+
+        await buffer.flush()
+
+        self.assertEqual(buffer.report_cache.bumped, [SERVER_ID])
+
+
+def at(minute: int) -> datetime.datetime:
+    return datetime.datetime(2022, 1, 1, 0, minute, tzinfo=datetime.timezone.utc)
+
+
+class MessageBufferEditTests(unittest.IsolatedAsyncioTestCase):
+    async def test_edit_merges_into_pending_row(self) -> None:
+        buffer = make_buffer()
+        buffer.put(row(1))
+
+        buffer.edit(1, 'edited', at(1), SERVER_ID)
+        self.assertEqual(buffer.depth, 1)
+        await buffer.flush()
+
+        self.assertEqual(buffer.pool.conn.inserted, [1])
+        self.assertEqual(buffer.pool.conn.updates, [])
+        self.assertEqual(buffer.stats.edits_merged, 1)
+
+    async def test_edits_coalesce_to_latest(self) -> None:
+        buffer = make_buffer()
+        buffer.edit(1, 'first', at(1), SERVER_ID)
+        buffer.edit(1, 'second', at(2), SERVER_ID)
+
+        await buffer.flush()
+
+        self.assertEqual(buffer.pool.conn.updates, [{1: ('second', at(2))}])
+        self.assertEqual(buffer.stats.edits_coalesced, 1)
+
+    async def test_out_of_order_edit_is_ignored(self) -> None:
+        buffer = make_buffer()
+        buffer.edit(1, 'second', at(2), SERVER_ID)
+        buffer.edit(1, 'first', at(1), SERVER_ID)
+
+        await buffer.flush()
+
+        self.assertEqual(buffer.pool.conn.updates, [{1: ('second', at(2))}])
+
+    async def test_delete_cancels_pending_edit(self) -> None:
+        buffer = make_buffer()
+        buffer.edit(1, 'edited', at(1), SERVER_ID)
+        buffer.delete([1], SERVER_ID)
+        # Discord can still deliver an edit for a message that is gone
+        buffer.edit(1, 'late', at(2), SERVER_ID)
+
+        await buffer.flush()
+
+        self.assertEqual(buffer.pool.conn.updates, [])
+        self.assertEqual(buffer.pool.conn.deletes, [1])
+        self.assertEqual(buffer.stats.edits_cancelled, 2)
+        self.assertEqual(buffer.stats.untracked_edits, 0)
+
+    async def test_edits_are_written_after_inserts(self) -> None:
+        buffer = make_buffer(batch_size=1)
+        buffer.put(row(1))
+        conn = buffer.pool.conn
+        execute = conn.execute
+
+        async def edited_during_write(query: str, *args):
+            status = await execute(query, *args)
+            # The row is no longer pending, so this becomes an UPDATE for the same flush
+            if query.startswith('INSERT INTO statbot_db.MESSAGES'):
+                buffer.edit(1, 'edited', at(1), SERVER_ID)
+            return status
+
+        conn.execute = edited_during_write
+        await buffer.flush()
+
+        self.assertEqual(conn.inserted, [1])
+        self.assertEqual(conn.updates, [{1: ('edited', at(1))}])
+
+    async def test_failed_edits_are_requeued_behind_newer_ones(self) -> None:
+        buffer = make_buffer()
+        buffer.edit(1, 'first', at(1), SERVER_ID)
+        buffer.edit(2, 'other', at(1), SERVER_ID)
+        conn = buffer.pool.conn
+        execute = conn.execute
+
+        async def edited_while_failing(query: str, *args):
+            if query.startswith('UPDATE statbot_db.MESSAGES'):
+                buffer.edit(1, 'second', at(2), SERVER_ID)
+                conn.execute = execute
+                raise asyncpg.ConnectionDoesNotExistError('connection lost')
+            return await execute(query, *args)
+
+        conn.execute = edited_while_failing
+        with self.assertRaises(asyncpg.ConnectionDoesNotExistError):
+            await buffer.flush()
+        await buffer.flush()
+
+        self.assertEqual(conn.updates, [{1: ('second', at(2)), 2: ('other', at(1))}])
+
+
+if __name__ == '__main__':
+    unittest.main()
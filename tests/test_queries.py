@@ -0,0 +1,18 @@
+import re
+import unittest
+
+from core import queries
+
+
+class ReportParameterTests(unittest.TestCase):
+    def test_every_report_query_has_its_parameters(self) -> None:
+        for name, parameters in queries.REPORT_PARAMETERS.items():
+            numbers = {int(n) for n in re.findall(r'\$(\d+)', queries.QUERIES[name])}
+            self.assertEqual(numbers, set(range(1, len(parameters) + 1)), name)
+
+    def test_only_blocked_users_is_not_a_report(self) -> None:
+        self.assertEqual(set(queries.QUERIES) - set(queries.REPORT_PARAMETERS), {'blocked_users'})
+
+
+if __name__ == '__main__':
+    unittest.main()
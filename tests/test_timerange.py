@@ -0,0 +1,109 @@
+import datetime
+import unittest
+
+from discord.ext import commands
+
+from core.timerange import EARLIEST, LATEST, TimeRange, TimeRangeConverter
+
+
+def day(year: int, month: int, date: int) -> datetime.datetime:
+    return datetime.datetime(year, month, date, tzinfo=datetime.timezone.utc)
+
+
+def today() -> datetime.datetime:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class TimeRangeTests(unittest.TestCase):
+    def test_empty_range_is_unbounded(self) -> None:
+        time_range = TimeRange()
+
+        self.assertFalse(time_range)
+        self.assertEqual(time_range.bounds, (EARLIEST, LATEST))
+        self.assertEqual(time_range.describe(), 'in total')
+
+    def test_since(self) -> None:
+        time_range = TimeRange()
+
+        self.assertTrue(time_range.update('since:2022-01-15'))
+        self.assertTrue(time_range)
+        self.assertEqual(time_range.bounds, (day(2022, 1, 15), LATEST))
+        self.assertEqual(time_range.describe(), 'since 2022-01-15')
+
+    def test_until_includes_the_whole_day(self) -> None:
+        time_range = TimeRange()
+
+        time_range.update('until:2022-06-30')
+
+        self.assertEqual(time_range.bounds, (EARLIEST, day(2022, 7, 1)))
+        self.assertEqual(time_range.describe(), 'up to 2022-06-30')
+
+    def test_since_and_until(self) -> None:
+        time_range = TimeRange()
+
+        time_range.update('SINCE:2022-01-01')
+        time_range.update('until:2022-01-31')
+
+        self.assertEqual(time_range.key, (day(2022, 1, 1), day(2022, 2, 1)))
+        self.assertEqual(time_range.describe(), 'between 2022-01-01 and 2022-01-31')
+
+    def test_days_counts_today(self) -> None:
+        time_range = TimeRange()
+
+        time_range.update('days:7')
+
+        self.assertEqual(time_range.since, today() - datetime.timedelta(days=6))
+        self.assertIsNone(time_range.until)
+        self.assertEqual(time_range.describe(), 'in the last 7 days')
+        self.assertEqual(TimeRange.last_days(7).key, time_range.key)
+
+    def test_since_replaces_days(self) -> None:
+        time_range = TimeRange()
+
+        time_range.update('days:7')
+        time_range.update('since:2022-01-01')
+
+        self.assertEqual(time_range.describe(), 'since 2022-01-01')
+
+    def test_other_tokens_are_not_time_ranges(self) -> None:
+        time_range = TimeRange()
+
+        for token in ('noemojis', 'https://example.com/image.png', 'since', 'since:', 'from:2022-01-01'):
+            self.assertFalse(time_range.update(token), token)
+        self.assertFalse(time_range)
+
+    def test_bad_values_are_rejected(self) -> None:
+        for token in ('since:2022-13-01', 'until:01/02/2022', 'days:0', 'days:-1', 'days:week'):
+            with self.assertRaises(commands.BadArgument, msg=token):
+                TimeRange().update(token)
+
+    def test_start_must_be_before_end(self) -> None:
+        time_range = TimeRange()
+        time_range.update('since:2022-02-01')
+
+        with self.assertRaises(commands.BadArgument):
+            time_range.update('until:2022-01-01')
+
+    def test_single_day(self) -> None:
+        time_range = TimeRange()
+
+        time_range.update('since:2022-01-01')
+        time_range.update('until:2022-01-01')
+
+        self.assertEqual(time_range.bounds, (day(2022, 1, 1), day(2022, 1, 2)))
+
+
+class TimeRangeConverterTests(unittest.IsolatedAsyncioTestCase):
+    async def test_converts_rest_of_message(self) -> None:
+        time_range = await TimeRangeConverter().convert(None, 'since:2022-01-01 until:2022-01-31')
+
+        self.assertEqual(time_range.key, (day(2022, 1, 1), day(2022, 2, 1)))
+
+    async def test_rejects_unknown_tokens(self) -> None:
+        with self.assertRaises(commands.BadArgument):
+            await TimeRangeConverter().convert(None, 'since:2022-01-01 lately')
+
+
+if __name__ == '__main__':
+    unittest.main()